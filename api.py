@@ -1,12 +1,27 @@
+import collections
+import httplib
 import json
+import logging
 import os.path
+import threading
+import time
 import urllib
-import urllib2
+import Queue
 
-import threadpool
+import httppool
+import imagestore
+from db import PostIdSet
+from imagequeue import IMAGE_QUEUE_SIZE
+from metrics import METRICS
+from scheduler import HOST_RATE, MAX_RETRIES, backoff
+from threadpool import ThreadPool
+
+logger = logging.getLogger(__name__)
 
 API_URL = 'https://api.tumblr.com/v2/'
 API_POST_LIMIT = 20
+PIPELINE_DEPTH = 2  # how many pages each fetcher thread may have in flight ahead of processing
+GONE_CODES = [401, 403, 404]  # HTTP statuses meaning a blog's posts can't be retrieved however often we ask
 
 JSON_PATH = os.path.join(os.getcwd(), ".bush_viper")
 
@@ -14,49 +29,138 @@ with open(os.path.join(os.getcwd(), "secret_key")) as key_file:
     secrets = json.load(key_file)
     CONSUMER_KEY = secrets['consumer_key']
 
+API_REQUESTS = METRICS.counter('api_requests', 'Requests made to the tumblr API')
+API_ERRORS = METRICS.counter('api_errors', 'Requests to the tumblr API that failed')
+API_RESPONSE_BYTES = METRICS.counter('api_response_bytes', 'Response bodies received from the tumblr API, in bytes')
+API_REQUEST_SECONDS = METRICS.histogram('api_request_seconds', 'Time taken by requests to the tumblr API')
+POSTS_PROCESSED = METRICS.counter('posts_processed', 'Posts prepared for storage')
+POST_PROCESS_SECONDS = METRICS.histogram('post_process_seconds', 'Time taken to prepare each post for storage')
+POSTS_REPLAYED = METRICS.counter('posts_replayed', 'Posts rebuilt from archived API responses')
+
 
 class TumblrRequester(object):
     """
     A wrapper around the Tumblr API
+
+    The requester hands the images in posts to its ImageSink, which must be shut down with close() when the
+    requester is finished with; using the requester as a context manager does this, leaving the image queue for the
+    next run if an exception escapes.
     """
 
     __version = '0.1.0'
 
-    def __init__(self, db, host=API_URL):
+    def __init__(self, db, host=API_URL, threadpool=None, archive=False, queue_size=IMAGE_QUEUE_SIZE, spill=False,
+                 host_rate=HOST_RATE):
+        """
+        :param db: the DBAdapter to store posts in
+        :param host: the URL of the API
+        :param threadpool: the ImageSink to hand image URLs to; if `None`, a ThreadPool is created
+        :param archive: whether to keep the raw responses to requests for posts; see archive_page()
+        :param queue_size: how many images the ThreadPool created may hold in memory; see ImageQueue
+        :param spill: whether the ThreadPool created spills images beyond queue_size to disk, rather than holding
+            the crawl back until there is room
+        :param host_rate: requests per second the ThreadPool created sends each media host; if `None`, unlimited
+            until a host throttles it
+        """
         self.db = db
         self.host = host
+        self.archive = archive
         self.headers = {
-            'User-Agent': 'bush-viper/' + self.__version
+            'User-Agent': 'bush-viper/' + self.__version,
+            'Accept-Encoding': 'gzip'
         }
-        self.threadpool = threadpool.ThreadPool()
+        self.pool = httppool.ConnectionPool()
+        if threadpool is None:
+            threadpool = ThreadPool(store=imagestore.ImageStore(db.get_image_hashes()), pool=self.pool,
+                                    queue_size=queue_size, spill=spill, host_rate=host_rate)
+        self.threadpool = threadpool
+        self.images_resumed = False
+        self.gone_blogs = set()
+        self.crawl_updates = {}  # blog -> its update time when its crawl started, recorded once the crawl completes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(drain=exc_type is None)
+
+    def close(self, drain=True):
+        """
+        Shuts down the image downloads and records the images downloaded and still pending.
 
-    def get(self, url, params=None):
+        :param drain: whether to download every queued image first; if not, they are left for the next run
+        :return: None
+        """
+        self.threadpool.close(drain)
+        self.save_image_progress()
+        self.db.flush()
+
+    def get(self, url, params=None, archive_as=None):
         """
         Issues a GET request against the API.
 
+        Requests go over the requester's shared ConnectionPool, so connections to the API are kept alive between
+        calls, and responses may be gzip-compressed.
+
         :param url: the URL requested
         :param params: a dict of parameters for the request
-        :returns: a dict parsed from the JSON response or None if the request failed
+        :param archive_as: for requests for posts, a tuple of the blog and offset requested, under which a successful
+            response is archived if archiving is on
+        :returns: a dict parsed from the JSON response, an error response like tumblr's own if the request failed
+            with one of GONE_CODES, or None if it failed otherwise
         """
-        if params is None:
-            params = {'api_key': CONSUMER_KEY}
-        else:
-            params['api_key'] = CONSUMER_KEY
-
-        url = self.host + url + "?" + urllib.urlencode(params)
+        url = self.api_url(url, params)
 
+        API_REQUESTS.inc()
         try:
-            request = urllib2.Request(url=url, headers=self.headers)
-            response = urllib2.urlopen(request)
+            with API_REQUEST_SECONDS.time():
+                response = self.pool.request(url, headers=self.headers)
+                content = response.read()
+            API_RESPONSE_BYTES.inc(len(content))
             if response.getcode() not in [200, 201, 301]:
-                print 'Failed to retrieve %s with error code %i' % (url, response.getcode())
+                logger.warning('Failed to retrieve %s with error code %i', url, response.getcode())
+                API_ERRORS.inc()
+                if response.getcode() in GONE_CODES:
+                    return {'meta': {'status': response.getcode(), 'msg': httplib.responses[response.getcode()]},
+                            'response': {'error': 'HTTP status %i' % response.getcode()}}
                 return None
-            content = response.read()
-        except urllib2.URLError, e:
-            print 'Failed to retrieve %s with error %s' % (url, str(e))
+        except httppool.REQUEST_ERRORS, e:
+            logger.warning('Failed to retrieve %s with error %s', url, str(e))
+            API_ERRORS.inc()
             return None
 
-        return self.json_parse(content)
+        results = self.json_parse(content)
+        if archive_as is not None and 'meta' not in results:
+            self.archive_page(archive_as[0], archive_as[1], content)
+        return results
+
+    def archive_page(self, blog, offset, content):
+        """
+        Keeps the raw response to a request for posts in the database's archive, if archiving is on, so that the
+        posts can be rebuilt from it later without going back to tumblr; see replay().
+
+        :param blog: the URL of the blog the posts were requested from
+        :param offset: the offset the posts were requested from
+        :param content: the response body, as received
+        :return: None
+        """
+        if self.archive:
+            self.db.archive_response(blog, offset, content)
+
+    def api_url(self, url, params=None):
+        """
+        Builds the full URL for an API request, including the API key.
+
+        :param url: the URL requested, relative to the API host
+        :param params: a dict of parameters for the request
+        :return: the full URL
+        """
+        if params is None:
+            params = {'api_key': CONSUMER_KEY}
+        else:
+            params['api_key'] = CONSUMER_KEY
+
+        return self.host + url + "?" + urllib.urlencode(params)
 
     def json_parse(self, content):
         """
@@ -82,17 +186,23 @@ class TumblrRequester(object):
         """
         Get metadata for the indicated blog and store it in the database.
 
+        The blog's update time is left out until its crawl completes, so that a crawl that is interrupted or
+        stopped by its limit is not mistaken for an up-to-date archive by incremental runs; see finish_crawl().
+
         :param blog: the URL for the blog
-        :return:
+        :return: a dict of the metadata or None if the request failed
         """
         metadata = self.get('blog/%s/info' % blog)
         if metadata is None:  # HTTP error from get()
-            print 'Failed to get metadata; catastrophic HTTP error'
+            logger.warning('Failed to get metadata; catastrophic HTTP error')
+            return None
         elif 'meta' in metadata:  # application-level error from tumblr
-            print 'Failed to get metadata: %s' % metadata['response']['error']
+            logger.warning('Failed to get metadata: %s', metadata['response']['error'])
+            return None
         else:
-            print 'Got metadata for %s' % blog
-            self.db.insert_metadata(blog, metadata['blog']['title'], metadata['blog']['updated'])
+            logger.info('Got metadata for %s', blog)
+            self.db.insert_metadata(blog, metadata['blog']['title'], None)
+            return metadata
 
     def get_posts(self, blog, offset=0):
         """
@@ -104,65 +214,114 @@ class TumblrRequester(object):
         :param offset: which post to start at
         :return: a dict of the posts or None if the request failed
         """
-        results = self.get('blog/%s/posts' % blog, {'offset': offset, 'limit': API_POST_LIMIT})
+        results = self.get('blog/%s/posts' % blog, {'offset': offset, 'limit': API_POST_LIMIT},
+                           archive_as=(blog, offset))
+        return self.check_posts(blog, offset, results)
+
+    def check_posts(self, blog, offset, results):
+        """
+        Checks the parsed response to a request for posts, logging what was retrieved.
+
+        :param blog: the URL of the blog the posts were requested from
+        :param offset: the offset the posts were requested from
+        :param results: the parsed response, as returned by get()
+        :return: a dict of the posts, an empty page if the blog's posts can't be retrieved at all (see blog_gone()),
+            or None if the request failed and may be retried
+        """
         if results is None:  # HTTP error from get()
-            print 'Failed to get posts: catastrophic HTTP error'
+            logger.warning('Failed to get posts: catastrophic HTTP error')
             return None
         elif 'meta' in results:  # application-level error from tumblr
-            print 'Failed to get posts: %s' % results['response']['error']
+            if results['meta']['status'] in GONE_CODES:
+                return self.blog_gone(blog, results['meta']['status'])
+            logger.warning('Failed to get posts: %s', results['response']['error'])
             return None
         else:
-            print 'Retrieved posts %i to %i out of %i (%s)' % (offset, offset+len(results['posts'])-1,
-                                                               results['total_posts'], blog)
+            logger.info('Retrieved posts %i to %i out of %i (%s)', offset, offset+len(results['posts'])-1,
+                        results['total_posts'], blog)
             return results
 
+    def blog_gone(self, blog, status):
+        """
+        Gives up on a blog whose posts can't be retrieved at all, eg because it doesn't exist or is private.
+
+        :param blog: the URL of the blog
+        :param status: the HTTP status the request for posts failed with, one of GONE_CODES
+        :return: an empty page, to stop the crawl as if it had reached the end of the blog
+        """
+        if blog not in self.gone_blogs:  # pages already in flight will fail the same way
+            self.gone_blogs.add(blog)
+            logger.error('Giving up on %s: its posts could not be retrieved (HTTP status %i)', blog, status)
+        return {'posts': [], 'total_posts': 0}
+
+    def retry_page(self, blog, offset, attempt):
+        """
+        Waits out the backoff before a failed request for posts is made again.
+
+        :param blog: the URL of the blog the posts were requested from
+        :param offset: the offset the posts were requested from
+        :param attempt: how many times the page has been requested already
+        :return: None
+        :raises IOError: if the page has already been requested MAX_RETRIES times
+        """
+        if attempt >= MAX_RETRIES:
+            raise IOError('Failed to get posts %i onwards from %s after %i attempts' % (offset, blog, attempt))
+        time.sleep(backoff(attempt - 1))
+
     def process_post(self, post):
         """
         Extracts the relevant data from a post and stores it in the database.
 
+        Post must be a dict as returned by TumblrRequester.get_posts(). See prepare_post() for the extraction.
+
+        :param post: the post to process
+        :return: None
+        """
+        self.db.insert_post(self.prepare_post(post))
+
+    def prepare_post(self, post):
+        """
+        Extracts the relevant data from a post, ready to be stored with DBAdapter.insert_posts().
+
         Post must be a dict as returned by TumblrRequester.get_posts().
 
-        Posts may contain a variety of type-specific data. For unified handling this data is dumped to JSON and stored in the 'aux' field of the post.
+        Posts may contain a variety of type-specific data. For unified handling this data is collected into a dict in the 'aux' field of the post, which DBAdapter stores compressed (see db.encode_aux()).
 
         Tags are merged from an array into a comma (',') delimited string. (Commas are not allowed in tags, so individual tags can be recovered later.)
 
         :param post: the post to process
-        :return: None
+        :return: the post, with the extracted fields added
         """
 
-        print 'Processing %s post %i' % (post['type'], post['id'])
+        logger.debug('Processing %s post %i', post['type'], post['id'])
 
         post['tags'] = ','.join(post['tags'])
         post['source_url'] = None if 'source_url' not in post else post['source_url']
         post['source_title'] = None if 'source_title' not in post else post['source_title']
 
         if post['type'] == 'text':
-            post['aux'] = json.dumps({'title': post['title'], 'body': self.threadpool.replace_urls(post['body'])})
+            post['aux'] = {'title': post['title'], 'body': self.threadpool.replace_urls(post['body'])}
         elif post['type'] == 'quote':
-            post['aux'] = json.dumps({'text': self.threadpool.replace_urls(post['text']), 'source': post['source']})
+            post['aux'] = {'text': self.threadpool.replace_urls(post['text']), 'source': post['source']}
         elif post['type'] == 'link':
             for photo in post['photos']:
                 # unlike in photo posts, in link posts photos give their biggest available size in original_size
                 # consistency!
-                self.threadpool.insert(photo['original_size']['url'])
                 photo['bv'] = {'url': self.threadpool.rewrite_and_download_url(photo['original_size']['url']),
                                'width': photo['original_size']['width'], 'height': photo['original_size']['height']}
-            post['aux'] = json.dumps(
-                {'title': post['title'], 'url': post['url'], 'author': post['link_author'], 'excerpt': post['excerpt'],
-                 'publisher': post['publisher'], 'photos': post['photos'],
-                 'description': self.threadpool.replace_urls(post['description'])})
+            post['aux'] = {'title': post['title'], 'url': post['url'], 'author': post['link_author'],
+                           'excerpt': post['excerpt'], 'publisher': post['publisher'], 'photos': post['photos'],
+                           'description': self.threadpool.replace_urls(post['description'])}
         elif post['type'] == 'answer':
-            post['aux'] = json.dumps(
-                {'asking_name': post['asking_name'], 'asking_url': post['asking_url'], 'question': post['question'],
-                 'answer': self.threadpool.replace_urls(post['answer'])})
+            post['aux'] = {'asking_name': post['asking_name'], 'asking_url': post['asking_url'],
+                           'question': post['question'], 'answer': self.threadpool.replace_urls(post['answer'])}
         elif post['type'] == 'video':
-            post['aux'] = json.dumps({'caption': self.threadpool.replace_urls(post['caption']),
-                                      'player': post['player']})
+            post['aux'] = {'caption': self.threadpool.replace_urls(post['caption']), 'player': post['player']}
         elif post['type'] == 'audio':
-            post['aux'] = json.dumps({'caption': self.threadpool.replace_urls(post['caption']),
-                                      'player': post['player'], 'plays': post['plays']})
+            post['aux'] = {'caption': self.threadpool.replace_urls(post['caption']), 'player': post['player'],
+                           'plays': post['plays']}
         elif post['type'] == 'chat':
-            post['aux'] = json.dumps({'title': post['title'], 'dialogue': post['dialogue']})
+            post['aux'] = {'title': post['title'], 'dialogue': post['dialogue']}
         elif post['type'] == 'photo':
             for photo in post['photos']:
                 max_width = 0
@@ -175,51 +334,368 @@ class TumblrRequester(object):
                         url = alt['url']
                         max_width = alt['width']
                         max_height = alt['height']
-                self.threadpool.insert(url)
                 photo['bv'] = {'url': self.threadpool.rewrite_and_download_url(url), 'width': max_width,
                                'height': max_height}
-            post['aux'] = json.dumps({'photos': post['photos'],
-                                      'caption': self.threadpool.replace_urls(post['caption'])})
+            post['aux'] = {'photos': post['photos'], 'caption': self.threadpool.replace_urls(post['caption'])}
+
+        return post
+
+    def new_posts(self, page, limit=None):
+        """
+        Generates the posts in a page that are not yet in the database, prepared for storage.
+
+        :param page: a page of posts as returned by get_posts()
+        :param limit: the most posts to generate; if `None`, unlimited
+        :return: each new post, as returned by prepare_post()
+        """
+        posts_generated = 0
+        for post in page['posts']:
+            if posts_generated == limit:
+                return
+            # tumblr, because tumblr, doesn't do stable pagination
+            # ie, since we get posts in blocks of 20 at fixed offsets from the most *recent* post
+            #  if a post is made while we're walking through the blog, the next block will contain a post
+            #  that was in the previous block, and if we put that in the database we'd violate the
+            #  uniqueness constraint on post ids
+            # thus, we check for duplication before we insert the post into the db
+            if self.db.post_id_exists(post['id']):
+                continue
+            with POST_PROCESS_SECONDS.time():
+                post = self.prepare_post(post)
+            POSTS_PROCESSED.inc()
+            yield post
+            posts_generated += 1
+
+    def reached_archive(self, page, newest_post_time):
+        """
+        Checks whether a page has reached posts that were archived by a previous run.
 
-        self.db.insert_post(post)
+        Since posts come newest first, once a page holds a post that is already in the database and no newer than
+        the newest archived post, every later page is already archived too. Pinned posts are ignored, since they
+        are shown at the top of the blog regardless of age.
 
-    def get_blog(self, blog, limit=None):
+        :param page: a page of posts as returned by get_posts()
+        :param newest_post_time: the timestamp of the newest archived post, or None if nothing is archived
+        :return: whether the page overlaps the archive
+        """
+        if newest_post_time is None:
+            return False
+        for post in page['posts']:
+            if post.get('is_pinned'):
+                continue
+            if post['timestamp'] <= newest_post_time and self.db.post_id_exists(post['id']):
+                return True
+        return False
+
+    def get_pages(self, blog, offset=0):
+        """
+        Generates pages of posts from the indicated blog, one request at a time.
+
+        Failed requests are retried at the same offset after a backoff; see retry_page(). Generation stops when a
+        page comes back empty.
+
+        :param blog: the URL of the blog to get posts for
+        :param offset: which post to start at
+        :return: each page as returned by get_posts()
+        """
+        attempt = 0
+        while True:
+            posts = self.get_posts(blog, offset=offset)
+            attempt += 1
+            if posts is None:
+                self.retry_page(blog, offset, attempt)
+                continue
+            if len(posts['posts']) == 0:  # we've run off the end of the blog
+                return
+            yield posts
+            offset += API_POST_LIMIT
+            attempt = 0
+
+    def get_pages_pipelined(self, blog, workers, offset=0):
+        """
+        Generates pages of posts from the indicated blog, keeping several requests in flight at once.
+
+        Offsets are handed to a pool of fetcher threads up to workers * PIPELINE_DEPTH pages ahead of the page
+        currently being consumed, but pages are always yielded in offset order, so callers see exactly what
+        get_pages() would have produced. Pages that fail to download are retried at the same offset, as in
+        get_pages().
+
+        The fetcher threads are shut down when the generator is exhausted or closed.
+
+        :param blog: the URL of the blog to get posts for
+        :param workers: how many fetcher threads to run
+        :param offset: which post to start at
+        :return: each page as returned by get_posts()
+        """
+        requests = Queue.Queue()
+        in_flight = collections.deque()
+
+        def fetch_pages():
+            while True:
+                request = requests.get()
+                if request is None:
+                    return
+                request_offset, result = request
+                result.put(self.get_posts(blog, offset=request_offset))
+
+        def submit(request_offset):
+            result = Queue.Queue(maxsize=1)
+            in_flight.append((request_offset, result))
+            requests.put((request_offset, result))
+
+        threads = [threading.Thread(target=fetch_pages) for _ in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            next_offset = offset
+            for _ in xrange(workers * PIPELINE_DEPTH):
+                submit(next_offset)
+                next_offset += API_POST_LIMIT
+            while True:
+                page_offset, result = in_flight.popleft()
+                posts = result.get()
+                attempt = 1
+                while posts is None:
+                    self.retry_page(blog, page_offset, attempt)
+                    posts = self.get_posts(blog, offset=page_offset)
+                    attempt += 1
+                if len(posts['posts']) == 0:  # we've run off the end of the blog
+                    return
+                submit(next_offset)
+                next_offset += API_POST_LIMIT
+                yield posts
+        finally:
+            # drop anything not yet picked up, then tell each fetcher to stop
+            # fetchers still mid-request will finish into result queues nobody reads, which is harmless
+            try:
+                while True:
+                    requests.get_nowait()
+            except Queue.Empty:
+                pass
+            for _ in threads:
+                requests.put(None)
+
+    def start_crawl(self, blog, incremental=False):
+        """
+        Works out where a crawl of a blog should start, storing the blog's metadata.
+
+        If an earlier crawl of the blog was interrupted or stopped by its limit, the crawl resumes from its
+        checkpoint, one page early in case posts have been deleted in the meantime and shifted later posts back. A
+        resumed crawl never reaches posts published since the crawl it resumes started, so when it completes it
+        records no update time, and the next incremental run checks the blog again. Image downloads left pending by
+        an interrupted crawl are queued again, the first time any crawl is started.
+
+        :param blog: the URL of the blog
+        :param incremental: whether the crawl is incremental; see get_blog()
+        :return: a tuple of the offset to start from, the number of posts already processed and the newest post
+            time to stop at in incremental mode, or None if there is nothing to retrieve
+        """
+        last_update = self.db.get_last_update(blog)
+        checkpoint = self.db.get_checkpoint(blog)
+        metadata = self.get_metadata(blog)
+
+        if not self.images_resumed:
+            for url, fallback_url in self.db.get_pending_images():
+                self.threadpool.insert_with_fallback(url, fallback_url)
+            self.images_resumed = True
+
+        self.crawl_updates.pop(blog, None)
+        if checkpoint is not None:
+            offset, posts_processed, newest_post_time = checkpoint
+            logger.info('Resuming crawl of %s at offset %i with %i posts processed', blog, offset, posts_processed)
+            return max(0, offset - API_POST_LIMIT), posts_processed, newest_post_time
+
+        if incremental and metadata is not None and last_update is not None \
+                and metadata['blog']['updated'] <= last_update:
+            logger.info('%s has not been updated since it was last retrieved', blog)
+            return None
+        if metadata is not None:
+            self.crawl_updates[blog] = metadata['blog']['updated']
+        return 0, 0, self.db.get_newest_post_time(blog)
+
+    def finish_crawl(self, blog):
+        """
+        Marks a crawl of a blog as complete: its checkpoint is cleared and, unless it was resumed, the blog's update
+        time from when it started is recorded, both in the same transaction.
+
+        :param blog: the URL of the blog
+        :return: None
+        """
+        self.db.clear_checkpoint(blog)
+        last_update = self.crawl_updates.pop(blog, None)
+        if last_update is not None:
+            self.db.set_last_update(blog, last_update)
+
+    def process_page(self, blog, page, offset, posts_processed, newest_post_time, limit=None, incremental=False):
+        """
+        Stores the new posts in a page of a blog's crawl, checkpointing the crawl, and works out whether the crawl is
+        done. A crawl that runs off the end of the blog or catches up with the archive is complete (see
+        finish_crawl()); one stopped by `limit` keeps its checkpoint, so a later run can carry on from there.
+
+        Every crawler processes its pages with this, one at a time in offset order, so duplicate detection, `limit`,
+        incremental mode and checkpointing behave the same whichever crawler is used.
+
+        :param blog: the URL of the blog
+        :param page: the page, as returned by get_posts()
+        :param offset: the offset the page was requested from
+        :param posts_processed: the number of posts the crawl had processed before the page
+        :param newest_post_time: the newest post time the crawl is stopping at in incremental mode
+        :param limit: how many posts the crawl should download; if `None`, unlimited
+        :param incremental: whether to stop at posts archived by a previous run; see get_blog()
+        :return: a tuple of the number of posts processed including the page's and whether the crawl is complete
+        """
+        if len(page['posts']) == 0:  # we've run off the end of the blog
+            self.finish_crawl(blog)
+            return posts_processed, True
+        caught_up = incremental and self.reached_archive(page, newest_post_time)
+        remaining = limit - posts_processed if limit is not None else None
+        posts = list(self.new_posts(page, remaining))
+        self.db.insert_posts(posts, blog)
+        posts_processed += len(posts)
+        self.save_progress(blog, offset + API_POST_LIMIT, posts_processed, newest_post_time)
+        if posts_processed == limit:
+            return posts_processed, True
+        if caught_up:
+            logger.info('Reached previously retrieved posts from %s', blog)
+            self.finish_crawl(blog)
+            return posts_processed, True
+        return posts_processed, False
+
+    def save_progress(self, blog, offset, posts_processed, newest_post_time):
+        """
+        Records a crawl's progress, so that it can be resumed if it is interrupted.
+
+        :param blog: the URL of the blog
+        :param offset: the offset of the next page to retrieve
+        :param posts_processed: the number of posts processed so far
+        :param newest_post_time: the newest post time the crawl is stopping at
+        :return: None
+        """
+        self.save_image_progress()
+        self.db.save_checkpoint(blog, offset, posts_processed, newest_post_time)
+
+    def save_image_progress(self):
+        """
+        Records downloaded images, the image URLs still pending and the download attempts made.
+
+        :return: None
+        """
+        self.db.insert_image_hashes(self.threadpool.store.pop_new_hashes())
+        added, finished = self.threadpool.pop_pending_changes()
+        self.db.update_pending_images(added, finished)
+        self.db.update_download_ledger(added, self.threadpool.pop_attempts(), self.threadpool.pop_skipped())
+
+    def get_blog(self, blog, limit=None, workers=1, incremental=False):
         """
         Retrieves posts from a blog and stores them in the database.
 
         Posts are retrieved starting from offset 0, the most recent post in the blog.
 
+        In incremental mode nothing is retrieved if the blog has not been updated since the last complete crawl, and
+        paging stops at the first page that reaches already-archived posts (see reached_archive()). This assumes
+        earlier runs archived everything older than their newest post, which holds since a limited run keeps its
+        checkpoint and the next run resumes it first.
+
+        With more than one worker, pages are fetched concurrently by get_pages_pipelined() while posts are still
+        processed one at a time in blog order, so duplicate detection and `limit` behave exactly as in a serial
+        crawl. Each page's new posts are handed to the database together; see DBAdapter.insert_posts().
+
+        Progress is checkpointed after every page. If the crawl is interrupted, stopped by `limit`, or a page still
+        fails after MAX_RETRIES attempts, running it again resumes where it stopped (see start_crawl()), with
+        `limit` counting the posts from both runs.
+
         :param blog: the URL of the blog to retreive posts from
         :param limit: how many posts to download; if `None`, unlimited
+        :param workers: how many pages to fetch concurrently
+        :param incremental: whether to stop at posts archived by a previous run
         :return: None
+        :raises IOError: if a page still fails after MAX_RETRIES attempts
         """
-        self.get_metadata(blog)
+        start = self.start_crawl(blog, incremental)
+        if start is None:
+            self.threadpool.block_on_queue()
+            self.save_image_progress()
+            return
+        offset, posts_processed, newest_post_time = start
 
-        print 'Retrieving %s posts from %s' % (str(limit) if limit is not None else 'unlimited', blog)
+        logger.info('Retrieving %s posts from %s', str(limit) if limit is not None else 'unlimited', blog)
 
-        posts_processed = 0
-        offset = 0
-        done = False
+        if workers > 1:
+            pages = self.get_pages_pipelined(blog, workers, offset=offset)
+        else:
+            pages = self.get_pages(blog, offset=offset)
 
-        while not done:
-            posts = self.get_posts(blog, offset=offset)
-            if posts is not None:
-                if len(posts) == 0:  # we've run off the end of the blog
-                    break
-                for post in posts['posts']:
-                    # tumblr, because tumblr, doesn't do stable pagination
-                    # ie, since we get posts in blocks of 20 at fixed offsets from the most *recent* post
-                    #  if a post is made while we're walking through the blog, the next block will contain a post
-                    #  that was in the previous block, and if we put that in the database we'd violate the
-                    #  uniqueness constraint on post ids
-                    # thus, we do a SQL query to check for duplication before we insert the post into the db
-                    if self.db.post_id_exists(post['id']):
-                        continue
-                    self.process_post(post)
-                    posts_processed += 1
-                    if posts_processed == limit:
-                        done = True
-                        break
+        try:
+            for page in pages:
+                posts_processed, done = self.process_page(blog, page, offset, posts_processed, newest_post_time,
+                                                          limit, incremental)
                 offset += API_POST_LIMIT
+                if done:
+                    break
+            else:  # the pages ran out at the end of the blog
+                self.finish_crawl(blog)
+        finally:
+            pages.close()
+
+        self.threadpool.block_on_queue()
+        self.save_image_progress()
+
+        logger.info('Successfully retreived %i posts from %s', posts_processed, blog)
+
+    def retry_images(self):
+        """
+        Queues every image that has never been stored again, without crawling any posts, and waits for them to
+        download.
+
+        This covers images given up on by earlier runs as well as any still pending; see
+        DBAdapter.get_undownloaded_images(). Each attempt is recorded in the download ledger.
+
+        :return: None
+        """
+        urls = self.db.get_undownloaded_images()
+        logger.info('Retrying %i images', len(urls))
+        for url, fallback_url in urls:
+            self.threadpool.insert_with_fallback(url, fallback_url)
+        self.threadpool.block_on_queue()
+        self.save_image_progress()
+        self.db.flush()
+        logger.info('Image downloads: %s', ', '.join('%i %s' % (count, status) for status, count
+                                                    in sorted(self.db.get_download_counts().iteritems())))
+
+    def replay(self, blog):
+        """
+        Rebuilds a blog's posts from its archived API responses, without making any requests.
+
+        Every archived page is processed again with prepare_post() and its posts replace the stored ones, so changes
+        to post processing can be applied to the whole archive. Where a post was archived more than once, the most
+        recently fetched copy wins. Posts that were never archived are left as they are.
 
-        print 'Successfully retreived %i posts from %s' % (posts_processed, blog)
+        Image URLs are rewritten and handed to the requester's ImageSink as usual; use a PendingImageSink to stay
+        offline and leave the downloads to the next crawl.
+
+        :param blog: the URL of the blog
+        :return: None
+        """
+        logger.info('Rebuilding posts of %s from archived responses', blog)
+        replayed = PostIdSet()
+        unflushed = 0
+        for offset, content in self.db.get_archived_pages(blog):
+            posts = []
+            for post in self.json_parse(content)['posts']:
+                if post['id'] in replayed:
+                    continue
+                replayed.add(post['id'])
+                with POST_PROCESS_SECONDS.time():
+                    posts.append(self.prepare_post(post))
+            self.db.replace_posts(posts, blog)
+            POSTS_REPLAYED.inc(len(posts))
+            unflushed += len(posts)
+            if unflushed >= self.db.batch_size:
+                self.save_image_progress()
+                self.db.flush()
+                unflushed = 0
+        self.save_image_progress()
+        self.db.flush()
+        logger.info('Rebuilt %i posts of %s', len(replayed), blog)
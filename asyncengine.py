@@ -0,0 +1,494 @@
+import asyncore
+import collections
+import heapq
+import logging
+import socket
+import ssl
+import sys
+import time
+import urlparse
+import zlib
+
+from api import (TumblrRequester, API_URL, API_POST_LIMIT, API_ERRORS, API_REQUESTS, API_REQUEST_SECONDS,
+                 API_RESPONSE_BYTES, GONE_CODES)
+from db import DOWNLOAD_DONE, DOWNLOAD_FAILED, DOWNLOAD_RETRYING
+from httppool import MAX_REDIRECTS, REDIRECT_CODES, TIMEOUT
+from imagestore import ImageStore, response_validator
+from scheduler import MAX_RETRIES, RETRY_CODES, IMAGE_RETRIES, backoff
+from threadpool import ImageSink, FALLBACK_CODES, IMAGE_DOWNLOAD_SECONDS, IMAGE_FAILURES, IMAGE_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 200  # requests in flight at once, API and images together
+API_WINDOW = 4  # pages of posts requested ahead of the page being processed
+READ_SIZE = 65536
+LOOP_TIMEOUT = 0.5  # seconds to wait for socket activity before checking timers and timeouts
+PROGRESS_INTERVAL = 5.0  # seconds between saves of image download progress while images are downloading
+
+
+class AsyncRequest(asyncore.dispatcher):
+    """
+    A single HTTP or HTTPS GET driven by an asyncore event loop
+
+    Requests are made with HTTP/1.0, so the body is simply everything up to the server closing the connection.
+    Body data is passed to on_data as it arrives, decompressed if it was gzip-encoded, and on_done is called exactly
+    once at the end with None or the exception that ended the request.
+    """
+
+    def __init__(self, url, headers, on_data, on_done, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        parsed = urlparse.urlsplit(url)
+        self.url = url
+        self.hostname = parsed.hostname
+        self.https = parsed.scheme == 'https'
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        lines = ['GET %s HTTP/1.0' % path, 'Host: %s' % parsed.netloc]
+        lines.extend('%s: %s' % header for header in headers.iteritems())
+        self.outbuf = '\r\n'.join(lines) + '\r\n\r\n'
+
+        self.on_data = on_data
+        self.on_done = on_done
+        self.status = None
+        self.headers = {}
+        self.header_buffer = ''
+        self.body_length = 0
+        self.decompressor = None
+        self.handshaking = False
+        self.handshake_wants_write = False
+        self.done = False
+        self.last_activity = time.time()
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((self.hostname, parsed.port or (443 if self.https else 80)))
+        except socket.error:
+            self.close()
+            raise
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def writable(self):
+        if self.handshaking:
+            return self.handshake_wants_write
+        return not self.connected or bool(self.outbuf)
+
+    def handle_connect(self):
+        if self.https:
+            context = ssl.create_default_context()
+            wrapped = context.wrap_socket(self.socket, server_hostname=self.hostname, do_handshake_on_connect=False)
+            self.del_channel()
+            self.set_socket(wrapped)
+            self.handshaking = True
+            self.handshake()
+
+    def handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_wants_write = False
+        except ssl.SSLWantWriteError:
+            self.handshake_wants_write = True
+        else:
+            self.handshaking = False
+
+    def handle_write(self):
+        self.last_activity = time.time()
+        if self.handshaking:
+            self.handshake()
+            return
+        try:
+            sent = self.send(self.outbuf)
+        except ssl.SSLWantWriteError:
+            return
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        self.last_activity = time.time()
+        if self.handshaking:
+            self.handshake()
+            return
+        while not self.done:
+            try:
+                data = self.recv(READ_SIZE)
+            except ssl.SSLWantReadError:
+                return
+            except ssl.SSLError:
+                # plenty of servers close the connection without a TLS close_notify; once the response has started
+                # treat that as the end of the body, which handle_close() checks against Content-Length
+                if self.status is None:
+                    raise
+                self.handle_close()
+                return
+            if not data:  # recv() has already closed the connection
+                return
+            self.receive(data)
+            # data already decrypted by the SSL layer doesn't show up as readable on the socket
+            if not (self.https and self.socket.pending()):
+                return
+
+    def receive(self, data):
+        """
+        Handles data read from the connection, parsing headers and passing body data on.
+
+        :param data: the data read
+        :return: None
+        """
+        if self.status is None:
+            self.header_buffer += data
+            if '\r\n\r\n' not in self.header_buffer:
+                return
+            head, data = self.header_buffer.split('\r\n\r\n', 1)
+            self.header_buffer = ''
+            lines = head.split('\r\n')
+            self.status = int(lines[0].split()[1])
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                self.headers[name.strip().lower()] = value.strip()
+            if self.getheader('content-encoding', '').lower() == 'gzip':
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.body_length += len(data)
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        if data:
+            self.on_data(self, data)
+
+    def handle_close(self):
+        self.close()
+        if self.status is None:
+            self.finish(socket.error('Connection closed before a response was received from %s' % self.url))
+            return
+        expected_length = self.getheader('content-length')
+        if expected_length is not None and int(expected_length) != self.body_length:
+            self.finish(socket.error('Truncated response from %s' % self.url))
+            return
+        if self.decompressor is not None:
+            data = self.decompressor.flush()
+            if data:
+                self.on_data(self, data)
+        self.finish(None)
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self.finish(error)
+
+    def fail(self, error):
+        """
+        Abandons the request.
+
+        :param error: the exception to report to on_done
+        :return: None
+        """
+        self.close()
+        self.finish(error)
+
+    def finish(self, error):
+        if not self.done:
+            self.done = True
+            self.on_done(self, error)
+
+
+class AsyncImageSink(ImageSink):
+    """
+    Collects image URLs for the AsyncCrawler to download, skipping any that are already stored or queued
+    """
+
+    def __init__(self, store):
+        ImageSink.__init__(self, store)
+        self.queue = collections.deque()
+        self.seen = set()
+
+    def insert(self, url):
+        if url in self.seen:
+            return
+        if self.store.is_stored(url):  # eg a pending image from an earlier run that was stored after all
+            self.already_stored(url)
+            self.finished(url)
+            return
+        self.seen.add(url)
+        self.track(url)
+        self.queue.append((url, 0))
+
+
+class AsyncCrawler(object):
+    """
+    Crawls a blog and downloads its images from a single asyncore event loop
+
+    This is an alternative to TumblrRequester.get_blog() and the ThreadPool that scales to far more concurrent
+    downloads than there could be threads. Pages of posts are requested up to API_WINDOW ahead and processed strictly
+    in order with TumblrRequester.process_page(), so duplicate detection, `limit` and incremental mode behave
+    exactly as in get_blog(). At most `concurrency` requests are in flight at once; requests for posts take priority
+    over image downloads. Failed requests are retried with the same backoff the ThreadPool's scheduler uses, up to
+    MAX_RETRIES times.
+
+    Host names are resolved synchronously when a connection is opened.
+    """
+
+    def __init__(self, db, host=API_URL, concurrency=DEFAULT_CONCURRENCY, api_window=API_WINDOW, archive=False):
+        self.db = db
+        self.concurrency = concurrency
+        self.api_window = api_window
+        self.sink = AsyncImageSink(ImageStore(db.get_image_hashes()))
+        self.requester = TumblrRequester(db, host=host, threadpool=self.sink, archive=archive)
+        self.socket_map = {}
+        self.waiting = collections.deque()  # requests waiting for a free slot, as (url, headers, on_data, on_done)
+        self.timers = []  # heap of (due time, sequence number, callback)
+        self.timer_sequence = 0
+        self.progress_saved = time.time()
+
+    def run(self, blog, limit=None, incremental=False):
+        """
+        Retrieves posts from a blog and stores them in the database, downloading their images.
+
+        :param blog: the URL of the blog to retrieve posts from
+        :param limit: how many posts to download; if `None`, unlimited
+        :param incremental: whether to stop at posts archived by a previous run; see TumblrRequester.get_blog()
+        :return: None
+        """
+        self.blog = blog
+        self.limit = limit
+        self.incremental = incremental
+        self.pages = {}  # offset -> page, for pages that arrived ahead of the one being processed
+        self.gave_up = False
+
+        start = self.requester.start_crawl(blog, incremental)
+        if start is None:
+            self.paging_done = True
+        else:
+            self.paging_done = False
+            self.next_offset, self.posts_processed, self.newest_post_time = start
+            self.requested_offset = self.next_offset  # the offset of the next page to request
+            logger.info('Retrieving %s posts from %s with up to %i requests in flight',
+                        str(limit) if limit is not None else 'unlimited', blog, self.concurrency)
+            for _ in xrange(self.api_window):
+                self.request_page()
+
+        while self.socket_map or self.waiting or self.timers or self.sink.queue:
+            self.run_timers()
+            self.start_downloads()
+            if self.socket_map:
+                asyncore.loop(timeout=LOOP_TIMEOUT, use_poll=True, map=self.socket_map, count=1)
+                self.check_timeouts()
+            elif self.timers:
+                time.sleep(max(0, min(LOOP_TIMEOUT, self.timers[0][0] - time.time())))
+
+        self.requester.save_image_progress()
+        if start is not None and not self.gave_up:
+            logger.info('Successfully retreived %i posts from %s', self.posts_processed, blog)
+
+    def start(self, url, headers, on_data, on_done, priority=False):
+        """
+        Starts a request, or queues it until there is a free slot.
+
+        :param url: the URL to request
+        :param headers: a dict of headers to send
+        :param on_data: called with the request and each piece of body data
+        :param on_done: called with the request and None or the exception that ended it
+        :param priority: whether to jump ahead of other waiting requests
+        :return: None
+        """
+        request = (url, headers, on_data, on_done)
+        if len(self.socket_map) < self.concurrency:
+            self.open(request)
+        elif priority:
+            self.waiting.appendleft(request)
+        else:
+            self.waiting.append(request)
+
+    def open(self, request):
+        url, headers, on_data, on_done = request
+
+        def done(connection, error):
+            on_done(connection, error)
+            while self.waiting and len(self.socket_map) < self.concurrency:
+                self.open(self.waiting.popleft())
+        try:
+            AsyncRequest(url, headers, on_data, done, self.socket_map)
+        except socket.error as e:  # eg the host name could not be resolved
+            self.after(0, lambda: on_done(None, e))
+
+    def after(self, delay, callback):
+        heapq.heappush(self.timers, (time.time() + delay, self.timer_sequence, callback))
+        self.timer_sequence += 1
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+
+    def check_timeouts(self):
+        now = time.time()
+        for connection in self.socket_map.values():
+            if now - connection.last_activity > TIMEOUT:
+                connection.fail(socket.timeout('Timed out fetching %s' % connection.url))
+
+    def request_page(self, offset=None, attempt=0):
+        """
+        Requests a page of posts.
+
+        :param offset: the offset to request; if `None`, the next offset not yet requested
+        :param attempt: how many times this page has been requested already
+        :return: None
+        """
+        if self.paging_done:
+            return
+        if offset is None:
+            offset = self.requested_offset
+            self.requested_offset += API_POST_LIMIT
+        url = self.requester.api_url('blog/%s/posts' % self.blog, {'offset': offset, 'limit': API_POST_LIMIT})
+        body = []
+        start = time.time()
+        API_REQUESTS.inc()
+
+        def on_data(connection, data):
+            body.append(data)
+            API_RESPONSE_BYTES.inc(len(data))
+
+        def on_done(connection, error):
+            API_REQUEST_SECONDS.observe(time.time() - start)
+            if self.paging_done:
+                return
+            results = None
+            if error is not None:
+                logger.warning('Failed to retrieve %s with error %s', url, str(error))
+                API_ERRORS.inc()
+            elif connection.getcode() not in [200, 201, 301]:
+                logger.warning('Failed to retrieve %s with error code %i', url, connection.getcode())
+                API_ERRORS.inc()
+                if connection.getcode() in GONE_CODES:
+                    results = self.requester.blog_gone(self.blog, connection.getcode())
+            else:
+                content = ''.join(body)
+                results = self.requester.check_posts(self.blog, offset, self.requester.json_parse(content))
+                if results is not None:
+                    self.requester.archive_page(self.blog, offset, content)
+            if results is None:
+                if attempt + 1 >= MAX_RETRIES:
+                    logger.error('Giving up on %s: posts %i onwards failed %i times', self.blog, offset, attempt + 1)
+                    self.gave_up = True  # the checkpoint is kept, so the next run resumes here
+                    self.paging_done = True
+                    self.pages.clear()
+                    return
+                self.after(backoff(attempt), lambda: self.request_page(offset, attempt + 1))
+                return
+            self.pages[offset] = results
+            self.process_pages()
+
+        self.start(url, self.requester.headers, on_data, on_done, priority=True)
+
+    def process_pages(self):
+        """
+        Processes every page that is ready, in order, requesting further pages to keep the window full.
+
+        :return: None
+        """
+        while not self.paging_done and self.next_offset in self.pages:
+            page = self.pages.pop(self.next_offset)
+            self.posts_processed, self.paging_done = self.requester.process_page(
+                self.blog, page, self.next_offset, self.posts_processed, self.newest_post_time, self.limit,
+                self.incremental)
+            self.next_offset += API_POST_LIMIT
+            if not self.paging_done:
+                self.request_page()
+        if self.paging_done:
+            self.pages.clear()
+
+    def start_downloads(self):
+        """
+        Starts waiting requests, then downloads for queued images, while there are free slots.
+
+        Image download progress is saved at most every PROGRESS_INTERVAL seconds, rather than on every pass of the
+        event loop; processing a page of posts saves it too.
+
+        :return: None
+        """
+        while self.waiting and len(self.socket_map) < self.concurrency:
+            self.open(self.waiting.popleft())
+        while self.sink.queue and len(self.socket_map) < self.concurrency and not self.waiting:
+            url, attempt = self.sink.queue.popleft()
+            self.download(url, attempt)
+        IMAGE_QUEUE_DEPTH.set(len(self.sink.queue))
+        if time.time() - self.progress_saved >= PROGRESS_INTERVAL:
+            self.requester.save_image_progress()
+            self.db.flush()
+            self.progress_saved = time.time()
+
+    def download(self, url, attempt, redirects=0, source_url=None, writer=None, resume=True):
+        """
+        Downloads an image into the store, resuming any partial download with a Range request. An upgraded image URL
+        that fails with one of FALLBACK_CODES is downloaded from its fallback instead; see ImageSink.fallback_url().
+
+        :param url: the URL to download from
+        :param attempt: how many times this image has been tried already
+        :param redirects: how many redirects have been followed to reach url
+        :param source_url: the URL the image was queued as, if url is a redirect or fallback target
+        :param writer: the ImageWriter claimed for source_url, if url is a redirect or fallback target
+        :param resume: whether to ask for just the rest of any partial download; not for a fallback target, which is
+            a different resource from the one the partial data came from
+        :return: None
+        """
+        source_url = source_url or url
+        if writer is None:
+            writer = self.sink.store.open_writer(source_url)
+            if writer is None:  # already being downloaded by another request; that one will finish it
+                return
+        started = []
+        start = time.time()
+
+        def on_data(connection, data):
+            if connection.getcode() in [200, 201, 206]:
+                if not started:
+                    writer.start(resumed=connection.getcode() == 206, validator=response_validator(connection))
+                    started.append(True)
+                writer.write(data)
+
+        def on_done(connection, error):
+            status = connection.getcode() if connection is not None else None
+            if error is None and status in [200, 201, 206]:
+                if not started:  # an empty image
+                    writer.start(resumed=status == 206, validator=response_validator(connection))
+                writer.commit()
+                self.sink.finished(source_url)
+                IMAGE_DOWNLOAD_SECONDS.observe(time.time() - start)
+                self.sink.attempted(source_url, DOWNLOAD_DONE, size=writer.size, seconds=time.time() - start)
+                return
+            if error is None and status in REDIRECT_CODES and connection.getheader('location') \
+                    and redirects < MAX_REDIRECTS:
+                self.download(urlparse.urljoin(url, connection.getheader('location')), attempt, redirects + 1,
+                              source_url, writer, resume)
+                return
+            fallback_url = self.sink.fallback_url(source_url)
+            if error is None and status in FALLBACK_CODES and fallback_url not in (None, url):
+                logger.info('Failed to retrieve %s with HTTP status %i; falling back to %s', url, status, fallback_url)
+                self.download(fallback_url, attempt, redirects, source_url, writer, resume=False)
+                return
+            reason = error if error is not None else 'HTTP status %i' % status
+            if status == 416 and attempt + 1 < MAX_RETRIES:  # the partial download no longer matches; start again
+                writer.abort()
+                self.sink.queue.append((source_url, attempt + 1))
+                IMAGE_RETRIES.inc()
+                outcome = DOWNLOAD_RETRYING
+            elif (error is not None or status in RETRY_CODES) and attempt + 1 < MAX_RETRIES:
+                writer.close()
+                logger.info('Retrying %s after %s', source_url, reason)
+                IMAGE_RETRIES.inc()
+                self.after(backoff(attempt), lambda: self.sink.queue.append((source_url, attempt + 1)))
+                outcome = DOWNLOAD_RETRYING
+            else:
+                writer.abort()
+                self.sink.finished(source_url)
+                logger.warning('Failed to retrieve %s: %s', source_url, reason)
+                IMAGE_FAILURES.inc()
+                outcome = DOWNLOAD_FAILED
+            self.sink.attempted(source_url, outcome, error=str(reason), seconds=time.time() - start)
+
+        headers = {'User-Agent': self.requester.headers['User-Agent']}
+        if resume:
+            headers.update(writer.range_headers())
+        self.start(url, headers, on_data, on_done)
@@ -0,0 +1,546 @@
+import argparse
+import BaseHTTPServer
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import os.path
+import random
+import shutil
+import socket
+import SocketServer
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+from metrics import METRICS
+
+BENCHMARK_BLOG = 'benchmark.tumblr.com'
+BENCHMARK_KEY = 'benchmark'  # the fake API accepts any key
+REDIRECT_PREFIX = '/redirect/'  # the fake servers redirect /redirect/<path> to /<path>
+
+POST_TYPES = ['text', 'photo', 'quote', 'link', 'answer', 'video', 'audio', 'chat']
+DEFAULT_TYPE_MIX = 'text:5,photo:3,quote:1,link:1'
+PHASES = ['crawl', 'replay', 'download', 'render', 'bundle']
+
+FIRST_POST_ID = 10 ** 11
+FIRST_TIMESTAMP = 1400000000
+POST_INTERVAL = 3600  # seconds between consecutive fake posts
+ALT_SIZES = [1280, 500, 400, 250, 100, 75]  # widths tumblr lists for each photo, largest first
+TAGS = ['art', 'photography', 'nature', 'reblog', 'text post', 'long post', 'original', 'queue']
+
+
+class FakeTumblr(object):
+    """
+    A local stand-in for the Tumblr API and media hosts
+
+    Serves a blog of synthetic posts from /v2/blog/<blog>/info and /v2/blog/<blog>/posts, where <blog> is
+    BENCHMARK_BLOG (any other blog is not found), and the images they refer to from /media/ on a second port, so
+    that as with tumblr the API and images are on different hosts. Every post and image is generated from its
+    position and the seed, so runs with the same settings fetch the same data, and images carry an ETag honoured by
+    Range requests' If-Range. Either server redirects /redirect/<path> to /<path>. Byte and request counts are kept
+    for the benchmark's report.
+    """
+
+    def __init__(self, posts=1000, type_mix=DEFAULT_TYPE_MIX, photos_per_post=1, image_size=100000, api_latency=0.0,
+                 media_latency=0.0, api_error_rate=0.0, media_error_rate=0.0, seed=0):
+        """
+        :param posts: how many posts the blog has
+        :param type_mix: relative weights of post types, as type:weight pairs separated by commas
+        :param photos_per_post: how many photos each photo post has
+        :param image_size: the average size of the largest copy of an image, in bytes
+        :param api_latency: seconds to wait before answering each API request
+        :param media_latency: seconds to wait before answering each image request
+        :param api_error_rate: the fraction of API requests to fail with HTTP 503
+        :param media_error_rate: the fraction of image requests to fail with HTTP 503
+        :param seed: the seed posts, images and errors are generated from
+        """
+        self.posts = posts
+        self.type_weights = parse_type_mix(type_mix)
+        self.photos_per_post = photos_per_post
+        self.image_size = image_size
+        self.api_latency = api_latency
+        self.media_latency = media_latency
+        self.api_error_rate = api_error_rate
+        self.media_error_rate = media_error_rate
+        self.seed = seed
+        self.errors = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'api_requests': 0, 'api_bytes': 0, 'media_requests': 0, 'media_bytes': 0, 'errors': 0}
+        self.servers = []
+        self.api_url = None
+        self.media_url = None
+
+    def start(self):
+        """
+        Starts serving the API and the images on free local ports, on background threads.
+
+        :return: None
+        """
+        for _ in xrange(2):
+            server = FakeTumblrServer(('127.0.0.1', 0), FakeTumblrHandler)
+            server.tumblr = self
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+        self.api_url, self.media_url = ['http://127.0.0.1:%i/' % server.server_address[1] for server in self.servers]
+        self.api_url += 'v2/'
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.close_connections()
+            server.server_close()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def record(self, kind, size):
+        with self.lock:
+            self.stats[kind + '_requests'] += 1
+            self.stats[kind + '_bytes'] += size
+
+    def should_fail(self, kind):
+        rate = self.api_error_rate if kind == 'api' else self.media_error_rate
+        with self.lock:
+            if self.errors.random() < rate:
+                self.stats['errors'] += 1
+                return True
+            return False
+
+    def post_type(self, index):
+        """
+        Picks the type of a post according to the type mix.
+
+        :param index: the position of the post in the blog, newest first
+        :return: the post type
+        """
+        choice = random.Random('%i:%i' % (self.seed, index)).random() * sum(weight for _, weight in self.type_weights)
+        for post_type, weight in self.type_weights:
+            choice -= weight
+            if choice < 0:
+                return post_type
+        return self.type_weights[-1][0]
+
+    def make_post(self, index):
+        """
+        Generates a post as the API would return it.
+
+        :param index: the position of the post in the blog, newest first
+        :return: a dict of the post
+        """
+        post_type = self.post_type(index)
+        post_id = FIRST_POST_ID + self.posts - index
+        timestamp = FIRST_TIMESTAMP + (self.posts - index) * POST_INTERVAL
+        post = {'id': post_id, 'type': post_type, 'timestamp': timestamp,
+                'date': time.strftime('%Y-%m-%d %H:%M:%S GMT', time.gmtime(timestamp)), 'state': 'published',
+                'tags': [TAGS[(post_id + i) % len(TAGS)] for i in xrange(post_id % 4)]}
+        text = '<p>Post %i. %s</p>' % (post_id, 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8)
+        if post_type == 'text':
+            post.update({'title': 'Post %i' % post_id, 'body': text})
+        elif post_type == 'photo':
+            post.update({'caption': text, 'photos': [self.make_photo(post_id, number)
+                                                     for number in xrange(self.photos_per_post)]})
+        elif post_type == 'quote':
+            post.update({'text': text, 'source': 'Someone'})
+        elif post_type == 'link':
+            photo = self.make_photo(post_id, 0)
+            del photo['alt_sizes']
+            post.update({'title': 'Link %i' % post_id, 'url': 'http://example.com/%i' % post_id,
+                         'link_author': 'Someone', 'excerpt': 'An excerpt', 'publisher': 'example.com',
+                         'photos': [photo], 'description': text})
+        elif post_type == 'answer':
+            post.update({'asking_name': 'anonymous', 'asking_url': None, 'question': 'Question %i?' % post_id,
+                         'answer': text})
+        elif post_type in ('video', 'audio'):
+            post.update({'caption': text, 'player': '<embed src="http://example.com/%i"></embed>' % post_id,
+                         'plays': post_id % 1000})
+        elif post_type == 'chat':
+            post.update({'title': 'Chat %i' % post_id,
+                         'dialogue': [{'name': 'a', 'label': 'a:', 'phrase': 'Hello'},
+                                      {'name': 'b', 'label': 'b:', 'phrase': 'Hi'}]})
+        return post
+
+    def make_photo(self, post_id, number):
+        sizes = [{'url': '%smedia/%i_%i_%i.jpg' % (self.media_url, post_id, number, width), 'width': width,
+                  'height': width * 3 / 4} for width in ALT_SIZES]
+        return {'caption': '', 'alt_sizes': sizes, 'original_size': sizes[0]}
+
+    def image_urls(self):
+        """
+        Lists the URL of the largest copy of every image in the blog, as a crawl would download them.
+
+        :return: a list of URLs
+        """
+        urls = []
+        for index in xrange(self.posts):
+            post = self.make_post(index)
+            for photo in post.get('photos', ()):
+                urls.append(photo['original_size']['url'])
+        return urls
+
+    def image_data(self, name):
+        """
+        Generates the contents of an image. Sizes vary between half and one and a half times image_size for the
+        largest copy, and shrink with the width for smaller copies.
+
+        :param name: the image's file name
+        :return: the image data
+        """
+        digest = hashlib.sha1('%i:%s' % (self.seed, name)).digest()
+        width = int(os.path.splitext(name)[0].rsplit('_', 1)[-1])
+        size = int(self.image_size * (0.5 + ord(digest[0]) / 255.0) * (float(width) / ALT_SIZES[0]) ** 2)
+        return (digest * (size // len(digest) + 1))[:size]
+
+
+class FakeTumblrServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server that can hang up on its kept-alive connections, so that their threads finish on shutdown
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def handle_error(self, request, client_address):
+        pass  # clients hanging up on kept-alive connections
+
+
+class FakeTumblrHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers requests for a FakeTumblr, over keep-alive connections
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        tumblr = self.server.tumblr
+        url = urlparse.urlsplit(self.path)
+        if url.path.startswith('/v2/blog/'):
+            time.sleep(tumblr.api_latency)
+            if tumblr.should_fail('api'):
+                self.send_body(503, '')
+            else:
+                self.serve_api(tumblr, url)
+        elif url.path.startswith('/media/'):
+            time.sleep(tumblr.media_latency)
+            if tumblr.should_fail('media'):
+                self.send_body(503, '')
+            else:
+                self.serve_media(tumblr, url)
+        elif url.path.startswith(REDIRECT_PREFIX):
+            location = url.path[len(REDIRECT_PREFIX) - 1:] + ('?' + url.query if url.query else '')
+            self.send_body(302, '', {'Location': location})
+        else:
+            self.send_body(404, '')
+
+    def serve_api(self, tumblr, url):
+        params = dict(urlparse.parse_qsl(url.query))
+        if url.path.split('/')[3] != BENCHMARK_BLOG:  # as with tumblr, blogs that don't exist are not found
+            self.send_body(404, json.dumps({'meta': {'status': 404, 'msg': 'Not Found'}, 'response': []}))
+            return
+        if url.path.endswith('/info'):
+            response = {'blog': {'title': 'Benchmark', 'name': BENCHMARK_BLOG, 'posts': tumblr.posts,
+                                 'updated': FIRST_TIMESTAMP + tumblr.posts * POST_INTERVAL}}
+        elif url.path.endswith('/posts'):
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 20))
+            response = {'total_posts': tumblr.posts,
+                        'posts': [tumblr.make_post(index)
+                                  for index in xrange(offset, min(offset + limit, tumblr.posts))]}
+        else:
+            self.send_body(404, '')
+            return
+        body = json.dumps({'meta': {'status': 200, 'msg': 'OK'}, 'response': response})
+        headers = {'Content-Type': 'application/json'}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressed = StringIO.StringIO()
+            with contextlib.closing(gzip.GzipFile(fileobj=compressed, mode='wb')) as gzip_file:
+                gzip_file.write(body)
+            body = compressed.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        tumblr.record('api', len(body))
+        self.send_body(200, body, headers)
+
+    def serve_media(self, tumblr, url):
+        data = tumblr.image_data(os.path.basename(url.path))
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        headers = {'Content-Type': 'image/jpeg', 'ETag': etag}
+        status = 200
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header is not None and range_header.startswith('bytes=') and range_header.endswith('-') \
+                and if_range in (None, etag):  # as with any server, a changed image is sent whole
+            start = int(range_header[len('bytes='):-1])
+            if start >= len(data):
+                self.send_body(416, '', {'Content-Range': 'bytes */%i' % len(data)})
+                return
+            headers['Content-Range'] = 'bytes %i-%i/%i' % (start, len(data) - 1, len(data))
+            data = data[start:]
+            status = 206
+        tumblr.record('media', len(data))
+        self.send_body(status, data, headers)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parse_type_mix(type_mix):
+    """
+    Parses a post type mix.
+
+    :param type_mix: relative weights of post types, as type:weight pairs separated by commas, eg 'text:5,photo:3'
+    :return: a list of (post type, weight) tuples
+    """
+    weights = []
+    for pair in type_mix.split(','):
+        post_type, _, weight = pair.strip().partition(':')
+        if post_type not in POST_TYPES:
+            raise ValueError('Unknown post type %s; expected one of %s' % (post_type, ', '.join(POST_TYPES)))
+        weights.append((post_type, float(weight or 1)))
+    return weights
+
+
+def database_size(path):
+    """
+    :param path: the database file
+    :return: the size of the database and its journal files, in bytes
+    """
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal', '-shm') if os.path.exists(path + suffix))
+
+
+def phase_result(name, seconds, before, after, **counts):
+    """
+    Summarises a phase of the benchmark.
+
+    :param name: the name of the phase
+    :param seconds: how long the phase took
+    :param before: the fake server's stats before the phase
+    :param after: the fake server's stats after the phase
+    :param counts: further counts to report, eg posts or images
+    :return: a dict of the phase's results
+    """
+    result = {'phase': name, 'seconds': seconds}
+    for key in after:
+        result[key] = after[key] - before[key]
+    result['bytes'] = result['api_bytes'] + result['media_bytes']
+    result.update(counts)
+    for key in ('posts', 'images', 'bytes'):
+        if key in result:
+            result[key + '_per_second'] = result[key] / seconds if seconds else 0.0
+    return result
+
+
+def run_benchmark(options):
+    """
+    Runs the benchmark phases against a FakeTumblr in a scratch directory.
+
+    :param options: the parsed command line options
+    :return: a dict of the settings and each phase's results
+    """
+    tumblr = FakeTumblr(options.posts, options.type_mix, options.photos_per_post, options.image_size,
+                        options.api_latency / 1000.0, options.media_latency / 1000.0, options.api_error_rate,
+                        options.media_error_rate, options.seed)
+    tumblr.start()
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='bush-viper-benchmark-')
+    os.chdir(workdir)
+    with open('secret_key', 'w') as key_file:
+        json.dump({'consumer_key': BENCHMARK_KEY}, key_file)
+    os.mkdir('posts')
+
+    # api and db find the API key and the database in the working directory when imported, so they are imported
+    # only once that is the scratch directory
+    import api
+    import asyncengine
+    import db
+    import imagestore
+    import renderer
+    import threadpool
+
+    results = {'settings': vars(options), 'phases': []}
+    try:
+        if 'crawl' in options.phases:
+            archive = 'replay' in options.phases  # the replay phase rebuilds the posts from the crawl's responses
+            with db.DBAdapter() as adapter:
+                before = tumblr.snapshot()
+                start = time.time()
+                if options.engine == 'async':
+                    crawler = asyncengine.AsyncCrawler(adapter, host=tumblr.api_url, concurrency=options.concurrency,
+                                                       archive=archive)
+                    crawler.run(BENCHMARK_BLOG, options.limit)
+                else:
+                    images = threadpool.ThreadPool(options.threads, imagestore.ImageStore())
+                    requester = api.TumblrRequester(adapter, host=tumblr.api_url, threadpool=images, archive=archive)
+                    with requester:
+                        requester.get_blog(BENCHMARK_BLOG, options.limit, workers=options.workers)
+                adapter.flush()
+                seconds = time.time() - start
+                results['phases'].append(phase_result('crawl', seconds, before, tumblr.snapshot(),
+                                                      posts=len(adapter.post_ids),
+                                                      images=len(adapter.get_image_hashes())))
+            results['database_bytes'] = database_size(db.DATABASE_PATH)
+
+        if 'replay' in options.phases:
+            with db.DBAdapter() as adapter:
+                before = tumblr.snapshot()
+                start = time.time()
+                images = threadpool.PendingImageSink(imagestore.ImageStore(adapter.get_image_hashes()))
+                api.TumblrRequester(adapter, host=tumblr.api_url, threadpool=images).replay(BENCHMARK_BLOG)
+                seconds = time.time() - start
+                results['phases'].append(phase_result('replay', seconds, before, tumblr.snapshot(),
+                                                      posts=api.POSTS_REPLAYED.value))
+
+        if 'download' in options.phases:
+            urls = tumblr.image_urls()
+            if options.limit is not None:
+                urls = urls[:options.limit]
+            before = tumblr.snapshot()
+            start = time.time()
+            images = threadpool.ThreadPool(options.threads, imagestore.ImageStore(root='download'))
+            for url in urls:
+                images.insert(url)
+            images.close()
+            seconds = time.time() - start
+            results['phases'].append(phase_result('download', seconds, before, tumblr.snapshot(),
+                                                  images=len(images.store.hashes)))
+
+        if 'render' in options.phases:
+            with db.DBAdapter() as adapter:
+                before = tumblr.snapshot()
+                start = time.time()
+                renderer.Renderer(adapter).dump_posts(processes=options.processes, force=True)
+                seconds = time.time() - start
+                results['phases'].append(phase_result('render', seconds, before, tumblr.snapshot(),
+                                                      posts=len(adapter.post_ids)))
+
+        if 'bundle' in options.phases:
+            with db.DBAdapter() as adapter:
+                before = tumblr.snapshot()
+                start = time.time()
+                renderer.Renderer(adapter).dump_bundle(processes=options.processes)
+                seconds = time.time() - start
+                results['phases'].append(phase_result('bundle', seconds, before, tumblr.snapshot(),
+                                                      posts=len(adapter.post_ids)))
+        results['metrics'] = METRICS.summary()
+    finally:
+        os.chdir(home)
+        tumblr.stop()
+        if options.keep:
+            print 'Kept benchmark files in %s' % workdir
+        else:
+            shutil.rmtree(workdir)
+    return results
+
+
+def print_results(results):
+    for phase in results['phases']:
+        line = '%-8s %8.2f s' % (phase['phase'], phase['seconds'])
+        if 'posts' in phase:
+            line += '  %7i posts %9.1f posts/s' % (phase['posts'], phase['posts_per_second'])
+        if 'images' in phase:
+            line += '  %7i images %9.1f images/s' % (phase['images'], phase['images_per_second'])
+        if phase['bytes']:
+            line += '  %8.2f MB/s' % (phase['bytes_per_second'] / 1e6)
+        if phase['errors']:
+            line += '  %i errors injected' % phase['errors']
+        print line
+    if 'database_bytes' in results:
+        print 'database %8.2f MB' % (results['database_bytes'] / 1e6)
+    for name, summary in sorted(results.get('metrics', {}).iteritems()):
+        if isinstance(summary, dict) and summary['count']:
+            print '%-24s %7i  mean %8.2f ms  p50 %8.2f ms  p99 %8.2f ms' % (
+                name, summary['count'], summary['mean'] * 1000, summary['p50'] * 1000, summary['p99'] * 1000)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks bush-viper against a local fake Tumblr API and media '
+                                                 'server, so that runs can be compared without touching tumblr.')
+    blog = parser.add_argument_group('fake blog')
+    blog.add_argument('--posts', type=int, default=1000, help='posts in the blog (default: %(default)s)')
+    blog.add_argument('--type-mix', default=DEFAULT_TYPE_MIX,
+                      help='relative weights of post types, as type:weight pairs (default: %(default)s)')
+    blog.add_argument('--photos-per-post', type=int, default=1, help='photos in each photo post (default: %(default)s)')
+    blog.add_argument('--image-size', type=int, default=100000,
+                      help='average size of each downloaded image in bytes (default: %(default)s)')
+    blog.add_argument('--api-latency', type=float, default=50, help='API response latency in ms (default: %(default)s)')
+    blog.add_argument('--media-latency', type=float, default=20,
+                      help='image response latency in ms (default: %(default)s)')
+    blog.add_argument('--api-error-rate', type=float, default=0.0,
+                      help='fraction of API requests failed with HTTP 503 (default: %(default)s)')
+    blog.add_argument('--media-error-rate', type=float, default=0.0,
+                      help='fraction of image requests failed with HTTP 503 (default: %(default)s)')
+    blog.add_argument('--seed', type=int, default=0, help='seed for generated posts and errors (default: %(default)s)')
+    run = parser.add_argument_group('bush-viper')
+    run.add_argument('--phases', default=','.join(PHASES),
+                     help='comma-separated phases to run, out of %s (default: %%(default)s)' % ', '.join(PHASES))
+    run.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                     help='crawl with TumblrRequester or AsyncCrawler (default: %(default)s)')
+    run.add_argument('--limit', type=int, default=None, help='most posts to crawl / images to download')
+    run.add_argument('--workers', type=int, default=4,
+                     help='page fetchers for the threaded crawl (default: %(default)s)')
+    run.add_argument('--threads', type=int, default=5, help='image download threads (default: %(default)s)')
+    run.add_argument('--concurrency', type=int, default=200,
+                     help='requests in flight for the async crawl (default: %(default)s)')
+    run.add_argument('--processes', type=int, default=None, help='render processes (default: one per CPU)')
+    output = parser.add_argument_group('output')
+    output.add_argument('--json', metavar='FILE', help='also write the results to FILE as JSON, for comparing runs')
+    output.add_argument('--keep', action='store_true', help='keep the scratch directory with the database and files')
+    output.add_argument('--verbose', action='store_true', help="log bush-viper's progress")
+    options = parser.parse_args(argv)
+    options.phases = [phase.strip() for phase in options.phases.split(',')]
+    for phase in options.phases:
+        if phase not in PHASES:
+            parser.error('unknown phase %s' % phase)
+    try:
+        parse_type_mix(options.type_mix)
+    except ValueError, e:
+        parser.error(str(e))
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.ERROR,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    results = run_benchmark(options)
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
@@ -1,15 +1,168 @@
+import logging
 import sys
 
 from api import *
+from asyncengine import *
 from db import *
+from exporter import export_posts, parse_time
+from imagequeue import IMAGE_QUEUE_SIZE
+from imagestore import ImageStore
+from metrics import METRICS
+from multiblog import *
 from renderer import *
+from scheduler import HOST_RATE
+from threadpool import PendingImageSink
 
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LOG_LEVELS = {'--quiet': logging.WARNING, '--verbose': logging.DEBUG}
 
-if __name__ == '__main__':
-    with DBAdapter() as db:
-        if sys.argv[1] == 'render':
-            renderer = Renderer(db)
-            renderer.dump_posts()
+
+def parse_options(args):
+    """
+    Splits the options off the front of the command line.
+
+    Options are --quiet (only log warnings and errors), --verbose (log every post and image), --archive (keep the raw
+    API responses of crawls, for the replay command), --image-queue=SIZE (how many images to queue in memory before
+    the crawl waits for downloads to catch up), --spill-images (spill images beyond that to disk instead of waiting),
+    --host-rate=N (send each media host at most N requests a second; by default hosts are only slowed down once they
+    throttle us), --force (render every post, even those the render manifest says are up to date), and
+    --metrics-json=FILE and --metrics-textfile=FILE to write metrics to FILE as a JSON summary or a Prometheus
+    textfile when the run ends.
+
+    :param args: the command line arguments, without the program name
+    :return: a tuple of a dict of options to values and the remaining arguments
+    """
+    options = {'level': logging.INFO, 'archive': False, 'queue_size': IMAGE_QUEUE_SIZE, 'spill': False,
+               'host_rate': HOST_RATE, 'force': False}
+    while args and args[0].startswith('--'):
+        name, _, value = args.pop(0).partition('=')
+        if name in LOG_LEVELS:
+            options['level'] = LOG_LEVELS[name]
+        elif name == '--archive':
+            options['archive'] = True
+        elif name == '--image-queue' and value.isdigit() and int(value) > 0:
+            options['queue_size'] = int(value)
+        elif name == '--spill-images':
+            options['spill'] = True
+        elif name == '--host-rate' and is_positive_number(value):
+            options['host_rate'] = float(value)
+        elif name == '--force':
+            options['force'] = True
+        elif name in ('--metrics-json', '--metrics-textfile') and value:
+            options[name] = value
         else:
-            requester = TumblrRequester(db)
-            requester.get_blog(sys.argv[1], int(sys.argv[2]))
+            print 'Unknown option %s' % name
+            exit(1)
+    return options, args
+
+
+def is_positive_number(value):
+    try:
+        return float(value) > 0
+    except ValueError:
+        return False
+
+
+def parse_filters(args):
+    """
+    Parses the name=value filters given to the export command.
+
+    The filters are blog=URL, type=TYPE[,TYPE...], since=TIME and until=TIME (Unix timestamps or UTC dates like
+    2015-06-30), tag=TAG, state=STATE, order=newest|oldest and chunk=N (split the export into files of N posts).
+
+    :param args: the filters
+    :return: a dict of keyword arguments for export_posts()
+    """
+    filters = {}
+    for arg in args:
+        name, _, value = arg.decode('utf-8').partition('=')
+        if name in ('blog', 'tag', 'state'):
+            filters[name] = value
+        elif name == 'type':
+            filters['types'] = value.split(',')
+        elif name in ('since', 'until'):
+            filters[name] = parse_time(value)
+        elif name == 'order' and value in ('newest', 'oldest'):
+            filters['newest_first'] = value == 'newest'
+        elif name == 'chunk' and value.isdigit() and int(value) > 0:
+            filters['chunk_size'] = int(value)
+        else:
+            print 'Unknown filter %s' % arg
+            exit(1)
+    return filters
+
+
+def new_requester(db, options):
+    """
+    Creates a TumblrRequester configured by the command line options.
+
+    :param db: the DBAdapter to store posts in
+    :param options: the options, as returned by parse_options()
+    :return: the requester
+    """
+    return TumblrRequester(db, archive=options['archive'], queue_size=options['queue_size'], spill=options['spill'],
+                           host_rate=options['host_rate'])
+
+
+if __name__ == '__main__':
+    options, args = parse_options(sys.argv[1:])
+    logging.basicConfig(level=options['level'], format=LOG_FORMAT)
+    try:
+        with DBAdapter() as db:
+            if args[0] == 'render':
+                processes = int(args[1]) if len(args) > 1 else None
+                for blog in db.get_blogs():
+                    renderer = Renderer(db, blog)
+                    renderer.dump_posts(processes=processes, force=options['force'])
+            elif args[0] == 'render-blog':
+                processes = int(args[2]) if len(args) > 2 else None
+                renderer = Renderer(db, args[1])
+                renderer.dump_posts(processes=processes, force=options['force'])
+            elif args[0] == 'bundle':
+                processes = int(args[1]) if len(args) > 1 else None
+                for blog in db.get_blogs():
+                    Renderer(db, blog).dump_bundle(processes=processes)
+            elif args[0] == 'bundle-blog':
+                processes = int(args[2]) if len(args) > 2 else None
+                Renderer(db, args[1]).dump_bundle(processes=processes)
+            elif args[0] == 'render-tag':
+                processes = int(args[2]) if len(args) > 2 else None
+                for blog in db.get_blogs():
+                    renderer = Renderer(db, blog)
+                    renderer.dump_posts(processes=processes, force=options['force'], tag=args[1].decode('utf-8'))
+            elif args[0] == 'tags':
+                limit = int(args[1]) if len(args) > 1 else None
+                for tag, count in db.get_tag_counts(limit):
+                    print (u'%7i  %s' % (count, tag)).encode('utf-8')
+            elif args[0] == 'export':
+                export_posts(db, args[1], **parse_filters(args[2:]))
+            elif args[0] == 'retry-images':
+                with new_requester(db, options) as requester:
+                    requester.retry_images()
+            elif args[0] == 'replay':
+                sink = PendingImageSink(ImageStore(db.get_image_hashes()))
+                with TumblrRequester(db, threadpool=sink) as requester:
+                    for blog in args[1:] or db.get_archived_blogs():
+                        requester.replay(blog)
+            elif args[0] == 'async':
+                concurrency = int(args[3]) if len(args) > 3 else DEFAULT_CONCURRENCY
+                crawler = AsyncCrawler(db, concurrency=concurrency, archive=options['archive'])
+                crawler.run(args[1], int(args[2]))
+            elif args[0] in ('multi', 'multi-update'):
+                workers = int(args[2]) if len(args) > 2 else 4
+                with new_requester(db, options) as requester:
+                    crawler = MultiBlogCrawler(db, workers=workers, requester=requester)
+                    crawler.run(read_blog_list(args[1]), incremental=args[0] == 'multi-update')
+            elif args[0] == 'update':
+                workers = int(args[2]) if len(args) > 2 else 1
+                with new_requester(db, options) as requester:
+                    requester.get_blog(args[1], workers=workers, incremental=True)
+            else:
+                workers = int(args[2]) if len(args) > 2 else 1
+                with new_requester(db, options) as requester:
+                    requester.get_blog(args[0], int(args[1]), workers=workers)
+    finally:
+        if '--metrics-json' in options:
+            METRICS.write_json(options['--metrics-json'])
+        if '--metrics-textfile' in options:
+            METRICS.write_textfile(options['--metrics-textfile'])
@@ -1,10 +1,279 @@
+import array
+import json
+import logging
 import os
 import os.path
 import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
 
 DATABASE_PATH = os.path.join(os.getcwd(), 'scrape.sql')
 METADATA_TABLE = 'metadata'
 POSTS_TABLE = 'posts'
+IMAGES_TABLE = 'images'
+RENDER_MANIFEST_TABLE = 'render_manifest'
+CHECKPOINTS_TABLE = 'checkpoints'
+PENDING_IMAGES_TABLE = 'pending_images'
+TAGS_TABLE = 'tags'
+RESPONSES_TABLE = 'responses'
+DOWNLOADS_TABLE = 'downloads'
+
+# the status of an image in the download ledger
+DOWNLOAD_QUEUED = 'queued'
+DOWNLOAD_RETRYING = 'retrying'  # the last attempt failed, and another is due
+DOWNLOAD_DONE = 'downloaded'
+DOWNLOAD_FAILED = 'failed'  # given up on
+
+SCHEMA_VERSION = 5  # stored in PRAGMA user_version; see DBAdapter.migrate()
+
+AUX_FORMAT_VERSION = 1  # first byte of every stored aux_info blob; see encode_aux()
+AUX_COMPRESSION_LEVEL = 6
+COLD_PHOTO_FIELDS = ['alt_sizes']  # photo fields never rendered, dropped from stored aux data
+MIGRATION_BATCH_SIZE = 5000  # rows rewritten at a time by migrations
+RESPONSE_FORMAT_VERSION = 1  # first byte of every archived response; see compress_response()
+RESPONSE_COMPRESSION_LEVEL = 6
+ARCHIVE_READ_BATCH_SIZE = 100  # archived responses read at a time by get_archived_pages()
+QUERY_BATCH_SIZE = 1000  # posts read at a time by query_posts()
+
+# the columns of a PostRow, in order; the blog column is left out, since it was added to the end of the table later
+POST_COLUMNS = 'id, type, time, date, tags, source_url, source_title, state, aux_info'
+
+DB_POSTS_WRITTEN = METRICS.counter('db_posts_written', 'Posts written to the database')
+DB_FLUSH_SECONDS = METRICS.histogram('db_flush_seconds', 'Time taken to write and commit each batch of posts')
+DB_RESPONSES_ARCHIVED = METRICS.counter('db_responses_archived', 'Raw API responses written to the archive')
+
+POST_BATCH_SIZE = 500  # posts written per transaction
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',  # safe under WAL; only a power loss can drop the last few transactions
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',  # 64 MB
+]
+
+POST_ID_SET_MIN_BITS = 10  # smallest table is 1024 slots
+EMPTY_SLOT = 0  # tumblr never hands out post id 0, so it marks unused slots
+FIBONACCI_MULTIPLIER = 0x9E3779B97F4A7C15  # 2**64 / golden ratio; spreads sequential ids across the table
+UINT64_MASK = (1 << 64) - 1
+
+
+def _find_id_typecode():
+    """
+    Finds an array typecode for 64-bit signed integers on this platform.
+
+    :return: the typecode
+    """
+    for typecode in ('l', 'q'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:  # 'q' is not available before Python 3.3
+            pass
+    raise RuntimeError('No 64-bit array typecode available')
+
+ID_TYPECODE = _find_id_typecode()
+
+
+class PostIdSet(object):
+    """
+    A compact set of post ids
+
+    Ids are kept in an open-addressed hash table backed by an array of 64-bit machine integers. The table doubles
+    whenever it gets more than half full, so it stays between a quarter and half full and each id costs 16 to 32
+    bytes (up to 48 while the table is being doubled) instead of the ~100 a set of Python ints would use.
+    """
+
+    def __init__(self, expected_size=0):
+        self.size = 0
+        self.bits = POST_ID_SET_MIN_BITS
+        while (1 << self.bits) < expected_size * 2:
+            self.bits += 1
+        self.table = array.array(ID_TYPECODE, [EMPTY_SLOT]) * (1 << self.bits)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, post_id):
+        return self.table[self._find_slot(post_id)] == post_id
+
+    def __iter__(self):
+        for post_id in self.table:
+            if post_id != EMPTY_SLOT:
+                yield post_id
+
+    def _find_slot(self, post_id):
+        """
+        Finds the slot holding a post id, or the empty slot it would be stored in.
+
+        :param post_id: the post id to look for
+        :return: the index of the slot
+        """
+        mask = len(self.table) - 1
+        index = ((post_id * FIBONACCI_MULTIPLIER) & UINT64_MASK) >> (64 - self.bits)
+        while True:
+            current = self.table[index]
+            if current == post_id or current == EMPTY_SLOT:
+                return index
+            index = (index + 1) & mask
+
+    def add(self, post_id):
+        """
+        Adds a post id to the set.
+
+        :param post_id: the post id to add; must be positive
+        :return: None
+        """
+        index = self._find_slot(post_id)
+        if self.table[index] == post_id:
+            return
+        self.table[index] = post_id
+        self.size += 1
+        if self.size * 2 > len(self.table):
+            self._grow()
+
+    def _grow(self):
+        """
+        Doubles the size of the table and re-inserts every id.
+
+        :return: None
+        """
+        old_table = self.table
+        self.bits += 1
+        self.table = array.array(ID_TYPECODE, [EMPTY_SLOT]) * (1 << self.bits)
+        for post_id in old_table:
+            if post_id != EMPTY_SLOT:
+                self.table[self._find_slot(post_id)] = post_id
+
+
+def compact_aux(aux):
+    """
+    Drops the parts of a post's aux data that are never rendered.
+
+    Tumblr lists every resized copy of each photo in alt_sizes; only the size picked out by
+    TumblrRequester.prepare_post() (in 'bv') and the original are kept.
+
+    :param aux: the aux data, as built by TumblrRequester.prepare_post(); it is modified in place
+    :return: the aux data
+    """
+    for photo in aux.get('photos', ()):
+        for field in COLD_PHOTO_FIELDS:
+            photo.pop(field, None)
+    return aux
+
+
+def encode_aux(aux):
+    """
+    Encodes a post's aux data for storage.
+
+    The data is compacted (see compact_aux()), dumped to JSON and compressed with zlib, behind a byte giving the
+    format version.
+
+    :param aux: the aux data, as built by TumblrRequester.prepare_post()
+    :return: the encoded data, ready to be stored in the aux_info column
+    """
+    data = json.dumps(compact_aux(aux), separators=(',', ':'))
+    return sqlite3.Binary(chr(AUX_FORMAT_VERSION) + zlib.compress(data, AUX_COMPRESSION_LEVEL))
+
+
+def decode_aux(aux_info):
+    """
+    Decodes a post's aux data as stored in the aux_info column.
+
+    Plain JSON, as stored before the data was compressed, is also accepted.
+
+    :param aux_info: the stored data
+    :return: the aux data
+    """
+    if isinstance(aux_info, unicode) or aux_info[:1] == '{':
+        return json.loads(aux_info)
+    if ord(aux_info[0]) == AUX_FORMAT_VERSION:
+        return json.loads(zlib.decompress(aux_info[1:]))
+    raise ValueError('Unknown aux_info format %i' % ord(aux_info[0]))
+
+
+class PostRow(tuple):
+    """
+    A post read from the database
+
+    This is the tuple of the post's POST_COLUMNS, with aux_info as stored, followed by the blog for posts read by
+    DBAdapter.query_posts(). The aux data is only decompressed and parsed when the `aux` attribute is first read.
+    """
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param row: the columns of a post as read by sqlite
+        :return: the post
+        """
+        aux_info = row[8]
+        if isinstance(aux_info, buffer):  # so that the row compares, hashes and repr()s by value
+            aux_info = str(aux_info)
+        return cls(row[:8] + (aux_info,) + row[9:])
+
+    id = property(lambda self: self[0])
+    type = property(lambda self: self[1])
+    time = property(lambda self: self[2])
+    date = property(lambda self: self[3])
+    tags = property(lambda self: self[4])
+    source_url = property(lambda self: self[5])
+    source_title = property(lambda self: self[6])
+    state = property(lambda self: self[7])
+    aux_info = property(lambda self: self[8])
+    blog = property(lambda self: self[9] if len(self) > 9 else None)
+
+    @property
+    def aux(self):
+        if '_aux' not in self.__dict__:
+            self._aux = decode_aux(self.aux_info)
+        return self._aux
+
+
+def compress_response(content):
+    """
+    Compresses a raw API response for the archive, behind a byte giving the format version.
+
+    :param content: the response body, as received
+    :return: the compressed body, ready to be stored in the responses table
+    """
+    return sqlite3.Binary(chr(RESPONSE_FORMAT_VERSION) + zlib.compress(content, RESPONSE_COMPRESSION_LEVEL))
+
+
+def decompress_response(body):
+    """
+    Recovers a raw API response from the archive.
+
+    :param body: the stored body
+    :return: the response body, as received
+    """
+    if ord(body[0]) == RESPONSE_FORMAT_VERSION:
+        return zlib.decompress(body[1:])
+    raise ValueError('Unknown archived response format %i' % ord(body[0]))
+
+
+def post_row(post, blog):
+    """
+    Builds the row a post is stored as in the posts table.
+
+    :param post: the post, as returned by TumblrRequester.prepare_post()
+    :param blog: the URL of the blog the post was crawled from
+    :return: a tuple of the POST_COLUMNS and the blog
+    """
+    return (post['id'], post['type'], post['timestamp'], post['date'], post['tags'], post['source_url'],
+            post['source_title'], post['state'], encode_aux(post['aux']), blog)
+
+
+def split_tags(tags):
+    """
+    Splits the comma-joined tags stored in the posts table.
+
+    :param tags: the tags as stored by TumblrRequester.prepare_post()
+    :return: a list of tags
+    """
+    return [tag for tag in tags.split(',') if tag] if tags else []
 
 
 class DBAdapter(object):
@@ -12,13 +281,21 @@ class DBAdapter(object):
     A wrapper around sqlite
     """
 
-    def __init__(self):
+    def __init__(self, batch_size=POST_BATCH_SIZE):
         self.conn = None
         self.curs = None
+        self.batch_size = batch_size
+        self.pending_posts = []
+        self.pending_checkpoints = {}  # blog -> checkpoint row
+        self.pending_responses = []
+        self.responses_lock = threading.Lock()  # responses are archived from fetcher threads
+        self.post_ids = None
 
     def __enter__(self):
         self.connect_to_db()
         self.create_tables()
+        self.migrate()
+        self.load_post_ids()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -26,7 +303,7 @@ class DBAdapter(object):
 
     def connect_to_db(self, db=DATABASE_PATH):
         """
-        Connects to a SQLilte database file.
+        Connects to a SQLilte database file and tunes it for bulk ingestion.
 
         Prints an error message and exit()s if the database cannot be connected to.
 
@@ -36,83 +313,689 @@ class DBAdapter(object):
         try:
             self.conn = sqlite3.connect(db)
         except:
-            print u'Could not connect to database {}'.format(db)
-            print 'Exiting'
+            logger.error(u'Could not connect to database %s', db)
+            logger.error('Exiting')
             exit(1)
         self.curs = self.conn.cursor()
+        for pragma in PRAGMAS:
+            self.curs.execute(pragma)
 
     def disconnect_from_db(self):
         """
-        Closes the connection to the database, committing any transactions in progress.
+        Closes the connection to the database, flushing any buffered posts and committing any transactions in progress.
 
         :return: None
         """
-        self.conn.commit()
+        self.flush()
         self.conn.close()
 
+    def flush(self):
+        """
+        Writes any buffered posts, crawl checkpoints and archived responses to the database and commits.
+
+        :return: None
+        """
+        with DB_FLUSH_SECONDS.time():
+            if self.pending_posts:
+                command = u'INSERT INTO %s (%s, blog) VALUES (%s)' % (POSTS_TABLE, POST_COLUMNS, ', '.join('?' * 10))
+                self.curs.executemany(command, self.pending_posts)
+                command = u'INSERT OR IGNORE INTO %s VALUES (?, ?)' % TAGS_TABLE
+                self.curs.executemany(command, ((tag, post[0]) for post in self.pending_posts
+                                                for tag in split_tags(post[4])))
+                DB_POSTS_WRITTEN.inc(len(self.pending_posts))
+                self.pending_posts = []
+            if self.pending_checkpoints:
+                command = u'INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)' % CHECKPOINTS_TABLE
+                self.curs.executemany(command, self.pending_checkpoints.values())
+                self.pending_checkpoints = {}
+            with self.responses_lock:
+                responses, self.pending_responses = self.pending_responses, []
+            if responses:
+                self.curs.executemany(u'INSERT INTO %s VALUES (?, ?, ?, ?)' % RESPONSES_TABLE, responses)
+                DB_RESPONSES_ARCHIVED.inc(len(responses))
+            self.conn.commit()
+
     def create_tables(self):
         """
-        Creates the tables for storing blog metadata and post data.
+        Creates the tables for storing blog metadata, post data, post tags, the downloaded image index, the image
+        download ledger, the render manifest, crawl checkpoints and the archive of raw API responses.
+
+        One database may hold any number of blogs; posts record the URL of the blog they were crawled from, and the
+        other per-blog tables are keyed by it.
+
+        Tags are stored one row per (tag, post id) as well as in the posts table's comma-joined tags column. The primary
+        key doubles as the index for tag lookups and counts; a second index covers lookups by post.
 
         :return: None
         """
         self.curs.execute('CREATE TABLE IF NOT EXISTS %s (url TEXT, title TEXT, last_update INTEGER)' % METADATA_TABLE)
         self.curs.execute('''CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, type TEXT, time INTEGER, date TEXT,
-                             tags TEXT, source_url TEXT, source_title TEXT, state TEXT, aux_info TEXT)''' % POSTS_TABLE)
+                             tags TEXT, source_url TEXT, source_title TEXT, state TEXT, aux_info TEXT,
+                             blog TEXT)''' % POSTS_TABLE)
+        self.curs.execute('CREATE TABLE IF NOT EXISTS %s (url TEXT PRIMARY KEY, hash TEXT)' % IMAGES_TABLE)
+        self.curs.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, digest TEXT)' % RENDER_MANIFEST_TABLE)
+        self.curs.execute('''CREATE TABLE IF NOT EXISTS %s (blog TEXT PRIMARY KEY, next_offset INTEGER,
+                             processed INTEGER, newest_post_time INTEGER)''' % CHECKPOINTS_TABLE)
+        self.curs.execute('CREATE TABLE IF NOT EXISTS %s (url TEXT PRIMARY KEY, fallback_url TEXT)'
+                          % PENDING_IMAGES_TABLE)
+        self.curs.execute('''CREATE TABLE IF NOT EXISTS %s (url TEXT PRIMARY KEY, status TEXT, attempts INTEGER,
+                             bytes INTEGER, last_error TEXT, last_attempt INTEGER, seconds REAL,
+                             fallback_url TEXT)''' % DOWNLOADS_TABLE)
+        self.curs.execute('''CREATE TABLE IF NOT EXISTS %s (tag TEXT COLLATE NOCASE, post_id INTEGER,
+                             PRIMARY KEY (tag, post_id)) WITHOUT ROWID''' % TAGS_TABLE)
+        self.curs.execute('CREATE INDEX IF NOT EXISTS %s_post_id ON %s (post_id)' % (TAGS_TABLE, TAGS_TABLE))
+        self.curs.execute('''CREATE TABLE IF NOT EXISTS %s (blog TEXT, offset INTEGER, fetched INTEGER,
+                             body BLOB)''' % RESPONSES_TABLE)
+        self.curs.execute('CREATE INDEX IF NOT EXISTS %s_blog ON %s (blog)' % (RESPONSES_TABLE, RESPONSES_TABLE))
         self.conn.commit()
 
+    def migrate(self):
+        """
+        Brings a database written by an older version up to SCHEMA_VERSION.
+
+        The schema version is kept in SQLite's user_version pragma; each migration runs once, in order, and the new
+        version is committed along with it.
+
+        :return: None
+        """
+        version = self.curs.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            self.migrate_tags()
+        if version < 2:
+            self.migrate_aux()
+        if version < 3:
+            self.migrate_blogs()
+        if version < 4:
+            self.migrate_query_indexes()
+        if version < 5:
+            self.migrate_fallback_urls()
+        if version < SCHEMA_VERSION:
+            self.curs.execute('PRAGMA user_version=%i' % SCHEMA_VERSION)
+            self.conn.commit()
+        if version < 2 and self.curs.execute(u'SELECT COUNT(*) FROM %s' % POSTS_TABLE).fetchone()[0]:
+            logger.info('Compacting database')
+            self.curs.execute('VACUUM')  # give the space freed by compressing aux data back to the filesystem
+
+    def migrate_tags(self):
+        """
+        Fills the tags table from the comma-joined tags column of posts stored before it existed.
+
+        :return: None
+        """
+        logger.info('Indexing post tags')
+        rows = self.conn.execute(u"SELECT id, tags FROM %s WHERE tags != ''" % POSTS_TABLE)
+        command = u'INSERT OR IGNORE INTO %s VALUES (?, ?)' % TAGS_TABLE
+        self.curs.executemany(command, ((tag, post_id) for post_id, tags in rows for tag in split_tags(tags)))
+
+    def load_post_ids(self):
+        """
+        Loads the ids of all posts in the database into memory, for post_id_exists().
+
+        :return: None
+        """
+        count = self.curs.execute(u'SELECT COUNT(*) FROM %s' % POSTS_TABLE).fetchone()[0]
+        self.post_ids = PostIdSet(count)
+        for (post_id,) in self.conn.execute(u'SELECT id FROM %s' % POSTS_TABLE):
+            self.post_ids.add(post_id)
+
     def insert_metadata(self, url, title, last_update):
         """
         Insert metadata for a blog into the database.
 
         :param url: the URL for the blog
         :param title: the title of the blog
-        :param last_update: when the blog was last updated
+        :param last_update: when the blog was last updated, or None until a crawl of it completes; see
+            set_last_update()
         :return: None
         """
         command = u'INSERT INTO %s VALUES (?, ?, ?)' % METADATA_TABLE
         self.curs.execute(command, (url, title, last_update))
-        self.conn.commit()
 
-    def get_metadata(self):
+    def set_last_update(self, url, last_update):
+        """
+        Records when a blog was last updated on the metadata most recently inserted for it, once the crawl that
+        inserted it has completed.
+
+        The row is committed with the next flush(), so a crawl that clears its checkpoint in the same transaction
+        either records both or neither.
+
+        :param url: the URL for the blog
+        :param last_update: when the blog was last updated, as reported when the crawl started
+        :return: None
+        """
+        command = u'UPDATE %s SET last_update=? WHERE rowid=(SELECT MAX(rowid) FROM %s WHERE url=?)' % (
+            METADATA_TABLE, METADATA_TABLE)
+        self.curs.execute(command, (last_update, url))
+
+    def get_metadata(self, blog=None):
+        """
+        Get the most recent metadata for a blog stored in the database.
+
+        :param blog: the URL for the blog; if `None`, whichever blog was updated most recently
+        :return: a tuple of blog title and URL, or None if no metadata is stored for the blog
+        """
+        if blog is None:
+            command = u'SELECT title, url FROM %s ORDER BY last_update DESC LIMIT 1' % METADATA_TABLE
+            return self.curs.execute(command).fetchone()
+        command = u'SELECT title, url FROM %s WHERE url=? ORDER BY last_update DESC LIMIT 1' % METADATA_TABLE
+        return self.curs.execute(command, (blog,)).fetchone()
+
+    def get_blogs(self):
+        """
+        Get the blogs with posts stored in the database, whether or not their metadata was retrieved.
+
+        Posts migrated from a single-blog database with no metadata have no blog, and are left out.
+
+        :return: a list of blog URLs
+        """
+        self.flush()
+        command = u'SELECT DISTINCT blog FROM %s WHERE blog IS NOT NULL ORDER BY blog' % POSTS_TABLE
+        return [blog for (blog,) in self.curs.execute(command)]
+
+    def get_last_update(self, url):
+        """
+        Get the last update time recorded for a blog by a previous run.
+
+        :param url: the URL for the blog
+        :return: the most recent last_update stored for the blog, or None if it has never been retrieved
         """
-        Get the most recent metadata for the blog stored in the database.
+        command = u'SELECT MAX(last_update) FROM %s WHERE url=?' % METADATA_TABLE
+        return self.curs.execute(command, (url,)).fetchone()[0]
 
-        :return: a tuple of blog title and URL
+    def get_newest_post_time(self, blog=None):
         """
-        command = u'SELECT title, url FROM %s ORDER BY last_update DESC' % METADATA_TABLE
-        for row in self.curs.execute(command):
-            return row
+        Get the timestamp of the most recent post stored in the database.
+
+        :param blog: the URL of the blog to look at; if `None`, every blog
+        :return: the timestamp, or None if there are no posts
+        """
+        self.flush()
+        if blog is None:
+            return self.curs.execute(u'SELECT MAX(time) FROM %s' % POSTS_TABLE).fetchone()[0]
+        command = u'SELECT MAX(time) FROM %s WHERE blog=?' % POSTS_TABLE
+        return self.curs.execute(command, (blog,)).fetchone()[0]
 
     def post_id_exists(self, post_id):
         """
-        Check if a post with the given id is already in the database
+        Check if a post with the given id is already in the database or waiting to be written to it
+
+        This is a lookup in the in-memory index built by load_post_ids() and kept up to date by insert_posts(); the
+        database itself is not queried.
 
         :param post_id: the post id to check
         :return: whether or not a post with the given id is in the database
         """
-        command = u'SELECT * FROM %s WHERE id=%i' % (POSTS_TABLE, post_id)
-        return len(self.curs.execute(command)) > 0
+        return post_id in self.post_ids
 
-    def insert_post(self, post):
+    def insert_post(self, post, blog=None):
         """
         Stores a post in the database.
 
+        The post is buffered and written with the rest of its batch; see insert_posts().
+
         :param post: the post to store
+        :param blog: the URL of the blog the post was crawled from
         :return: None
         """
-        command = u'INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)' % POSTS_TABLE
-        values = (post['id'], post['type'], post['timestamp'], post['date'], post['tags'], post['source_url'],
-                  post['source_title'], post['state'], post['aux'])
-        self.curs.execute(command, values)
-        self.conn.commit()
+        self.insert_posts([post], blog)
+
+    def insert_posts(self, posts, blog=None):
+        """
+        Stores posts in the database.
+
+        Posts are buffered and written batch_size at a time, one transaction per batch. Anything left in the buffer
+        is written by flush(), which is called when the adapter is closed.
+
+        :param posts: an iterable of posts to store
+        :param blog: the URL of the blog the posts were crawled from
+        :return: None
+        """
+        for post in posts:
+            self.pending_posts.append(post_row(post, blog))
+            self.post_ids.add(post['id'])
+            if len(self.pending_posts) >= self.batch_size:
+                self.flush()
+
+    def replace_posts(self, posts, blog=None):
+        """
+        Stores posts in the database, replacing any stored posts with the same ids along with their tags.
+
+        The rows are committed with the next flush().
+
+        :param posts: an iterable of posts to store
+        :param blog: the URL of the blog the posts were crawled from
+        :return: None
+        """
+        if self.pending_posts:  # buffered posts must be written first, so that they are the ones replaced
+            self.flush()
+        rows = [post_row(post, blog) for post in posts]
+        self.curs.executemany(u'DELETE FROM %s WHERE post_id=?' % TAGS_TABLE, ((row[0],) for row in rows))
+        command = u'INSERT OR REPLACE INTO %s (%s, blog) VALUES (%s)' % (POSTS_TABLE, POST_COLUMNS, ', '.join('?' * 10))
+        self.curs.executemany(command, rows)
+        command = u'INSERT OR IGNORE INTO %s VALUES (?, ?)' % TAGS_TABLE
+        self.curs.executemany(command, ((tag, row[0]) for row in rows for tag in split_tags(row[4])))
+        for row in rows:
+            self.post_ids.add(row[0])
+        DB_POSTS_WRITTEN.inc(len(rows))
+
+    def archive_response(self, blog, offset, content):
+        """
+        Stores the raw response to a request for a page of posts, compressed, so that it can be replayed later.
+
+        This may be called from any thread. The response is buffered and written by the next flush().
+
+        :param blog: the URL of the blog the posts were requested from
+        :param offset: the offset the posts were requested from
+        :param content: the response body, as received
+        :return: None
+        """
+        row = (blog, offset, int(time.time()), compress_response(content))
+        with self.responses_lock:
+            self.pending_responses.append(row)
+
+    def get_archived_blogs(self):
+        """
+        Get the blogs with archived responses.
+
+        :return: a list of blog URLs
+        """
+        self.flush()
+        command = u'SELECT DISTINCT blog FROM %s ORDER BY blog' % RESPONSES_TABLE
+        return [blog for (blog,) in self.conn.execute(command)]
+
+    def get_archived_pages(self, blog):
+        """
+        Generates the archived responses for a blog, most recently fetched first.
+
+        Responses are read ARCHIVE_READ_BATCH_SIZE at a time, so the caller may write to and commit the database
+        between them.
+
+        :param blog: the URL of the blog
+        :return: each archived response as a tuple of the offset it was requested from and the response body
+        """
+        self.flush()
+        command = u'SELECT rowid, offset, body FROM %s WHERE blog=? AND rowid<? ORDER BY rowid DESC LIMIT %i' % (
+            RESPONSES_TABLE, ARCHIVE_READ_BATCH_SIZE)
+        last_rowid = self.curs.execute(u'SELECT MAX(rowid) FROM %s' % RESPONSES_TABLE).fetchone()[0]
+        if last_rowid is None:
+            return
+        last_rowid += 1
+        while True:
+            rows = self.conn.execute(command, (blog, last_rowid)).fetchall()
+            if not rows:
+                return
+            for last_rowid, offset, body in rows:
+                yield offset, decompress_response(str(body))
+
+    def migrate_blogs(self):
+        """
+        Adds the blog column to the posts table and indexes it.
+
+        Databases from before the column existed held a single blog, so their posts are assigned to the blog in the
+        most recent metadata.
+
+        :return: None
+        """
+        columns = [column[1] for column in self.curs.execute(u'PRAGMA table_info(%s)' % POSTS_TABLE)]
+        if 'blog' not in columns:
+            logger.info('Adding blogs to posts')
+            self.curs.execute(u'ALTER TABLE %s ADD COLUMN blog TEXT' % POSTS_TABLE)
+            metadata = self.get_metadata()
+            if metadata is not None:
+                self.curs.execute(u'UPDATE %s SET blog=?' % POSTS_TABLE, (metadata[1],))
+        self.curs.execute(u'CREATE INDEX IF NOT EXISTS %s_blog_time ON %s (blog, time)' % (POSTS_TABLE, POSTS_TABLE))
+
+    def migrate_query_indexes(self):
+        """
+        Indexes posts by time, and by type and time, for query_posts().
+
+        :return: None
+        """
+        logger.info('Indexing posts by time and type')
+        self.curs.execute(u'CREATE INDEX IF NOT EXISTS %s_time ON %s (time)' % (POSTS_TABLE, POSTS_TABLE))
+        self.curs.execute(u'CREATE INDEX IF NOT EXISTS %s_type_time ON %s (type, time)' % (POSTS_TABLE, POSTS_TABLE))
+
+    def migrate_fallback_urls(self):
+        """
+        Adds the fallback_url column to the pending images and the download ledger, for images queued before it
+        existed; those are left without a fallback.
+
+        :return: None
+        """
+        for table in [PENDING_IMAGES_TABLE, DOWNLOADS_TABLE]:
+            columns = [column[1] for column in self.curs.execute(u'PRAGMA table_info(%s)' % table)]
+            if 'fallback_url' not in columns:
+                logger.info('Adding fallback URLs to %s', table)
+                self.curs.execute(u'ALTER TABLE %s ADD COLUMN fallback_url TEXT' % table)
+
+    def migrate_aux(self):
+        """
+        Rewrites aux data stored as plain JSON in the compressed format; see encode_aux().
+
+        :return: None
+        """
+        logger.info('Compressing post data')
+        command = u"SELECT id, aux_info FROM %s WHERE typeof(aux_info) = 'text'" % POSTS_TABLE
+        rows = self.conn.execute(command)
+        update = u'UPDATE %s SET aux_info=? WHERE id=?' % POSTS_TABLE
+        while True:
+            batch = [(encode_aux(json.loads(aux_info)), post_id)
+                     for post_id, aux_info in rows.fetchmany(MIGRATION_BATCH_SIZE)]
+            if not batch:
+                break
+            self.curs.executemany(update, batch)
+
+    def get_post_tags(self, post_id):
+        """
+        Get the tags on a post.
+
+        :param post_id: the id of the post
+        :return: a list of tags
+        """
+        self.flush()
+        command = u'SELECT tag FROM %s WHERE post_id=?' % TAGS_TABLE
+        return [tag for (tag,) in self.conn.execute(command, (post_id,))]
+
+    def get_post_ids_with_tag(self, tag):
+        """
+        Get the ids of the posts with a tag. Tags are matched case-insensitively, as on tumblr.
+
+        :param tag: the tag to look for
+        :return: a list of post ids, newest post first
+        """
+        self.flush()
+        command = u'SELECT post_id FROM %s WHERE tag=? ORDER BY post_id DESC' % TAGS_TABLE
+        return [post_id for (post_id,) in self.conn.execute(command, (tag,))]
+
+    def get_posts_with_tag(self, tag, blog=None):
+        """
+        Generates the posts with a tag. Tags are matched case-insensitively, as on tumblr.
+
+        :param tag: the tag to look for
+        :param blog: the URL of the blog to look in; if `None`, every blog
+        :return: each post with the tag as a PostRow, newest post first
+        """
+        self.flush()
+        columns = ', '.join('p.' + column for column in POST_COLUMNS.split(', '))
+        command = u'SELECT %s FROM %s t JOIN %s p ON p.id = t.post_id WHERE t.tag=?' % (columns, TAGS_TABLE,
+                                                                                        POSTS_TABLE)
+        params = (tag,)
+        if blog is not None:
+            command += u' AND p.blog=?'
+            params += (blog,)
+        for post in self.conn.execute(command + u' ORDER BY t.post_id DESC', params):
+            yield PostRow.from_row(post)
+
+    def get_tag_counts(self, limit=None):
+        """
+        Get how many posts each tag is on.
+
+        :param limit: how many of the most used tags to return; if `None`, all of them
+        :return: a list of (tag, count) tuples, most used tag first
+        """
+        self.flush()
+        command = u'SELECT tag, COUNT(*) AS uses FROM %s GROUP BY tag ORDER BY uses DESC, tag' % TAGS_TABLE
+        if limit is not None:
+            command += u' LIMIT %i' % limit
+        return self.conn.execute(command).fetchall()
+
+    def get_image_hashes(self):
+        """
+        Get the content hash of every downloaded image.
+
+        :return: a dict of source URL to content hash
+        """
+        command = u'SELECT url, hash FROM %s' % IMAGES_TABLE
+        return dict(self.conn.execute(command))
+
+    def insert_image_hashes(self, hashes):
+        """
+        Records the content hashes of downloaded images.
+
+        The rows are committed with the next flush().
+
+        :param hashes: an iterable of (source URL, content hash) tuples
+        :return: None
+        """
+        command = u'INSERT OR REPLACE INTO %s VALUES (?, ?)' % IMAGES_TABLE
+        self.curs.executemany(command, hashes)
+
+    def get_checkpoint(self, blog):
+        """
+        Get the checkpoint left by an interrupted crawl of a blog.
+
+        :param blog: the URL for the blog
+        :return: a tuple of the offset to resume from, the number of posts processed so far and the newest post time
+            the crawl started with, or None if there is no unfinished crawl
+        """
+        command = u'SELECT next_offset, processed, newest_post_time FROM %s WHERE blog=?' % CHECKPOINTS_TABLE
+        return self.curs.execute(command, (blog,)).fetchone()
+
+    def save_checkpoint(self, blog, offset, processed, newest_post_time):
+        """
+        Records how far a crawl of a blog has got.
+
+        The checkpoint is buffered and written by the next flush(), in the same transaction as the posts it covers,
+        so it never claims progress that was not stored.
+
+        :param blog: the URL for the blog
+        :param offset: the offset to resume from
+        :param processed: the number of posts processed so far
+        :param newest_post_time: the newest post time the crawl started with; see TumblrRequester.get_blog()
+        :return: None
+        """
+        self.pending_checkpoints[blog] = (blog, offset, processed, newest_post_time)
+
+    def clear_checkpoint(self, blog):
+        """
+        Removes the checkpoint for a blog once its crawl has finished.
+
+        :param blog: the URL for the blog
+        :return: None
+        """
+        self.pending_checkpoints.pop(blog, None)
+        self.curs.execute(u'DELETE FROM %s WHERE blog=?' % CHECKPOINTS_TABLE, (blog,))
+
+    def get_pending_images(self):
+        """
+        Get the image URLs that were queued for download but not finished.
+
+        :return: a list of (URL, fallback URL) tuples; see ImageSink.fallback_url()
+        """
+        command = u'SELECT url, fallback_url FROM %s' % PENDING_IMAGES_TABLE
+        return self.conn.execute(command).fetchall()
+
+    def update_pending_images(self, added, finished):
+        """
+        Records image URLs queued for download and finished, in that order.
+
+        The rows are committed with the next flush().
+
+        :param added: an iterable of (URL, fallback URL) tuples queued, the fallback URL being None if there is none
+        :param finished: an iterable of URLs downloaded or given up on
+        :return: None
+        """
+        added = list(added)
+        self.curs.executemany(u'INSERT OR IGNORE INTO %s VALUES (?, ?)' % PENDING_IMAGES_TABLE, added)
+        self.set_fallback_urls(PENDING_IMAGES_TABLE, added)
+        self.curs.executemany(u'DELETE FROM %s WHERE url=?' % PENDING_IMAGES_TABLE, ((url,) for url in finished))
+
+    def set_fallback_urls(self, table, urls):
+        """
+        Fills in the fallback URL of images queued again with one after first being queued without.
+
+        :param table: the table to update: the pending images or the download ledger
+        :param urls: an iterable of (URL, fallback URL) tuples
+        :return: None
+        """
+        command = u'UPDATE %s SET fallback_url=? WHERE url=? AND fallback_url IS NULL' % table
+        self.curs.executemany(command, ((fallback_url, url) for url, fallback_url in urls if fallback_url is not None))
+
+    def update_download_ledger(self, queued, attempts, skipped=()):
+        """
+        Records image URLs queued for download, and the outcome of attempts to download them, in the download ledger.
+
+        The ledger has a row for every image URL ever queued, with its status, how many times it has been tried, its
+        size once downloaded, the error from the last failed attempt, when it was last tried and how long that took,
+        and the URL to fall back to if it doesn't exist. The rows are committed with the next flush().
+
+        :param queued: an iterable of (URL, fallback URL) tuples queued, the fallback URL being None if there is none
+        :param attempts: an iterable of (status, size in bytes, error, time, seconds, url) tuples, one per attempt, in
+            the order they were made
+        :param skipped: an iterable of URLs found already stored when their download came up, marked downloaded
+            without counting an attempt
+        :return: None
+        """
+        queued = list(queued)
+        attempts = list(attempts)
+        command = u'''INSERT OR IGNORE INTO %s (url, status, attempts, fallback_url)
+                      VALUES (?, ?, 0, ?)''' % DOWNLOADS_TABLE
+        self.curs.executemany(command, ((url, DOWNLOAD_QUEUED, fallback_url) for url, fallback_url in queued))
+        self.curs.executemany(command, ((attempt[-1], DOWNLOAD_QUEUED, None) for attempt in attempts))
+        self.set_fallback_urls(DOWNLOADS_TABLE, queued)
+        command = u'''UPDATE %s SET status=?, attempts=attempts+1, bytes=?, last_error=?, last_attempt=?, seconds=?
+                      WHERE url=?''' % DOWNLOADS_TABLE
+        self.curs.executemany(command, attempts)
+        command = u'UPDATE %s SET status=? WHERE url=?' % DOWNLOADS_TABLE
+        self.curs.executemany(command, ((DOWNLOAD_DONE, url) for url in skipped))
+
+    def get_undownloaded_images(self):
+        """
+        Get the image URLs that have been queued but never stored: those that failed, and those still pending.
+
+        :return: a list of (URL, fallback URL) tuples; see ImageSink.fallback_url()
+        """
+        self.flush()
+        command = u'''SELECT url, MAX(fallback_url) FROM (
+                          SELECT url, fallback_url FROM %s WHERE url NOT IN (SELECT url FROM %s)
+                          UNION ALL SELECT url, fallback_url FROM %s)
+                      GROUP BY url''' % (DOWNLOADS_TABLE, IMAGES_TABLE, PENDING_IMAGES_TABLE)
+        return self.conn.execute(command).fetchall()
+
+    def get_download_counts(self):
+        """
+        Get how many images in the download ledger have each status.
+
+        :return: a dict of status to count
+        """
+        self.flush()
+        command = u'SELECT status, COUNT(*) FROM %s GROUP BY status' % DOWNLOADS_TABLE
+        return dict(self.conn.execute(command))
+
+    def get_render_manifest(self):
+        """
+        Get the digest each post was last rendered with.
+
+        :return: a dict of post id to render digest
+        """
+        command = u'SELECT id, digest FROM %s' % RENDER_MANIFEST_TABLE
+        return dict(self.conn.execute(command))
+
+    def update_render_manifest(self, digests):
+        """
+        Records the digests posts were rendered with.
+
+        The rows are committed with the next flush(). Committing is deliberately left until then, since a commit
+        would reset any get_all_posts() cursor still being read.
+
+        :param digests: an iterable of (post id, render digest) tuples
+        :return: None
+        """
+        command = u'INSERT OR REPLACE INTO %s VALUES (?, ?)' % RENDER_MANIFEST_TABLE
+        self.curs.executemany(command, digests)
+
+    def count_posts(self, blog=None):
+        """
+        Get how many posts are stored in the database.
+
+        :param blog: the URL of the blog to count posts from; if `None`, every blog
+        :return: the number of posts
+        """
+        self.flush()
+        if blog is None:
+            return self.curs.execute(u'SELECT COUNT(*) FROM %s' % POSTS_TABLE).fetchone()[0]
+        return self.curs.execute(u'SELECT COUNT(*) FROM %s WHERE blog=?' % POSTS_TABLE, (blog,)).fetchone()[0]
+
+    def get_posts_by_time(self, blog=None):
+        """
+        Generates the posts stored in the database, newest post first.
+
+        Posts are read from a single cursor as they are consumed, so nothing may commit until the generator is
+        exhausted.
+
+        :param blog: the URL of the blog to generate posts from; if `None`, every blog
+        :return: each post as a PostRow
+        """
+        self.flush()
+        if blog is None:
+            posts = self.conn.execute(u'SELECT %s FROM %s ORDER BY time DESC, id DESC' % (POST_COLUMNS, POSTS_TABLE))
+        else:
+            command = u'SELECT %s FROM %s WHERE blog=? ORDER BY time DESC, id DESC' % (POST_COLUMNS, POSTS_TABLE)
+            posts = self.conn.execute(command, (blog,))
+        for post in posts:
+            yield PostRow.from_row(post)
+
+    def query_posts(self, blog=None, types=None, since=None, until=None, tag=None, state=None, newest_first=False):
+        """
+        Generates the posts matching every filter given, in time order.
+
+        Posts are streamed from a single cursor, QUERY_BATCH_SIZE at a time, so memory use is constant however many
+        posts match; as with get_posts_by_time(), nothing may commit until the generator is exhausted. Filters on
+        time and type are served by the posts_time and posts_type_time indexes, and filters on tag by the tags table.
+
+        :param blog: the URL of the blog to generate posts from; if `None`, every blog
+        :param types: a list of post types to include, eg ['photo', 'text']; if `None`, every type
+        :param since: the earliest post timestamp to include
+        :param until: the timestamp to stop before
+        :param tag: a tag the posts must have, matched case-insensitively
+        :param state: the state the posts must be in, eg 'published'
+        :param newest_first: whether to generate the newest post first rather than the oldest
+        :return: each matching post as a PostRow, including its blog
+        """
+        self.flush()
+        conditions = []
+        params = []
+        if blog is not None:
+            conditions.append(u'blog=?')
+            params.append(blog)
+        if types:
+            conditions.append(u'type IN (%s)' % ', '.join('?' * len(types)))
+            params.extend(types)
+        if since is not None:
+            conditions.append(u'time>=?')
+            params.append(since)
+        if until is not None:
+            conditions.append(u'time<?')
+            params.append(until)
+        if tag is not None:
+            conditions.append(u'id IN (SELECT post_id FROM %s WHERE tag=?)' % TAGS_TABLE)
+            params.append(tag)
+        if state is not None:
+            conditions.append(u'state=?')
+            params.append(state)
+        order = u'DESC' if newest_first else u'ASC'
+        command = u'SELECT %s, blog FROM %s' % (POST_COLUMNS, POSTS_TABLE)
+        if conditions:
+            command += u' WHERE ' + u' AND '.join(conditions)
+        posts = self.conn.execute(command + u' ORDER BY time %s, id %s' % (order, order), params)
+        while True:
+            rows = posts.fetchmany(QUERY_BATCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield PostRow.from_row(row)
 
-    def get_all_posts(self):
+    def get_all_posts(self, blog=None):
         """
         Generates all posts stored in the database.
 
-        :return: each post in the database as a tuple of its columns
+        :param blog: the URL of the blog to generate posts from; if `None`, every blog
+        :return: each post in the database as a PostRow
         """
-        command = u'SELECT * FROM %s' % POSTS_TABLE
-        for post in self.curs.execute(command):
-            yield post
+        self.flush()
+        if blog is None:
+            posts = self.conn.execute(u'SELECT %s FROM %s' % (POST_COLUMNS, POSTS_TABLE))
+        else:
+            posts = self.conn.execute(u'SELECT %s FROM %s WHERE blog=?' % (POST_COLUMNS, POSTS_TABLE), (blog,))
+        for post in posts:
+            yield PostRow.from_row(post)
@@ -0,0 +1,119 @@
+import calendar
+import json
+import logging
+import os.path
+import sys
+import time
+
+from db import split_tags
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+STDOUT_PATH = '-'
+CHUNK_PATTERN = '%s-%05i%s'  # eg posts.jsonl -> posts-00000.jsonl, posts-00001.jsonl, ...
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']
+
+POSTS_EXPORTED = METRICS.counter('posts_exported', 'Posts exported as JSON lines')
+
+
+def parse_time(value):
+    """
+    Parses a time given on the command line, as a Unix timestamp or a UTC date in one of DATE_FORMATS.
+
+    :param value: the time
+    :return: the Unix timestamp
+    """
+    if value.isdigit():
+        return int(value)
+    for date_format in DATE_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(value, date_format))
+        except ValueError:
+            pass
+    raise ValueError('Unrecognised time %s; expected a timestamp or a date like 2015-06-30' % value)
+
+
+def post_record(post):
+    """
+    Converts a post to the dict exported for it.
+
+    :param post: the post as a db.PostRow, including its blog
+    :return: the dict
+    """
+    return {'id': post.id, 'blog': post.blog, 'type': post.type, 'timestamp': post.time, 'date': post.date,
+            'tags': split_tags(post.tags), 'source_url': post.source_url, 'source_title': post.source_title,
+            'state': post.state, 'aux': post.aux}
+
+
+class JsonLinesWriter(object):
+    """
+    Writes records as JSON lines to a file, or to a series of files of at most chunk_size records each
+
+    Chunks are named by numbering the path, eg posts.jsonl is split into posts-00000.jsonl, posts-00001.jsonl, ...
+    Records are written as they come, so memory use does not depend on how many there are.
+    """
+
+    def __init__(self, path, chunk_size=None):
+        """
+        :param path: the file to write to, or '-' for standard output
+        :param chunk_size: the most records to write to each file; if `None`, everything goes in one file
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk = 0
+        self.written = 0  # records written to the current file
+        self.outfile = None
+        self.open_next()
+
+    def write(self, record):
+        if self.chunk_size is not None and self.written >= self.chunk_size:
+            self.open_next()
+        self.outfile.write(json.dumps(record, separators=(',', ':')))
+        self.outfile.write('\n')
+        self.written += 1
+
+    def open_next(self):
+        self.close()
+        if self.path == STDOUT_PATH:
+            self.outfile = sys.stdout
+            return
+        path = self.path
+        if self.chunk_size is not None:
+            root, extension = os.path.splitext(self.path)
+            path = CHUNK_PATTERN % (root, self.chunk, extension)
+            self.chunk += 1
+        logger.info('Writing %s', path)
+        self.outfile = open(path, 'w')
+        self.written = 0
+
+    def close(self):
+        if self.outfile is not None and self.outfile is not sys.stdout:
+            self.outfile.close()
+        self.outfile = None
+
+
+def export_posts(db, path, chunk_size=None, blog=None, **filters):
+    """
+    Streams the posts matching a query to JSON lines files, one post per line, for analysis elsewhere.
+
+    Posts are exported in time order across every blog exported; see DBAdapter.query_posts() for the filters.
+
+    :param db: the DBAdapter to read posts from
+    :param path: the file to write to, or '-' for standard output
+    :param chunk_size: the most posts to write to each file; if `None`, everything goes in one file
+    :param blog: the URL of the blog to export; if `None`, every blog
+    :param filters: further filters for DBAdapter.query_posts()
+    :return: how many posts were exported
+    """
+    writer = JsonLinesWriter(path, chunk_size)
+    exported = 0
+    try:
+        for post in db.query_posts(blog, **filters):
+            writer.write(post_record(post))
+            exported += 1
+            POSTS_EXPORTED.inc()
+    finally:
+        writer.close()
+    logger.info('Exported %i posts', exported)
+    return exported
@@ -0,0 +1,207 @@
+import httplib
+import socket
+import threading
+import urlparse
+import zlib
+
+MAX_CONNECTIONS_PER_HOST = 8
+MAX_REDIRECTS = 5
+TIMEOUT = 60  # seconds
+
+REDIRECT_CODES = [301, 302, 303, 307, 308]
+
+# everything request() may raise when a request fails; ssl.SSLError is a socket.error
+REQUEST_ERRORS = (httplib.HTTPException, socket.error)
+
+
+class ConnectionPool(object):
+    """
+    Keeps HTTP and HTTPS connections alive for reuse, shared between threads
+
+    Each host gets at most max_per_host connections at once; further requests to that host block until a connection
+    is released. Connections are released when their response has been read to the end or closed.
+    """
+
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, timeout=TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}  # (scheme, netloc) -> list of idle connections
+        self.slots = {}  # (scheme, netloc) -> semaphore bounding the connections to that host
+
+    def request(self, url, headers=None, method='GET'):
+        """
+        Issues a request, following redirects.
+
+        :param url: the URL to request
+        :param headers: a dict of headers to send
+        :param method: the HTTP method
+        :return: a PooledResponse, which must be read to the end or closed to release its connection
+        """
+        for _ in xrange(MAX_REDIRECTS + 1):
+            response = self.request_once(url, headers, method)
+            location = response.getheader('location')
+            if response.getcode() not in REDIRECT_CODES or location is None:
+                return response
+            response.read()
+            url = urlparse.urljoin(url, location)
+        raise httplib.HTTPException('Too many redirects fetching %s' % url)
+
+    def request_once(self, url, headers=None, method='GET'):
+        """
+        Issues a single request, without following redirects.
+
+        A request on a reused connection that fails before a response arrives (usually because the server closed
+        the idle connection) is retried once on a fresh connection.
+
+        :param url: the URL to request
+        :param headers: a dict of headers to send
+        :param method: the HTTP method
+        :return: a PooledResponse
+        """
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        self.slot(key).acquire()
+        try:
+            connection, reused = self.checkout(key)
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+            except REQUEST_ERRORS:
+                connection.close()
+                if not reused:
+                    raise
+                connection, reused = self.connect(key), False
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+        except:
+            self.slot(key).release()
+            raise
+        return PooledResponse(self, key, connection, response)
+
+    def slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self.slots[key]
+
+    def checkout(self, key):
+        """
+        Takes an idle connection to a host, or opens a new one.
+
+        :param key: the (scheme, netloc) of the host
+        :return: a tuple of the connection and whether it was reused
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.connect(key), False
+
+    def connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, key, connection, reusable):
+        """
+        Returns a connection to the pool.
+
+        :param key: the (scheme, netloc) of the host
+        :param connection: the connection
+        :param reusable: whether the connection can be kept alive for another request
+        :return: None
+        """
+        if reusable:
+            with self.lock:
+                self.idle.setdefault(key, []).append(connection)
+        else:
+            connection.close()
+        self.slot(key).release()
+
+    def close(self):
+        """
+        Closes all idle connections.
+
+        :return: None
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+class PooledResponse(object):
+    """
+    A response whose connection goes back to its ConnectionPool once the body has been consumed
+
+    gzip-encoded bodies are decompressed transparently.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.released = False
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = None
+
+    def getcode(self):
+        return self.response.status
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        """
+        Reads from the response body.
+
+        :param amt: the most bytes to read; if `None`, the rest of the body
+        :return: the data read; an empty string at the end of the body
+        """
+        while not self.released:
+            try:
+                data = self.response.read(amt)
+            except:
+                self.close()
+                raise
+            if not data or amt is None or self.response.isclosed():
+                self.finish()
+            if self.decompressor is None:
+                return data
+            data = self.decompressor.decompress(data)
+            if self.released:
+                data += self.decompressor.flush()
+            if data:  # a compressed chunk can decompress to nothing; that is not the end of the body
+                return data
+        return ''
+
+    def finish(self):
+        """
+        Releases the connection after the body has been read to the end.
+
+        :return: None
+        """
+        if not self.released:
+            self.released = True
+            self.pool.release(self.key, self.connection, not self.response.will_close)
+
+    def close(self):
+        """
+        Abandons the rest of the body, closing the connection rather than returning it to the pool.
+
+        :return: None
+        """
+        if not self.released:
+            self.released = True
+            self.response.close()
+            self.pool.release(self.key, self.connection, False)
@@ -0,0 +1,199 @@
+import collections
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+IMAGE_QUEUE_SIZE = 10000  # images held in memory before producers wait, or the rest spill to disk
+SPILL_BATCH_SIZE = 1000  # images written to or read from the spill file at a time
+
+IMAGE_QUEUE_SPILLED = METRICS.counter('image_queue_spilled', 'Images spilled from the image queue to disk')
+IMAGE_QUEUE_WAIT_SECONDS = METRICS.histogram('image_queue_wait_seconds',
+                                             'Time the crawler spent waiting for room in the image queue')
+
+
+class SpillFile(object):
+    """
+    A first in, first out store of queue items in a scratch SQLite file
+
+    The file only holds items while they wait; anything that must survive a restart is persisted elsewhere (see
+    DBAdapter.update_pending_images()), so it is written without a journal or syncs and deleted when closed. It is
+    not thread safe; the ImageQueue using it serialises access.
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='bush-viper-queue-', suffix='.sql')
+        os.close(fd)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE items (url TEXT, attempt INTEGER)')
+        self.count = 0
+
+    def push(self, items):
+        self.conn.executemany('INSERT INTO items VALUES (?, ?)', items)
+        self.conn.commit()
+        self.count += len(items)
+
+    def pop(self, limit):
+        """
+        Removes the oldest items from the file.
+
+        :param limit: the most items to remove
+        :return: a list of the items, oldest first
+        """
+        rows = self.conn.execute('SELECT rowid, url, attempt FROM items ORDER BY rowid LIMIT ?', (limit,)).fetchall()
+        if rows:
+            self.conn.execute('DELETE FROM items WHERE rowid <= ?', (rows[-1][0],))
+            self.conn.commit()
+            self.count -= len(rows)
+        return [(url, attempt) for _, url, attempt in rows]
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+
+class ImageQueue(object):
+    """
+    A bounded queue of images to download, as (url, attempt) tuples
+
+    It is used like a Queue.Queue, with task_done() and join(). At most `maxsize` items are held in memory. Once it is
+    full, put() either spills further items to a SpillFile, to be read back in order as the queue drains, or, without
+    spilling, blocks until there is room, holding the producer back to the pace of the downloads. Either way memory
+    use stays flat however far ahead of the downloads the crawl gets.
+
+    Items put back by the pool itself, such as retries, pass block=False so that they never wait on the pool.
+
+    close() stops the queue: anything still queued is dropped and get() returns None from then on, to tell the
+    workers to exit.
+    """
+
+    def __init__(self, maxsize=IMAGE_QUEUE_SIZE, spill=False):
+        """
+        :param maxsize: how many items to hold in memory
+        :param spill: whether to spill items beyond maxsize to disk rather than make producers wait
+        """
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.spill_file = SpillFile() if spill else None
+        self.spill_buffer = []  # items waiting to be written to the spill file, newer than everything in it
+        self.unfinished_tasks = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.all_tasks_done = threading.Condition(self.lock)
+
+    def spilled(self):
+        return (self.spill_file.count if self.spill_file is not None else 0) + len(self.spill_buffer)
+
+    def qsize(self):
+        with self.lock:
+            return len(self.items) + self.spilled()
+
+    def put(self, item, block=True):
+        """
+        Adds an item to the queue.
+
+        :param item: the item
+        :param block: whether to wait for room when the queue is full and not spilling; if not, the item is added
+            regardless
+        :return: None
+        """
+        with self.not_full:
+            if self.closed:
+                return
+            if self.spill_file is not None and (self.spilled() or len(self.items) >= self.maxsize):
+                self.spill_buffer.append(item)
+                IMAGE_QUEUE_SPILLED.inc()
+                if len(self.spill_buffer) >= SPILL_BATCH_SIZE:
+                    self.spill_file.push(self.spill_buffer)
+                    self.spill_buffer = []
+            else:
+                if block and len(self.items) >= self.maxsize:
+                    start = time.time()
+                    while len(self.items) >= self.maxsize and not self.closed:
+                        self.not_full.wait()
+                    IMAGE_QUEUE_WAIT_SECONDS.observe(time.time() - start)
+                    if self.closed:
+                        return
+                self.items.append(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get(self):
+        """
+        Removes the oldest item from the queue, waiting for one if it is empty.
+
+        :return: the item, or None once the queue has been closed
+        """
+        with self.not_empty:
+            while not self.items and not self.closed:
+                if self.spilled():
+                    self.refill()
+                else:
+                    self.not_empty.wait()
+            if self.closed:
+                return None
+            item = self.items.popleft()
+            if self.spilled() and len(self.items) <= self.maxsize // 2:
+                self.refill()
+            self.not_full.notify()
+            return item
+
+    def refill(self):
+        """
+        Moves spilled items back into memory, oldest first, to fill the queue. Called with the lock held.
+
+        :return: None
+        """
+        room = self.maxsize - len(self.items)
+        if self.spill_file.count:
+            self.items.extend(self.spill_file.pop(min(room, SPILL_BATCH_SIZE)))
+        else:
+            self.items.extend(self.spill_buffer[:room])
+            del self.spill_buffer[:room]
+
+    def task_done(self):
+        with self.all_tasks_done:
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks <= 0:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        """
+        Blocks until every item put on the queue has been marked done, or the queue is closed.
+
+        :return: None
+        """
+        with self.all_tasks_done:
+            while self.unfinished_tasks > 0 and not self.closed:
+                self.all_tasks_done.wait()
+
+    def close(self):
+        """
+        Stops the queue, dropping anything still queued and waking everything waiting on it.
+
+        :return: how many items were dropped
+        """
+        with self.lock:
+            if self.closed:
+                return 0
+            dropped = len(self.items) + self.spilled()
+            self.closed = True
+            self.items.clear()
+            self.spill_buffer = []
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+            self.all_tasks_done.notify_all()
+        return dropped
@@ -0,0 +1,331 @@
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import threading
+
+from metrics import METRICS
+from renderer import OUTFILE_FOLDER as POSTS_FOLDER
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16384  # 16 KB, chosen randomly
+
+OUTFILE_FOLDER = 'images'
+OBJECTS_FOLDER = 'objects'
+TEMP_FOLDER = 'tmp'
+PARTIAL_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.validator'
+OBJECT_MODE = 0644  # objects may be served straight from the store, so keep them world readable
+
+IMAGES_STORED = METRICS.counter('images_stored', 'Images downloaded into the store')
+IMAGE_BYTES = METRICS.counter('image_download_bytes', 'Image data downloaded, in bytes')
+
+
+def response_validator(response):
+    """
+    Gets the validator an If-Range header can use to check that a partial download is still of the same image: the
+    response's ETag, unless it is weak (If-Range needs a strong comparison), otherwise its Last-Modified date.
+
+    :param response: the response, with a getheader() method
+    :return: the validator, or None if the response has neither
+    """
+    etag = response.getheader('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.getheader('last-modified')
+
+
+def shard(digest):
+    """
+    Splits a hex digest into a sharded relative path, eg 'abcdef...' -> 'ab/cd/abcdef...'
+
+    :param digest: the hex digest to shard
+    :return: the sharded path
+    """
+    return os.path.join(digest[:2], digest[2:4], digest)
+
+
+def ensure_folder(path):
+    """
+    Creates a folder and any missing parents, tolerating other threads doing the same.
+
+    :param path: the folder to create
+    :return: None
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class ImageStore(object):
+    """
+    A content-addressed store for downloaded images
+
+    Image data is stored once per distinct content, named by its SHA-1 and sharded into subfolders under
+    images/objects/. Each source URL gets a stable alias path, also sharded, derived from the URL alone, which is
+    hard linked to the stored object once the download finishes; this lets URLs be rewritten before the image has
+    been downloaded. An index from source URL to content hash records what has been stored, so nothing needs to
+    look at the filesystem to decide whether a URL has been downloaded.
+    """
+
+    def __init__(self, hashes=None, root=os.path.join(POSTS_FOLDER, OUTFILE_FOLDER)):
+        """
+        :param hashes: a dict of source URL to content hash for images already in the store
+        :param root: the folder to keep the store in
+        """
+        self.root = root
+        self.hashes = dict(hashes) if hashes else {}
+        self.new_hashes = []
+        self.writing = set()  # URLs with an open ImageWriter
+        self.lock = threading.Lock()
+        logger.debug('Checking for %s', self.root)
+        ensure_folder(os.path.join(self.root, OBJECTS_FOLDER))
+        ensure_folder(os.path.join(self.root, TEMP_FOLDER))
+
+    def alias_path(self, url):
+        """
+        Get the path, relative to the store, that an image URL will be available at.
+
+        :param url: the source URL of the image
+        :return: the relative path
+        """
+        extension = os.path.splitext(url.split('?')[0].split('/')[-1])[1]
+        return shard(hashlib.sha1(url).hexdigest()) + extension
+
+    def object_path(self, digest):
+        """
+        Get the absolute path to the stored object with the given content hash.
+
+        :param digest: the hex SHA-1 of the image data
+        :return: the path
+        """
+        return os.path.join(self.root, OBJECTS_FOLDER, shard(digest))
+
+    def is_stored(self, url):
+        """
+        Check whether the image at a URL has already been stored.
+
+        :param url: the source URL of the image
+        :return: whether or not the image has been stored
+        """
+        with self.lock:
+            return url in self.hashes
+
+    def save(self, writer, response):
+        """
+        Streams a response into an ImageWriter and commits it.
+
+        If reading fails the writer is closed with its partial data kept, so the download can be resumed.
+
+        :param writer: the ImageWriter, already started
+        :param response: a file-like object to read the image data from
+        :return: the hex SHA-1 of the image data
+        """
+        try:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+        except:
+            writer.close()
+            raise
+        return writer.commit()
+
+    def open_writer(self, url):
+        """
+        Claims an image URL for writing into the store.
+
+        Only one writer may be open for a URL at a time, since they would share a partial file.
+
+        :param url: the source URL of the image
+        :return: an ImageWriter, or None if another writer is already open for the URL
+        """
+        with self.lock:
+            if url in self.writing:
+                return None
+            self.writing.add(url)
+        return ImageWriter(self, url)
+
+    def add(self, url, digest):
+        """
+        Records that the image at a URL has been stored under the given content hash, and links its alias path.
+
+        :param url: the source URL of the image
+        :param digest: the hex SHA-1 of the stored object
+        :return: None
+        """
+        self.link(url, digest)
+        with self.lock:
+            self.hashes[url] = digest
+            self.new_hashes.append((url, digest))
+        IMAGES_STORED.inc()
+
+    def link(self, url, digest):
+        """
+        Points the alias path for a URL at a stored object.
+
+        Hard links are used where available, falling back to a copy.
+
+        :param url: the source URL of the image
+        :param digest: the hex SHA-1 of the stored object
+        :return: None
+        """
+        alias_path = os.path.join(self.root, self.alias_path(url))
+        if os.path.exists(alias_path):
+            return
+        ensure_folder(os.path.dirname(alias_path))
+        try:
+            os.link(self.object_path(digest), alias_path)
+        except (AttributeError, OSError) as e:  # no os.link on this platform, or linking not supported here
+            if isinstance(e, OSError) and e.errno == errno.EEXIST:  # another thread got there first
+                return
+            shutil.copyfile(self.object_path(digest), alias_path)
+
+    def pop_new_hashes(self):
+        """
+        Get the URL to content hash entries stored since this was last called, to be persisted.
+
+        :return: a list of (url, hash) tuples
+        """
+        with self.lock:
+            new_hashes, self.new_hashes = self.new_hashes, []
+        return new_hashes
+
+
+class ImageWriter(object):
+    """
+    Writes one image into an ImageStore as its data arrives
+
+    Data is written to a partial file named for the source URL in the store's temporary folder while being hashed,
+    then moved into place by commit(), so the store never holds a partially written object. If an object with the
+    same content already exists the new copy is discarded.
+
+    A download that is interrupted leaves its partial file behind, along with the validator of the response it came
+    from; the next writer for the same URL reports its size as `offset`, so the download can be resumed with a Range
+    request whose If-Range asks for the whole image instead if it has changed since. Partial data with no validator
+    cannot be checked, so it is not resumed.
+
+    `size` counts the bytes of the image written so far, including any resumed partial data.
+    """
+
+    def __init__(self, store, url):
+        self.store = store
+        self.url = url
+        self.temp_path = os.path.join(store.root, TEMP_FOLDER, hashlib.sha1(url).hexdigest() + PARTIAL_SUFFIX)
+        self.validator_path = self.temp_path + VALIDATOR_SUFFIX
+        self.validator = None
+        self.offset = 0
+        if os.path.exists(self.temp_path) and os.path.exists(self.validator_path):
+            with open(self.validator_path) as validator_file:
+                self.validator = validator_file.read() or None
+            self.offset = os.path.getsize(self.temp_path) if self.validator else 0
+        self.size = 0
+        self.digest = None
+        self.outfile = None
+
+    def range_headers(self):
+        """
+        Gets the headers to request the rest of the partial download with.
+
+        :return: a dict of the Range and If-Range headers, or an empty dict if there is nothing to resume
+        """
+        if not self.offset:
+            return {}
+        return {'Range': 'bytes=%i-' % self.offset, 'If-Range': self.validator}
+
+    def start(self, resumed, validator=None):
+        """
+        Opens the partial file for writing.
+
+        :param resumed: whether the data to come continues from `offset` (eg the response to a Range request was
+            206 Partial Content); otherwise any partial data is thrown away
+        :param validator: the validator of the response the data comes from, as given by response_validator(), to
+            be kept with the partial file; ignored when resuming, since the response matched the validator kept
+        :return: None
+        """
+        self.digest = hashlib.sha1()
+        if resumed and self.offset:
+            with open(self.temp_path, 'rb') as partial:
+                while True:
+                    data = partial.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.digest.update(data)
+            self.outfile = open(self.temp_path, 'ab')
+        else:
+            self.offset = 0
+            self.outfile = open(self.temp_path, 'wb')
+            self.validator = validator
+            if validator:
+                with open(self.validator_path, 'w') as validator_file:
+                    validator_file.write(validator)
+            elif os.path.exists(self.validator_path):
+                os.remove(self.validator_path)
+        self.size = self.offset
+
+    def write(self, data):
+        self.digest.update(data)
+        self.outfile.write(data)
+        self.size += len(data)
+        IMAGE_BYTES.inc(len(data))
+
+    def commit(self):
+        """
+        Moves the image into the store under its content hash and records it as the image at the writer's URL.
+
+        :return: the hex SHA-1 of the image data
+        """
+        if self.outfile is None:  # an empty image
+            self.start(False)
+        try:
+            self.outfile.close()
+            os.chmod(self.temp_path, OBJECT_MODE)
+            digest = self.digest.hexdigest()
+            object_path = self.store.object_path(digest)
+            if os.path.exists(object_path):
+                os.remove(self.temp_path)
+            else:
+                ensure_folder(os.path.dirname(object_path))
+                os.rename(self.temp_path, object_path)
+            self.remove_validator()
+        except:
+            self.abort()
+            raise
+        self.store.add(self.url, digest)
+        self.release()
+        return digest
+
+    def close(self):
+        """
+        Stops writing, keeping any partial data so that the download can be resumed.
+
+        :return: None
+        """
+        if self.outfile is not None:
+            self.outfile.close()
+        self.release()
+
+    def abort(self):
+        """
+        Stops writing and throws away any partial data.
+
+        :return: None
+        """
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.remove_validator()
+
+    def remove_validator(self):
+        if os.path.exists(self.validator_path):
+            os.remove(self.validator_path)
+
+    def release(self):
+        with self.store.lock:
+            self.store.writing.discard(self.url)
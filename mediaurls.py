@@ -0,0 +1,68 @@
+import collections
+import re
+import threading
+
+# every form tumblr serves media URLs in, eg
+#   http://33.media.tumblr.com/tumblr_abc123_500.gif
+#   https://64.media.tumblr.com/0123abcd/tumblr_inline_xyz_540.png
+#   https://64.media.tumblr.com/0123abcd/4567ef-a1/s640x960/89ab.jpg
+#   https://media.tumblr.com/tumblr_def456_r1_250.gifv
+TUMBLR_MEDIA_REGEX = re.compile(r'''
+    https?://(?P<host>(?:\d+\.)?media\.tumblr\.com)/
+    (?P<path>[\w/-]*?)          # folders and file name
+    (?:_(?P<size>\d+(?:sq)?))?  # legacy size suffix, eg _500 or _75sq
+    \.(?P<extension>jpe?g|png|gifv?|webp|bmp)\b
+''', re.IGNORECASE | re.VERBOSE)
+SIZE_FOLDER_REGEX = re.compile(r'(?<=/)s\d+x\d+(?=/)')  # the size folder of newer URLs, eg /s640x960/
+
+LARGEST_SIZE = '1280'
+LARGEST_AVATAR_SIZE = '512'
+LARGEST_SIZE_FOLDER = 's2048x3072'
+
+
+def largest_media_url(match):
+    """
+    Builds the canonical URL for the largest size of a tumblr media URL.
+
+    The URL is upgraded to https, legacy _NNN sizes to _1280 (_512 for avatars), the size folder of newer URLs to
+    s2048x3072, and .gifv (a page wrapping the GIF) to the .gif itself.
+
+    :param match: a match of TUMBLR_MEDIA_REGEX
+    :return: the canonical URL
+    """
+    path = SIZE_FOLDER_REGEX.sub(LARGEST_SIZE_FOLDER, match.group('path'))
+    if match.group('size') is not None:
+        largest = LARGEST_AVATAR_SIZE if path.rsplit('/', 1)[-1].startswith('avatar_') else LARGEST_SIZE
+        path = '%s_%s' % (path, largest)
+    extension = match.group('extension')
+    if extension.lower() == 'gifv':
+        extension = extension[:3]
+    return 'https://%s/%s.%s' % (match.group('host'), path, extension)
+
+
+class RewriteCache(object):
+    """
+    A bounded map of media URL to the local path it was rewritten to, evicting the least recently used URL when full
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.paths = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            path = self.paths.pop(url, None)
+            if path is not None:
+                self.paths[url] = path  # move it to the most recently used end
+            return path
+
+    def put(self, url, path):
+        with self.lock:
+            self.paths.pop(url, None)
+            self.paths[url] = path
+            if len(self.paths) > self.max_size:
+                self.paths.popitem(last=False)
+
+    def __len__(self):
+        return len(self.paths)
@@ -0,0 +1,242 @@
+import bisect
+import contextlib
+import json
+import os
+import os.path
+import threading
+import time
+
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0]  # seconds
+SUMMARY_QUANTILES = [0.5, 0.9, 0.99]
+METRIC_PREFIX = 'bush_viper_'
+
+
+class Counter(object):
+    """
+    A count that only goes up, eg of requests made or bytes downloaded
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name + '_total', self.value)]
+
+    def summary(self):
+        return self.value
+
+
+class Gauge(object):
+    """
+    A value that goes up and down, eg the length of a queue
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def summary(self):
+        return self.value
+
+
+class Histogram(object):
+    """
+    A distribution of observed values, eg of request latencies, counted into fixed buckets
+
+    Quantiles for the JSON summary are estimated from the buckets, as Prometheus does.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket counts values above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """
+        Observes how long the body of a with statement takes, in seconds.
+
+        :return: a context manager
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by interpolating within the bucket it falls in.
+
+        :param q: the quantile, between 0 and 1
+        :return: the estimate, or None if nothing has been observed
+        """
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.bounds):  # above the last bound, so the best estimate is that bound
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.bounds[-1]
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds + ['+Inf'], counts):
+            cumulative += bucket_count
+            samples.append(('%s_bucket{le="%s"}' % (self.name, bound), cumulative))
+        samples.append((self.name + '_sum', total))
+        samples.append((self.name + '_count', count))
+        return samples
+
+    def summary(self):
+        summary = {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None}
+        for q in SUMMARY_QUANTILES:
+            summary['p%i' % (q * 100)] = self.quantile(q)
+        return summary
+
+
+class MetricsRegistry(object):
+    """
+    Holds every metric, and exports them as a JSON summary or a Prometheus textfile
+
+    Metrics are created on first use, so modules can look them up by name wherever they are needed.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, metric_class, name, description, *args):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, description, *args)
+            metric = self.metrics[name]
+        if not isinstance(metric, metric_class):
+            raise ValueError('Metric %s is a %s, not a %s' % (name, metric.kind, metric_class.kind))
+        return metric
+
+    def counter(self, name, description):
+        return self.get(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self.get(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self.get(Histogram, name, description, buckets)
+
+    def summary(self):
+        """
+        Summarises every metric: counters and gauges by their value, histograms by their count, sum, mean and
+        estimated quantiles.
+
+        :return: a dict of metric name to summary
+        """
+        with self.lock:
+            metrics = self.metrics.values()
+        return dict((metric.name, metric.summary()) for metric in metrics)
+
+    def textfile(self):
+        """
+        Formats every metric in the Prometheus text exposition format.
+
+        :return: the text
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            # a counter's HELP and TYPE name its sample, as prometheus_client writes them
+            name = metric.name + '_total' if metric.kind == 'counter' else metric.name
+            lines.append('# HELP %s%s %s' % (METRIC_PREFIX, name, metric.description))
+            lines.append('# TYPE %s%s %s' % (METRIC_PREFIX, name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('%s%s %r' % (METRIC_PREFIX, sample, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        """
+        Writes the summary of every metric to a file as JSON.
+
+        :param path: the file to write
+        :return: None
+        """
+        write_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def write_textfile(self, path):
+        """
+        Writes every metric to a file in the Prometheus text exposition format, eg for node_exporter's textfile
+        collector. The file is replaced atomically, so a scrape never sees it half written.
+
+        :param path: the file to write; the textfile collector expects a .prom extension
+        :return: None
+        """
+        write_atomically(path, self.textfile())
+
+
+def write_atomically(path, text):
+    """
+    Replaces a file's contents by writing a temporary file alongside it and renaming it into place.
+
+    :param path: the file to write
+    :param text: the contents
+    :return: None
+    """
+    temp_path = '%s.%i.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(text)
+    os.rename(temp_path, path)
+
+
+METRICS = MetricsRegistry()
@@ -0,0 +1,238 @@
+import codecs
+import collections
+import heapq
+import logging
+import threading
+import time
+import Queue
+
+from api import TumblrRequester, API_POST_LIMIT, PIPELINE_DEPTH
+from scheduler import MAX_RETRIES, backoff
+
+logger = logging.getLogger(__name__)
+
+MAX_ACTIVE_BLOGS = 8  # blogs crawled at once; the rest wait their turn
+BLOG_WINDOW = 2  # pages of each blog in flight at once
+
+
+def read_blog_list(path):
+    """
+    Reads a list of blogs to crawl.
+
+    The file lists one blog URL per line; blank lines and lines starting with '#' are skipped.
+
+    :param path: the file to read
+    :return: a list of blog URLs, without duplicates, in the order given
+    """
+    blogs = []
+    with codecs.open(path, encoding='utf-8') as blog_file:
+        for line in blog_file:
+            blog = line.strip()
+            if blog and not blog.startswith('#') and blog not in blogs:
+                blogs.append(blog)
+    return blogs
+
+
+class BlogCrawl(object):
+    """
+    The progress of one blog's crawl within a MultiBlogCrawler
+    """
+
+    def __init__(self, blog, offset, posts_processed, newest_post_time):
+        self.blog = blog
+        self.next_offset = offset  # the offset of the next page to process
+        self.requested_offset = offset  # the offset of the next page to request
+        self.posts_processed = posts_processed
+        self.newest_post_time = newest_post_time
+        self.pages = {}  # offset -> page, for pages that arrived ahead of the one being processed
+        self.in_flight = 0  # pages requested or waiting to be retried
+        self.done = False
+
+
+class MultiBlogCrawler(object):
+    """
+    Crawls many blogs at once over one TumblrRequester, sharing its connection pool and image ThreadPool
+
+    Pages are requested by a shared pool of fetcher threads. Up to max_active blogs are crawled at once, each with at
+    most `window` pages in flight, and they take turns round robin to submit requests as fetchers come free, so every
+    active blog gets an even share of the fetchers however large it is. As a blog finishes, the next one waiting
+    starts.
+
+    Each blog's pages are processed strictly in order with TumblrRequester.process_page(), so duplicate
+    detection, `limit`, incremental mode and checkpointing behave exactly as in get_blog(). Processing happens on the
+    calling thread, which keeps all database access on one thread.
+
+    Failed pages are requested again after the same backoff the ThreadPool's scheduler uses. A blog with a page that
+    still fails after MAX_RETRIES attempts is given up on, keeping its checkpoint for the next run, and a blog that
+    doesn't exist is given up on at once; either way the other blogs carry on.
+    """
+
+    def __init__(self, db, workers=4, max_active=MAX_ACTIVE_BLOGS, window=BLOG_WINDOW, requester=None, archive=False):
+        """
+        :param db: the DBAdapter to store posts in
+        :param workers: how many fetcher threads to run
+        :param max_active: how many blogs to crawl at once
+        :param window: how many pages of each blog may be in flight at once
+        :param requester: the TumblrRequester to crawl with; if `None`, one is created
+        :param archive: whether the requester created should archive raw responses; see TumblrRequester
+        """
+        self.db = db
+        self.workers = workers
+        self.max_active = max_active
+        self.window = window
+        self.requester = requester if requester is not None else TumblrRequester(db, archive=archive)
+
+    def run(self, blogs, limit=None, incremental=False):
+        """
+        Retrieves posts from each of a list of blogs and stores them in the database, downloading their images.
+
+        :param blogs: the URLs of the blogs to retrieve posts from
+        :param limit: how many posts to download from each blog; if `None`, unlimited
+        :param incremental: whether to stop at posts archived by a previous run; see TumblrRequester.get_blog()
+        :return: None
+        """
+        self.limit = limit
+        self.incremental = incremental
+        waiting = collections.deque(blogs)
+        active = collections.deque()  # the blogs being crawled, in the order they take turns
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+        self.in_flight = 0
+        self.retries = []  # heap of (due time, sequence number, crawl, offset, attempt)
+        self.retry_sequence = 0
+        capacity = self.workers * PIPELINE_DEPTH
+
+        threads = [threading.Thread(target=self.fetch_pages) for _ in xrange(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        logger.info('Retrieving %s posts from each of %i blogs', str(limit) if limit is not None else 'unlimited',
+                    len(waiting))
+        try:
+            while True:
+                while waiting and len(active) < self.max_active:
+                    blog = waiting.popleft()
+                    start = self.requester.start_crawl(blog, incremental)
+                    if start is not None:
+                        active.append(BlogCrawl(blog, *start))
+                if not active and not self.in_flight:
+                    break
+
+                self.release_retries()
+                # hand out free fetcher slots one page at a time, to each blog in turn
+                turns_without_request = 0
+                while self.in_flight < capacity and turns_without_request < len(active):
+                    crawl = active[0]
+                    active.rotate(-1)
+                    if crawl.in_flight < self.window:
+                        self.submit(crawl, crawl.requested_offset)
+                        crawl.requested_offset += API_POST_LIMIT
+                        turns_without_request = 0
+                    else:
+                        turns_without_request += 1
+
+                try:
+                    crawl, offset, attempt, page = self.results.get(timeout=self.retry_timeout())
+                except Queue.Empty:  # a retry has come due
+                    continue
+                self.in_flight -= 1
+                crawl.in_flight -= 1
+                if crawl.done:  # a page requested ahead of the end of the blog
+                    continue
+                if page is None:  # failed; try again at the same offset
+                    self.retry(crawl, offset, attempt)
+                    if crawl.done:
+                        active.remove(crawl)
+                    continue
+                crawl.pages[offset] = page
+                self.process_pages(crawl)
+                if crawl.done:
+                    active.remove(crawl)
+        finally:
+            # drop anything not yet picked up, then tell each fetcher to stop
+            try:
+                while True:
+                    self.requests.get_nowait()
+            except Queue.Empty:
+                pass
+            for _ in threads:
+                self.requests.put(None)
+
+        self.requester.threadpool.block_on_queue()
+        self.requester.save_image_progress()
+        self.db.flush()
+
+    def fetch_pages(self):
+        """
+        Fetches requested pages until told to stop. Runs on each fetcher thread.
+
+        :return: None
+        """
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            crawl, offset, attempt = request
+            self.results.put((crawl, offset, attempt, self.requester.get_posts(crawl.blog, offset=offset)))
+
+    def submit(self, crawl, offset, attempt=0):
+        crawl.in_flight += 1
+        self.in_flight += 1
+        self.requests.put((crawl, offset, attempt))
+
+    def retry(self, crawl, offset, attempt):
+        """
+        Schedules a failed page to be requested again after a backoff, or gives up on its blog once the page has
+        failed MAX_RETRIES times.
+
+        :param crawl: the BlogCrawl of the blog
+        :param offset: the offset of the page
+        :param attempt: how many times the page had been requested before the request that failed
+        :return: None
+        """
+        if attempt + 1 >= MAX_RETRIES:
+            logger.error('Giving up on %s: posts %i onwards failed %i times', crawl.blog, offset, attempt + 1)
+            crawl.done = True  # the checkpoint is kept, so the next run resumes here
+            crawl.pages.clear()
+            return
+        crawl.in_flight += 1  # the retry holds its place in the blog's window while it waits
+        heapq.heappush(self.retries, (time.time() + backoff(attempt), self.retry_sequence, crawl, offset, attempt + 1))
+        self.retry_sequence += 1
+
+    def release_retries(self):
+        now = time.time()
+        while self.retries and self.retries[0][0] <= now:
+            _, _, crawl, offset, attempt = heapq.heappop(self.retries)
+            crawl.in_flight -= 1
+            if not crawl.done:
+                self.submit(crawl, offset, attempt)
+
+    def retry_timeout(self):
+        """
+        :return: how long to wait for a page before the next retry comes due, or None if no retries are waiting
+        """
+        if not self.retries:
+            return None
+        return max(0, self.retries[0][0] - time.time())
+
+    def process_pages(self, crawl):
+        """
+        Processes every page of a blog that is ready, in order, stopping the blog's crawl when it is complete.
+
+        :param crawl: the BlogCrawl of the blog
+        :return: None
+        """
+        while not crawl.done and crawl.next_offset in crawl.pages:
+            page = crawl.pages.pop(crawl.next_offset)
+            crawl.posts_processed, done = self.requester.process_page(
+                crawl.blog, page, crawl.next_offset, crawl.posts_processed, crawl.newest_post_time, self.limit,
+                self.incremental)
+            crawl.next_offset += API_POST_LIMIT
+            if done:
+                self.finish(crawl)
+
+    def finish(self, crawl):
+        crawl.done = True
+        crawl.pages.clear()
+        logger.info('Successfully retreived %i posts from %s', crawl.posts_processed, crawl.blog)
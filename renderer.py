@@ -1,51 +1,347 @@
 import codecs
-import json
+import hashlib
+import logging
+import multiprocessing
 import os
 import os.path
+import zipfile
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
 
 HEADER = '<html>\n<head>\n<meta charset="UTF-8">\n<title>%s</title>\n</head>\n<body>\n'
 # TODO: source attribution block for posts with sources
 FOOTER = '\n</body>\n</html>'
 
 OUTFILE_FOLDER = 'posts'
-OUTFILE_PATTERN = os.path.join(OUTFILE_FOLDER, '%i.html')
+OUTFILE_NAME = '%i.html'
+OUTFILE_PATTERN = os.path.join(OUTFILE_FOLDER, OUTFILE_NAME)
+BUNDLE_PATTERN = os.path.join(OUTFILE_FOLDER, '%s.zip')
+
+INDEX_PAGE_SIZE = 50  # posts on each index page of a bundle
+INDEX_ENTRY = '<article id="post-%i">\n%s\n<p><a href="%s">Permalink</a></p>\n</article>\n'
+
+# bump this whenever render_post() changes its output, so that every post is re-rendered on the next run
+TEMPLATE_VERSION = 1
+RENDER_BATCH_SIZE = 2000  # posts handed to the process pool at a time
+RENDER_CHUNK_SIZE = 50  # posts sent to a worker process at a time
+
+POSTS_RENDERED = METRICS.counter('posts_rendered', 'Posts rendered to HTML')
+POSTS_UNCHANGED = METRICS.counter('posts_unchanged', 'Posts skipped by the renderer as already up to date')
+RENDER_BATCH_SECONDS = METRICS.histogram('render_batch_seconds', 'Time taken to render each batch of posts')
+
+
+def render_digest(blog_title, post):
+    """
+    Hashes everything that goes into rendering a post, to tell whether its file is out of date.
+
+    The post's aux data is hashed as stored, without decoding it.
+
+    :param blog_title: the title of the blog
+    :param post: the post as a db.PostRow
+    :return: the hex digest
+    """
+    digest = hashlib.sha1()
+    for part in (TEMPLATE_VERSION, HEADER, FOOTER, blog_title) + tuple(post):
+        digest.update(repr(part))
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def render_post(blog_title, post):
+    """
+    Renders a post to HTML.
+
+    :param blog_title: the title of the blog
+    :param post: the post as a db.PostRow
+    :return: the HTML for the post
+    """
+    return u''.join((HEADER % blog_title, render_body(post), FOOTER))
+
+
+def render_body(post):
+    """
+    Renders the content of a post to HTML, without the page around it.
+
+    :param post: the post as a db.PostRow
+    :return: the HTML for the post's content
+    """
+    post_id, post_type, aux_info = post.id, post.type, post.aux
+    parts = []
+    if post_type == 'text':
+        parts.append('<h2>%s<h2>\n%s' % (aux_info['title'], aux_info['body']))
+    elif post_type == 'photo':
+        for photo in aux_info['photos']:
+            photo_slug = '<img src="%s" width="%ipx" height="%ipx"' % (photo['bv']['url'],
+                                                                       photo['bv']['width'],
+                                                                       photo['bv']['height'])
+            if 'caption' in photo:
+                photo_slug += ' alt="%s" title="%s">\n<p>%s</p>\n' % (photo['caption'], photo['caption'],
+                                                                      photo['caption'])
+            else:
+                photo_slug += '>\n'
+            parts.append(photo_slug)
+        parts.append(aux_info['caption'])
+    else:
+        logger.debug('Skipping %s post %i', post_type, post_id)
+    return u''.join(parts)
+
+
+def write_post(task):
+    """
+    Renders a post and writes it to its output file.
+
+    This is the unit of work for the render process pool, so it takes a single argument.
+
+    :param task: a tuple of the blog title, the post as a db.PostRow, and the post's render digest
+    :return: a tuple of the post id and its render digest
+    """
+    blog_title, post, digest = task
+    post_id, post_type = post[0], post[1]
+    outfile_name = OUTFILE_PATTERN % post_id
+    logger.debug('Dumping %s post %i to %s', post_type, post_id, outfile_name)
+    html = render_post(blog_title, post)
+    with codecs.open(outfile_name, 'w', encoding='utf-8') as outfile:
+        outfile.write(html)
+    return post_id, digest
+
+
+def render_bundled_post(post):
+    """
+    Renders the content of a post for a bundle. This is the unit of work for the render process pool in bundle mode.
+
+    :param post: the post as a db.PostRow
+    :return: a tuple of the post id and the HTML for its content
+    """
+    return post.id, render_body(post)
+
+
+def index_page_name(number):
+    """
+    Get the name of an index page of a bundle; the first page is the bundle's index.html.
+
+    :param number: the page number, counting from 1
+    :return: the name
+    """
+    return 'index.html' if number == 1 else 'page%i.html' % number
+
+
+class BundleWriter(object):
+    """
+    Writes rendered posts into a single zip bundle as they arrive, along with paginated index pages
+
+    Each post gets an entry named as its file would be in the posts folder, with image links unchanged, so the bundle
+    can be extracted into the posts folder in place of rendering a file per post. Posts are also gathered
+    INDEX_PAGE_SIZE at a time onto index pages (index.html, page2.html, ...) linked to each other and to each post.
+    The zip's central directory indexes every entry by offset, so single posts can also be read straight out of the
+    bundle, eg to serve them.
+
+    The bundle is written to a temporary file and moved into place by close(), so an existing bundle is only
+    replaced by a complete one.
+    """
+
+    def __init__(self, path, blog_title, page_count):
+        """
+        :param path: the file to write the bundle to
+        :param blog_title: the title of the blog
+        :param page_count: how many index pages there will be, to link the last one correctly
+        """
+        self.path = path
+        self.temp_path = '%s.%i.tmp' % (path, os.getpid())
+        self.blog_title = blog_title
+        self.page_count = page_count
+        self.page_number = 1
+        self.page = []
+        self.bundle = zipfile.ZipFile(self.temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def write(self, name, body):
+        self.bundle.writestr(name, u''.join((HEADER % self.blog_title, body, FOOTER)).encode('utf-8'))
+
+    def add_post(self, post_id, body):
+        """
+        Adds a post to the bundle and to the current index page. Posts must be added in the order they are to be
+        listed.
+
+        :param post_id: the id of the post
+        :param body: the HTML for the post's content, from render_body()
+        :return: None
+        """
+        self.write(OUTFILE_NAME % post_id, body)
+        self.page.append(INDEX_ENTRY % (post_id, body, OUTFILE_NAME % post_id))
+        if len(self.page) == INDEX_PAGE_SIZE:
+            self.write_page()
+
+    def write_page(self):
+        links = []
+        if self.page_number > 1:
+            links.append('<a href="%s">Newer posts</a>' % index_page_name(self.page_number - 1))
+        if self.page_number < self.page_count:
+            links.append('<a href="%s">Older posts</a>' % index_page_name(self.page_number + 1))
+        self.page.append('<nav>%s</nav>' % ' | '.join(links))
+        self.write(index_page_name(self.page_number), u''.join(self.page))
+        self.page = []
+        self.page_number += 1
+
+    def close(self):
+        """
+        Writes the last index page and moves the finished bundle into place.
+
+        :return: None
+        """
+        if self.page or self.page_number == 1:  # a part-filled last page, or the index of a blog with no posts
+            self.write_page()
+        self.bundle.close()
+        os.rename(self.temp_path, self.path)
+
+    def abort(self):
+        """
+        Stops writing and throws the unfinished bundle away.
+
+        :return: None
+        """
+        self.bundle.close()
+        os.remove(self.temp_path)
 
 
 class Renderer(object):
     """
-    Dumps downloaded posts from the database to HTML files
+    Dumps downloaded posts of a blog from the database to HTML files
     """
 
-    def __init__(self, db):
+    def __init__(self, db, blog=None):
+        """
+        :param db: the DBAdapter to read posts from
+        :param blog: the URL of the blog to render; if `None`, the blog retrieved most recently
+        """
         self.db = db
-        self.blog_title, self.blog_url = self.db.get_metadata()
+        metadata = self.db.get_metadata(blog)
+        if metadata is None:
+            if blog is None or not self.db.count_posts(blog):
+                logger.error('No posts stored for %s; exiting', blog if blog is not None else 'any blog')
+                exit(1)
+            logger.warning('No metadata stored for %s; using its URL as its title', blog)
+            metadata = (blog, blog)
+        self.blog_title, self.blog_url = metadata
+
+    def dump_posts(self, processes=None, force=False, tag=None):
+        """
+        Renders posts to HTML files, skipping any whose output would be unchanged.
+
+        A render manifest in the database records a digest of each post's data and the templates it was last
+        rendered with (see render_digest()); only posts whose digest has changed, or whose file has gone missing, are
+        rendered again. Rendering is spread across a pool of worker processes.
+
+        :param processes: how many worker processes to render with; if `None`, one per CPU
+        :param force: whether to render every post regardless of the manifest
+        :param tag: if given, only render posts with this tag
+        :return: None
+        """
+        logger.debug('Checking for %s', OUTFILE_FOLDER)
+        if not os.path.exists(OUTFILE_FOLDER):
+            logger.error('%s not found; exiting', OUTFILE_FOLDER)
+            exit(1)
+
+        manifest = {} if force else self.db.get_render_manifest()
+        rendered = set() if force else set(os.listdir(OUTFILE_FOLDER))
+        pool = multiprocessing.Pool(processes) if processes != 1 else None
+        posts_rendered = 0
+        posts_skipped = 0
+        if tag is None:
+            posts = self.db.get_all_posts(self.blog_url)
+        else:
+            posts = self.db.get_posts_with_tag(tag, self.blog_url)
+        try:
+            batch = []
+            for post in posts:
+                digest = render_digest(self.blog_title, post)
+                if manifest.get(post[0]) == digest and OUTFILE_NAME % post[0] in rendered:
+                    posts_skipped += 1
+                    POSTS_UNCHANGED.inc()
+                    continue
+                batch.append((self.blog_title, post, digest))
+                if len(batch) >= RENDER_BATCH_SIZE:
+                    posts_rendered += self.write_posts(pool, batch)
+                    batch = []
+            posts_rendered += self.write_posts(pool, batch)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        logger.info('Rendered %i posts; %i were unchanged', posts_rendered, posts_skipped)
 
-    def dump_posts(self):
-        print 'Checking for %s' % OUTFILE_FOLDER
+    def dump_bundle(self, processes=None):
+        """
+        Renders every post into a single zip bundle with paginated index pages, newest post first; see BundleWriter.
+
+        This is an alternative to dump_posts() for blogs too large to keep a file per post. Posts are streamed from
+        the database in time order and rendered RENDER_BATCH_SIZE at a time across a pool of worker processes, so
+        memory use stays flat however large the blog. The whole bundle is rewritten each time, so the render
+        manifest is neither used nor updated.
+
+        :param processes: how many worker processes to render with; if `None`, one per CPU
+        :return: None
+        """
+        logger.debug('Checking for %s', OUTFILE_FOLDER)
         if not os.path.exists(OUTFILE_FOLDER):
-            print '%s not found; exiting' % OUTFILE_FOLDER
+            logger.error('%s not found; exiting', OUTFILE_FOLDER)
             exit(1)
-        for post in self.db.get_all_posts():
-            post_id, post_type, time, date, tags, source_url, source_title, state, aux_info = post
-            aux_info = json.loads(aux_info)
-            outfile_name = OUTFILE_PATTERN % post_id
-            with codecs.open(outfile_name, 'w', encoding='utf-8') as outfile:
-                print 'Dumping %s post %i to %s' % (post_type, post_id, outfile_name)
-                outfile.write(HEADER % self.blog_title)
-                if post_type == 'text':
-                    outfile.write('<h2>%s<h2>\n%s' % (aux_info['title'], aux_info['body']))
-                elif post_type == 'photo':
-                    for photo in aux_info['photos']:
-                        photo_slug = '<img src="%s" width="%ipx" height="%ipx"' % (photo['bv']['url'],
-                                                                                   photo['bv']['width'],
-                                                                                   photo['bv']['height'])
-                        if 'caption' in photo:
-                            photo_slug += ' alt="%s" title="%s">\n<p>%s</p>\n' % (photo['caption'], photo['caption'],
-                                                                                  photo['caption'])
-                        else:
-                            photo_slug += '>\n'
-                        outfile.write(photo_slug)
-                    outfile.write(aux_info['caption'])
-                else:
-                    print 'Skipping %s post %i' % (post_type, post_id)
-                outfile.write(FOOTER)
+
+        path = BUNDLE_PATTERN % self.blog_url
+        post_count = self.db.count_posts(self.blog_url)
+        writer = BundleWriter(path, self.blog_title, max(1, (post_count + INDEX_PAGE_SIZE - 1) // INDEX_PAGE_SIZE))
+        pool = multiprocessing.Pool(processes) if processes != 1 else None
+        try:
+            batch = []
+            for post in self.db.get_posts_by_time(self.blog_url):
+                batch.append(post)
+                if len(batch) >= RENDER_BATCH_SIZE:
+                    self.bundle_posts(pool, writer, batch)
+                    batch = []
+            self.bundle_posts(pool, writer, batch)
+            writer.close()
+        except:
+            writer.abort()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        logger.info('Bundled %i posts into %s', post_count, path)
+
+    def bundle_posts(self, pool, writer, batch):
+        """
+        Renders a batch of posts and adds them to a bundle, in order.
+
+        :param pool: the process pool to render with, or None to render in this process
+        :param writer: the BundleWriter to add the posts to
+        :param batch: a list of posts as db.PostRows
+        :return: None
+        """
+        with RENDER_BATCH_SECONDS.time():
+            if pool is None:
+                rendered = (render_bundled_post(post) for post in batch)
+            else:
+                rendered = pool.imap(render_bundled_post, batch, RENDER_CHUNK_SIZE)
+            for post_id, body in rendered:
+                writer.add_post(post_id, body)
+        POSTS_RENDERED.inc(len(batch))
+
+    def write_posts(self, pool, batch):
+        """
+        Renders a batch of posts and records them in the render manifest.
+
+        :param pool: the process pool to render with, or None to render in this process
+        :param batch: a list of tasks for write_post()
+        :return: how many posts were rendered
+        """
+        with RENDER_BATCH_SECONDS.time():
+            if pool is None:
+                rendered = [write_post(task) for task in batch]
+            else:
+                rendered = list(pool.imap_unordered(write_post, batch, RENDER_CHUNK_SIZE))
+        POSTS_RENDERED.inc(len(rendered))
+        self.db.update_render_manifest(rendered)
+        return len(rendered)
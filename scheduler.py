@@ -0,0 +1,313 @@
+import heapq
+import logging
+import random
+import threading
+import time
+import urlparse
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+HOST_RATE = None  # requests per second allowed to each host; None for no limit until the host throttles us
+HOST_BURST = 10  # requests a host may receive back to back after being idle
+MIN_HOST_RATE = 0.5  # the slowest a throttled host is slowed down to
+RATE_WINDOW = 1.0  # seconds over which an unlimited host's request rate is measured
+
+RETRY_CODES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 5
+BASE_BACKOFF = 1.0  # seconds
+MAX_BACKOFF = 120.0  # seconds
+
+ADJUST_INTERVAL = 5.0  # seconds of results to judge throughput and errors by
+MAX_ERROR_RATE = 0.1  # shrink the pool when more than this fraction of downloads fail
+GROWTH_THRESHOLD = 0.05  # keep growing the pool while throughput improves by at least this fraction
+
+IMAGE_RETRIES = METRICS.counter('image_download_retries', 'Image downloads scheduled to be tried again')
+
+
+def backoff(attempt):
+    """
+    Picks how long to wait before trying a failed request again: exponential backoff with full jitter.
+
+    :param attempt: how many times the request has failed before this failure
+    :return: the delay in seconds
+    """
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket rate limiter
+
+    A bucket without a rate lets every request straight through, measuring the rate they arrive at, until
+    slow_down() is first called. From then on it limits requests, starting from half the rate it measured, and
+    never recovers beyond the measured rate.
+    """
+
+    def __init__(self, rate=HOST_RATE, burst=HOST_BURST):
+        """
+        :param rate: requests per second to allow; if `None`, unlimited until the host throttles us
+        :param burst: requests allowed back to back after being idle
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.window_start = self.updated
+        self.window_requests = 0
+        self.measured_rate = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it.
+
+        :return: None
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.rate is None:
+                    self.measure(now)
+                    return
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def measure(self, now):
+        """
+        Counts a request let through while unlimited, updating the measured rate every RATE_WINDOW seconds. Called
+        with the lock held.
+
+        :param now: the time of the request
+        :return: None
+        """
+        self.window_requests += 1
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW:
+            self.measured_rate = self.window_requests / elapsed
+            self.window_start = now
+            self.window_requests = 0
+
+    def slow_down(self):
+        """
+        Halves the rate, eg after the host has asked us to back off. An unlimited bucket starts limiting from the
+        rate it measured.
+
+        :return: None
+        """
+        with self.lock:
+            if self.rate is None:
+                now = time.time()
+                rate = self.measured_rate
+                if rate is None:  # throttled within the first window
+                    rate = self.window_requests / max(now - self.window_start, RATE_WINDOW)
+                self.max_rate = self.rate = max(MIN_HOST_RATE, rate)
+                self.tokens = 0.0
+                self.updated = now
+            self.rate = max(MIN_HOST_RATE, self.rate / 2)
+
+    def speed_up(self):
+        """
+        Recovers the rate a little after a success, up to the configured rate.
+
+        :return: None
+        """
+        with self.lock:
+            if self.rate is not None:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class DownloadScheduler(object):
+    """
+    Paces, retries and sizes the work done by a ThreadPool
+
+    Requests to each host are rate limited by a TokenBucket. Throttling responses (429) and server errors (5xx) are
+    retried after an exponential backoff with full jitter, honouring Retry-After where given; retries wait on a
+    timer thread rather than tying up a worker. The number of active workers is adjusted every ADJUST_INTERVAL
+    seconds: it grows by one while throughput keeps improving and shrinks by a quarter when the error rate rises
+    above MAX_ERROR_RATE.
+    """
+
+    def __init__(self, queue, threads, min_threads=1, max_threads=20, host_rate=HOST_RATE, on_resize=None):
+        """
+        :param queue: the queue retries are put back on
+        :param threads: how many workers to start with
+        :param min_threads: the fewest workers to shrink to
+        :param max_threads: the most workers to grow to
+        :param host_rate: requests per second allowed to each host; if `None`, unlimited until a host throttles us
+        :param on_resize: called with the new target whenever the number of active workers changes
+        """
+        self.queue = queue
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.host_rate = host_rate
+        self.on_resize = on_resize
+        self.target = min(max(threads, min_threads), max_threads)
+        self.stopped = False
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.active = threading.Condition(self.lock)  # notified when the target changes
+
+        self.window_start = time.time()
+        self.successes = 0
+        self.failures = 0
+        self.last_throughput = None
+
+        self.retries = []  # heap of (due time, sequence number, item)
+        self.retry_sequence = 0
+        self.retries_changed = threading.Condition(threading.Lock())
+        retry_thread = threading.Thread(target=self.release_retries)
+        retry_thread.daemon = True
+        retry_thread.start()
+
+    def throttle(self, url):
+        """
+        Blocks until the rate limit for the URL's host allows another request.
+
+        :param url: the URL about to be requested
+        :return: None
+        """
+        self.bucket(url).acquire()
+
+    def bucket(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.host_rate)
+            return self.buckets[host]
+
+    def wait_until_active(self, id):
+        """
+        Parks a worker while the pool is shrunk below it.
+
+        :param id: the worker's ID number; workers with IDs at or above the target park
+        :return: None
+        """
+        with self.active:
+            while id >= self.target and not self.stopped:
+                self.active.wait()
+
+    def stop(self):
+        """
+        Releases every parked worker, so that they can see the pool is shutting down.
+
+        :return: None
+        """
+        with self.active:
+            self.stopped = True
+            self.active.notify_all()
+
+    def record_success(self, url):
+        self.bucket(url).speed_up()
+        self.record(True)
+
+    def record_failure(self):
+        self.record(False)
+
+    def record(self, success):
+        """
+        Records the outcome of a download, adjusting the number of active workers at the end of each window.
+
+        :param success: whether the download succeeded
+        :return: None
+        """
+        with self.lock:
+            if success:
+                self.successes += 1
+            else:
+                self.failures += 1
+            now = time.time()
+            elapsed = now - self.window_start
+            if elapsed < ADJUST_INTERVAL:
+                return
+            throughput = self.successes / elapsed
+            error_rate = float(self.failures) / (self.successes + self.failures)
+            old_target = self.target
+            if error_rate > MAX_ERROR_RATE:
+                self.target = max(self.min_threads, self.target - max(1, self.target // 4))
+            elif self.last_throughput is None or throughput > self.last_throughput * (1 + GROWTH_THRESHOLD):
+                self.target = min(self.max_threads, self.target + 1)
+            self.last_throughput = throughput
+            self.window_start = now
+            self.successes = 0
+            self.failures = 0
+            target = self.target
+            if target != old_target:
+                logger.info('Adjusting download threads from %i to %i (%.1f images/s, %.0f%% errors)',
+                            old_target, target, throughput, error_rate * 100)
+                self.active.notify_all()
+        if target != old_target and self.on_resize is not None:
+            self.on_resize(target)
+
+    def retry(self, url, attempt, throttled=False, retry_after=None, overloaded=True):
+        """
+        Schedules a failed download to be tried again after a backoff.
+
+        :param url: the URL that failed
+        :param attempt: how many times the URL has been tried already
+        :param throttled: whether the host asked us to slow down, in which case its rate limit is halved
+        :param retry_after: the value of the response's Retry-After header, if any
+        :param overloaded: whether the failure may be down to sending too much at once (throttling, server errors and
+            network errors), in which case it counts towards shrinking the pool
+        :return: whether the download will be retried
+        """
+        if overloaded:
+            self.record_failure()
+        if throttled:
+            self.bucket(url).slow_down()
+        if attempt + 1 >= MAX_RETRIES:
+            logger.warning('Giving up on %s after %i attempts', url, attempt + 1)
+            return False
+        delay = backoff(attempt)
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):  # no Retry-After, or an HTTP date rather than a number of seconds
+            pass
+        logger.info('Retrying %s in %.1f seconds', url, delay)
+        IMAGE_RETRIES.inc()
+        with self.retries_changed:
+            heapq.heappush(self.retries, (time.time() + delay, self.retry_sequence, (url, attempt + 1)))
+            self.retry_sequence += 1
+            self.retries_changed.notify_all()
+        return True
+
+    def release_retries(self):
+        """
+        Puts retries back on the queue as they come due. Runs on its own thread.
+
+        :return: None
+        """
+        with self.retries_changed:
+            while True:
+                if not self.retries:
+                    self.retries_changed.wait()
+                    continue
+                due, _, item = self.retries[0]
+                now = time.time()
+                if due > now:
+                    self.retries_changed.wait(due - now)
+                    continue
+                # put the item on the queue before dropping it from the heap, so it is never counted by neither
+                # don't wait for room in the queue, since the workers may be waiting on this lock to schedule retries
+                self.queue.put(item, block=False)
+                heapq.heappop(self.retries)
+                self.retries_changed.notify_all()
+
+    def wait_for_retries(self):
+        """
+        Blocks until every scheduled retry has been put back on the queue.
+
+        :return: whether there were any retries to wait for
+        """
+        with self.retries_changed:
+            waited = bool(self.retries)
+            while self.retries:
+                self.retries_changed.wait()
+        return waited
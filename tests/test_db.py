@@ -0,0 +1,224 @@
+import json
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from benchmark import BENCHMARK_BLOG, FakeTumblr
+from db import DBAdapter, DOWNLOAD_DONE, DOWNLOAD_FAILED, PostIdSet, POST_ID_SET_MIN_BITS, SCHEMA_VERSION, split_tags
+
+
+def open_db(path):
+    """
+    Opens a database as DBAdapter.__enter__() does, but at the given path rather than in the working directory.
+
+    :param path: the database file
+    :return: the DBAdapter
+    """
+    adapter = DBAdapter()
+    adapter.connect_to_db(path)
+    adapter.create_tables()
+    adapter.migrate()
+    adapter.load_post_ids()
+    return adapter
+
+
+def stored_post(post):
+    """
+    Converts a post as served by FakeTumblr to the form DBAdapter.insert_posts() takes.
+
+    :param post: the post
+    :return: the post, ready to be stored
+    """
+    return dict(post, tags=','.join(post['tags']), source_url=None, source_title=None,
+                aux={'title': post.get('title'), 'body': post.get('body')})
+
+
+def create_original_db(path, posts, blog=None):
+    """
+    Writes a database as the first version of bush-viper did: one blog, with no blog column, tags table or
+    schema version, and aux data stored as plain JSON.
+
+    :param path: the database file
+    :param posts: the posts to store, as taken by DBAdapter.insert_posts()
+    :param blog: the URL of the blog to store metadata for; if `None`, none is stored
+    :return: None
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE metadata (url TEXT, title TEXT, last_update INTEGER)')
+    conn.execute('''CREATE TABLE posts (id INTEGER PRIMARY KEY, type TEXT, time INTEGER, date TEXT, tags TEXT,
+                    source_url TEXT, source_title TEXT, state TEXT, aux_info TEXT)''')
+    if blog is not None:
+        conn.execute('INSERT INTO metadata VALUES (?, ?, ?)', (blog, 'Benchmark', 1))
+    conn.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(post['id'], post['type'], post['timestamp'], post['date'], post['tags'], post['source_url'],
+                       post['source_title'], post['state'], json.dumps(post['aux'])) for post in posts])
+    conn.commit()
+    conn.close()
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'scrape.sql')
+        self.tumblr = FakeTumblr(posts=200, type_mix='text:1')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+class PostIdSetTest(DatabaseTestCase):
+
+    def test_add_and_contains(self):
+        ids = PostIdSet()
+        for post_id in [1, 2, 10 ** 11, 2 ** 62, 123456789012]:
+            self.assertNotIn(post_id, ids)
+            ids.add(post_id)
+            self.assertIn(post_id, ids)
+        ids.add(2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(sorted(ids), [1, 2, 10 ** 11, 123456789012, 2 ** 62])
+
+    def test_grows(self):
+        ids = PostIdSet()
+        post_ids = [self.tumblr.make_post(index)['id'] for index in xrange(5000)]
+        for post_id in post_ids:
+            ids.add(post_id)
+        self.assertEqual(len(ids), 5000)
+        self.assertGreater(ids.bits, POST_ID_SET_MIN_BITS)
+        self.assertLessEqual(len(ids) * 2, len(ids.table))
+        self.assertTrue(all(post_id in ids for post_id in post_ids))
+        self.assertFalse(any(post_id + 5000 in ids for post_id in post_ids))
+
+    def test_presized(self):
+        ids = PostIdSet(expected_size=5000)
+        bits = ids.bits
+        for index in xrange(5000):
+            ids.add(index + 1)
+        self.assertEqual(ids.bits, bits)
+
+    def test_loaded_from_database(self):
+        posts = [stored_post(self.tumblr.make_post(index)) for index in xrange(self.tumblr.posts)]
+        adapter = open_db(self.path)
+        adapter.insert_posts(posts[:150], BENCHMARK_BLOG)
+        self.assertTrue(adapter.post_id_exists(posts[0]['id']))  # known before it is written
+        adapter.disconnect_from_db()
+
+        adapter = open_db(self.path)
+        self.assertEqual(len(adapter.post_ids), 150)
+        self.assertTrue(all(adapter.post_id_exists(post['id']) for post in posts[:150]))
+        self.assertFalse(any(adapter.post_id_exists(post['id']) for post in posts[150:]))
+        adapter.disconnect_from_db()
+
+
+class DownloadLedgerTest(DatabaseTestCase):
+
+    def test_skipped_marked_downloaded(self):
+        adapter = open_db(self.path)
+        self.addCleanup(adapter.disconnect_from_db)
+        adapter.update_download_ledger([('a', None), ('b', None)], [(DOWNLOAD_DONE, 100, None, 1, 0.5, 'a')])
+        adapter.update_download_ledger([], [], skipped=['b'])
+        self.assertEqual(adapter.get_download_counts(), {DOWNLOAD_DONE: 2})
+        self.assertEqual(adapter.curs.execute('SELECT url, attempts, bytes FROM downloads ORDER BY url').fetchall(),
+                         [('a', 1, 100), ('b', 0, None)])
+
+    def test_fallback_urls(self):
+        adapter = open_db(self.path)
+        self.addCleanup(adapter.disconnect_from_db)
+        adapter.update_pending_images([('a_1280', 'a_500'), ('b', None)], [])
+        adapter.update_download_ledger([('a_1280', 'a_500'), ('b', None)], [])
+        adapter.update_download_ledger([('c_1280', None)],
+                                       [(DOWNLOAD_FAILED, None, 'HTTP status 503', 1, 0.5, 'c_1280')])
+        adapter.update_download_ledger([('c_1280', 'c_500')], [])  # queued again, now with its fallback
+        adapter.update_pending_images([], ['a_1280', 'b'])
+        self.assertEqual(adapter.get_pending_images(), [])
+        self.assertEqual(sorted(adapter.get_undownloaded_images()),
+                         [('a_1280', 'a_500'), ('b', None), ('c_1280', 'c_500')])
+
+
+class MigrationTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.posts = [stored_post(self.tumblr.make_post(index)) for index in xrange(self.tumblr.posts)]
+
+    def migrated_db(self, blog=BENCHMARK_BLOG):
+        create_original_db(self.path, self.posts, blog)
+        self.adapter = open_db(self.path)
+        self.addCleanup(self.adapter.disconnect_from_db)
+        return self.adapter
+
+    def test_schema_version(self):
+        create_original_db(self.path, self.posts, BENCHMARK_BLOG)
+        adapter = open_db(self.path)
+        self.assertEqual(adapter.curs.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        adapter.disconnect_from_db()
+        adapter = open_db(self.path)  # migrations run once
+        self.assertEqual(adapter.curs.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+        adapter.disconnect_from_db()
+
+    def test_tags(self):
+        adapter = self.migrated_db()
+        tagged = [post for post in self.posts if post['tags']]
+        self.assertTrue(tagged)
+        tag_counts = {}
+        for post in tagged:
+            for tag in split_tags(post['tags']):
+                tag_counts[tag] = tag_counts.get(tag, 0) + 1
+        self.assertEqual(dict(adapter.get_tag_counts()), tag_counts)
+        tag = split_tags(tagged[0]['tags'])[0]
+        self.assertEqual(sorted(post.id for post in adapter.get_posts_with_tag(tag.upper())),
+                         sorted(post['id'] for post in tagged if tag in split_tags(post['tags'])))
+
+    def test_aux_compression(self):
+        adapter = self.migrated_db()
+        self.assertEqual(adapter.curs.execute("SELECT COUNT(*) FROM posts WHERE typeof(aux_info) != 'blob'")
+                         .fetchone()[0], 0)
+        stored = dict((post.id, post.aux) for post in adapter.get_all_posts())
+        self.assertEqual(stored, dict((post['id'], post['aux']) for post in self.posts))
+
+    def test_blogs(self):
+        adapter = self.migrated_db()
+        self.assertEqual(adapter.get_blogs(), [BENCHMARK_BLOG])
+        self.assertEqual(adapter.count_posts(BENCHMARK_BLOG), len(self.posts))
+        indexes = [row[1] for row in adapter.curs.execute('PRAGMA index_list(posts)')]
+        self.assertIn('posts_blog_time', indexes)
+
+    def test_blogs_without_metadata(self):
+        adapter = self.migrated_db(blog=None)
+        self.assertEqual(adapter.get_blogs(), [])
+        self.assertEqual(adapter.count_posts(), len(self.posts))
+        self.assertEqual(set(post.blog for post in adapter.query_posts()), set([None]))
+
+    def test_fallback_urls(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE pending_images (url TEXT PRIMARY KEY)')
+        conn.execute('''CREATE TABLE downloads (url TEXT PRIMARY KEY, status TEXT, attempts INTEGER, bytes INTEGER,
+                        last_error TEXT, last_attempt INTEGER, seconds REAL)''')
+        conn.execute("INSERT INTO pending_images VALUES ('a')")
+        conn.execute("INSERT INTO downloads VALUES ('b', 'failed', 5, NULL, 'HTTP status 404', 1, 0.5)")
+        conn.commit()
+        conn.close()
+        adapter = self.migrated_db()
+        self.assertEqual(adapter.get_pending_images(), [('a', None)])
+        self.assertEqual(sorted(adapter.get_undownloaded_images()), [('a', None), ('b', None)])
+
+    def test_query_indexes(self):
+        adapter = self.migrated_db()
+        indexes = [row[1] for row in adapter.curs.execute('PRAGMA index_list(posts)')]
+        self.assertIn('posts_time', indexes)
+        self.assertIn('posts_type_time', indexes)
+        times = sorted(post['timestamp'] for post in self.posts)
+        since, until = times[50], times[150]
+        posts = list(adapter.query_posts(BENCHMARK_BLOG, types=['text'], since=since, until=until))
+        self.assertEqual([post.time for post in posts], [time for time in times if since <= time < until])
+        self.assertTrue(all(post.blog == BENCHMARK_BLOG for post in posts))
+        newest = list(adapter.query_posts(newest_first=True))
+        self.assertEqual([post.time for post in newest], times[::-1])
+        self.assertEqual(list(adapter.query_posts(types=['photo'])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
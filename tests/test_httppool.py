@@ -0,0 +1,109 @@
+import httplib
+import json
+import threading
+import unittest
+
+from benchmark import BENCHMARK_BLOG, FakeTumblr
+from httppool import ConnectionPool, MAX_REDIRECTS
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tumblr = FakeTumblr(posts=40)
+        self.tumblr.start()
+        self.pool = ConnectionPool(max_per_host=2, timeout=5)
+        self.connections = []
+        connect = self.pool.connect
+
+        def counting_connect(key):
+            connection = connect(key)
+            self.connections.append(connection)
+            return connection
+        self.pool.connect = counting_connect
+
+    def tearDown(self):
+        self.pool.close()
+        self.tumblr.stop()
+
+    def image_url(self, name='a_500.jpg'):
+        return self.tumblr.media_url + 'media/' + name
+
+    def test_reuses_connections(self):
+        for _ in xrange(5):
+            response = self.pool.request(self.image_url())
+            self.assertEqual(response.getcode(), 200)
+            self.assertEqual(response.read(), self.tumblr.image_data('a_500.jpg'))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_thread_safe_checkout(self):
+        results = []
+
+        def fetch(index):
+            for request in xrange(10):
+                name = '%i_%i_500.jpg' % (index, request)
+                response = self.pool.request(self.image_url(name))
+                results.append(response.read() == self.tumblr.image_data(name))
+        threads = [threading.Thread(target=fetch, args=(index,)) for index in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 80)
+        self.assertLessEqual(len(self.connections), 2)
+        self.assertLessEqual(len(self.pool.idle.values()[0]), 2)
+
+    def test_limits_connections_per_host(self):
+        first = self.pool.request(self.image_url())
+        second = self.pool.request(self.image_url())
+        third_done = threading.Event()
+
+        def third():
+            self.pool.request(self.image_url()).read()
+            third_done.set()
+        thread = threading.Thread(target=third)
+        thread.start()
+        self.assertFalse(third_done.wait(0.3))
+        # other hosts have slots of their own
+        self.assertEqual(self.pool.request(self.tumblr.api_url + 'blog/%s/info' % BENCHMARK_BLOG).getcode(), 200)
+        first.read()
+        self.assertTrue(third_done.wait(5))
+        second.read()
+        thread.join()
+
+    def test_retries_stale_connection(self):
+        self.pool.request(self.image_url()).read()
+        for server in self.tumblr.servers:
+            server.close_connections()
+        response = self.pool.request(self.image_url())
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(response.read(), self.tumblr.image_data('a_500.jpg'))
+        self.assertEqual(len(self.connections), 2)
+
+    def test_follows_redirects(self):
+        response = self.pool.request(self.tumblr.media_url + 'redirect/redirect/media/a_500.jpg')
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(response.read(), self.tumblr.image_data('a_500.jpg'))
+
+    def test_too_many_redirects(self):
+        url = self.tumblr.media_url + 'redirect/' * (MAX_REDIRECTS + 1) + 'media/a_500.jpg'
+        self.assertRaises(httplib.HTTPException, self.pool.request, url)
+
+    def test_decompresses_gzip(self):
+        url = self.tumblr.api_url + 'blog/%s/posts?offset=0&limit=20' % BENCHMARK_BLOG
+        response = self.pool.request(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('content-encoding'), 'gzip')
+        chunks = []
+        while True:
+            chunk = response.read(100)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(len(json.loads(''.join(chunks))['response']['posts']), 20)
+        # the connection went back to the pool once the body was read
+        self.pool.request(self.image_url()).read()
+        self.assertEqual(len(self.connections), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
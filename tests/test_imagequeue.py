@@ -0,0 +1,112 @@
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import imagequeue
+from benchmark import FakeTumblr
+from imagequeue import ImageQueue, SPILL_BATCH_SIZE
+from imagestore import ImageStore
+from threadpool import ThreadPool
+
+
+def drain(queue, count):
+    items = []
+    for _ in xrange(count):
+        items.append(queue.get())
+        queue.task_done()
+    return items
+
+
+class ImageQueueTest(unittest.TestCase):
+
+    def test_spills_in_order(self):
+        queue = ImageQueue(maxsize=10, spill=True)
+        items = [('url%i' % index, 0) for index in xrange(SPILL_BATCH_SIZE * 2 + 25)]
+        for item in items:
+            queue.put(item)
+        self.assertEqual(queue.qsize(), len(items))
+        self.assertEqual(queue.spill_file.count, SPILL_BATCH_SIZE * 2)
+        self.assertEqual(len(queue.spill_buffer), 15)
+        self.assertEqual(drain(queue, len(items)), items)
+        self.assertEqual(queue.qsize(), 0)
+        queue.close()
+
+    def test_interleaved_puts_and_gets_keep_order(self):
+        queue = ImageQueue(maxsize=10, spill=True)
+        expected = []
+        received = []
+        for index in xrange(SPILL_BATCH_SIZE * 3):
+            item = ('url%i' % index, 0)
+            queue.put(item)
+            expected.append(item)
+            if index % 3 == 0:
+                received.extend(drain(queue, 1))
+        received.extend(drain(queue, queue.qsize()))
+        self.assertEqual(received, expected)
+        queue.close()
+
+    def test_retries_keep_their_attempt(self):
+        queue = ImageQueue(maxsize=1, spill=True)
+        queue.put(('a', 0))
+        queue.put(('b', 3), block=False)
+        self.assertEqual(drain(queue, 2), [('a', 0), ('b', 3)])
+        queue.close()
+
+    def test_close_removes_spill_file(self):
+        queue = ImageQueue(maxsize=1, spill=True)
+        for index in xrange(SPILL_BATCH_SIZE + 1):
+            queue.put(('url%i' % index, 0))
+        path = queue.spill_file.path
+        self.assertEqual(queue.close(), SPILL_BATCH_SIZE + 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(queue.get())
+
+    def test_blocks_without_spilling(self):
+        queue = ImageQueue(maxsize=2)
+        queue.put(('a', 0))
+        queue.put(('b', 0))
+        put_done = threading.Event()
+
+        def put():
+            queue.put(('c', 0))
+            put_done.set()
+        thread = threading.Thread(target=put)
+        thread.start()
+        self.assertFalse(put_done.wait(0.2))
+        queue.put(('retry', 1), block=False)  # the pool's own retries never wait
+        self.assertEqual(drain(queue, 1), [('a', 0)])
+        self.assertFalse(put_done.wait(0.2))  # the retry took the room
+        self.assertEqual(drain(queue, 1), [('b', 0)])
+        self.assertTrue(put_done.wait(5))
+        thread.join()
+        self.assertEqual(drain(queue, 2), [('retry', 1), ('c', 0)])
+        queue.close()
+
+
+class SpillingThreadPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tumblr = FakeTumblr(image_size=1000)
+        self.tumblr.start()
+        imagequeue.SPILL_BATCH_SIZE = 10  # so that a few images go through the spill file
+
+    def tearDown(self):
+        imagequeue.SPILL_BATCH_SIZE = SPILL_BATCH_SIZE
+        self.tumblr.stop()
+        shutil.rmtree(self.root)
+
+    def test_downloads_everything_spilled(self):
+        pool = ThreadPool(num_threads=2, store=ImageStore(root=self.root), queue_size=5, spill=True)
+        urls = [self.tumblr.media_url + 'media/%i_500.jpg' % index for index in xrange(100)]
+        for url in urls:
+            pool.insert(url)
+        self.assertGreater(pool.queue.spilled(), 0)
+        pool.close()
+        self.assertTrue(all(pool.store.is_stored(url) for url in urls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from mediaurls import TUMBLR_MEDIA_REGEX, largest_media_url
+
+# (text, the URL matched, host, path, size, extension)
+MATCHES = [
+    ('http://33.media.tumblr.com/tumblr_abc123_500.gif',
+     'http://33.media.tumblr.com/tumblr_abc123_500.gif', '33.media.tumblr.com', 'tumblr_abc123', '500', 'gif'),
+    ('https://64.media.tumblr.com/0123abcd/tumblr_inline_xyz_540.png',
+     'https://64.media.tumblr.com/0123abcd/tumblr_inline_xyz_540.png', '64.media.tumblr.com',
+     '0123abcd/tumblr_inline_xyz', '540', 'png'),
+    ('https://64.media.tumblr.com/0123abcd/4567ef-a1/s640x960/89ab.jpg',
+     'https://64.media.tumblr.com/0123abcd/4567ef-a1/s640x960/89ab.jpg', '64.media.tumblr.com',
+     '0123abcd/4567ef-a1/s640x960/89ab', None, 'jpg'),
+    ('https://media.tumblr.com/tumblr_def456_r1_250.gifv',
+     'https://media.tumblr.com/tumblr_def456_r1_250.gifv', 'media.tumblr.com', 'tumblr_def456_r1', '250', 'gifv'),
+    ('http://38.media.tumblr.com/tumblr_abc_75sq.JPG',
+     'http://38.media.tumblr.com/tumblr_abc_75sq.JPG', '38.media.tumblr.com', 'tumblr_abc', '75sq', 'JPG'),
+    ('https://media.tumblr.com/tumblr_xyz.jpeg',
+     'https://media.tumblr.com/tumblr_xyz.jpeg', 'media.tumblr.com', 'tumblr_xyz', None, 'jpeg'),
+    ('https://media.tumblr.com/tumblr_xyz_1280.webp?x=1',
+     'https://media.tumblr.com/tumblr_xyz_1280.webp', 'media.tumblr.com', 'tumblr_xyz', '1280', 'webp'),
+    ('<img src="http://24.media.tumblr.com/tumblr_q_400.png" srcset="a">',
+     'http://24.media.tumblr.com/tumblr_q_400.png', '24.media.tumblr.com', 'tumblr_q', '400', 'png'),
+]
+
+NON_MATCHES = [
+    'https://example.com/tumblr_abc_500.jpg',
+    'https://media.tumblr.com/tumblr_abc_500.txt',
+    'https://notmedia.tumblr.com/tumblr_abc_500.jpg',
+]
+
+# (URL, the URL of its largest size)
+UPGRADES = [
+    ('http://33.media.tumblr.com/tumblr_abc123_500.gif', 'https://33.media.tumblr.com/tumblr_abc123_1280.gif'),
+    ('https://64.media.tumblr.com/0123abcd/tumblr_inline_xyz_540.png',
+     'https://64.media.tumblr.com/0123abcd/tumblr_inline_xyz_1280.png'),
+    ('https://64.media.tumblr.com/0123abcd/4567ef-a1/s640x960/89ab.jpg',
+     'https://64.media.tumblr.com/0123abcd/4567ef-a1/s2048x3072/89ab.jpg'),
+    ('https://media.tumblr.com/tumblr_def456_r1_250.gifv', 'https://media.tumblr.com/tumblr_def456_r1_1280.gif'),
+    ('https://66.media.tumblr.com/avatar_0a1b2c_64.png', 'https://66.media.tumblr.com/avatar_0a1b2c_512.png'),
+    ('http://38.media.tumblr.com/tumblr_abc_75sq.JPG', 'https://38.media.tumblr.com/tumblr_abc_1280.JPG'),
+    ('https://media.tumblr.com/tumblr_xyz.jpeg', 'https://media.tumblr.com/tumblr_xyz.jpeg'),
+    ('https://64.media.tumblr.com/abc/s2048x3072/def.bmp', 'https://64.media.tumblr.com/abc/s2048x3072/def.bmp'),
+    ('https://media.tumblr.com/tumblr_xyz_1280.png', 'https://media.tumblr.com/tumblr_xyz_1280.png'),
+]
+
+
+class TumblrMediaRegexTest(unittest.TestCase):
+
+    def test_matches(self):
+        for text, url, host, path, size, extension in MATCHES:
+            match = TUMBLR_MEDIA_REGEX.search(text)
+            self.assertIsNotNone(match, text)
+            self.assertEqual((match.group(0), match.group('host'), match.group('path'), match.group('size'),
+                              match.group('extension')), (url, host, path, size, extension), text)
+
+    def test_non_matches(self):
+        for text in NON_MATCHES:
+            self.assertIsNone(TUMBLR_MEDIA_REGEX.search(text), text)
+
+
+class LargestMediaUrlTest(unittest.TestCase):
+
+    def test_upgrades(self):
+        for url, largest in UPGRADES:
+            self.assertEqual(largest_media_url(TUMBLR_MEDIA_REGEX.search(url)), largest, url)
+
+    def test_largest_is_unchanged(self):
+        for _, largest in UPGRADES:
+            self.assertEqual(largest_media_url(TUMBLR_MEDIA_REGEX.search(largest)), largest, largest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from metrics import MetricsRegistry
+
+
+class TextfileTest(unittest.TestCase):
+
+    def test_counter_family_is_named_after_its_sample(self):
+        registry = MetricsRegistry()
+        registry.counter('requests', 'Requests made').inc(3)
+        registry.gauge('queue_length', 'Images queued').set(2)
+        self.assertEqual(registry.textfile().splitlines(), [
+            '# HELP bush_viper_queue_length Images queued',
+            '# TYPE bush_viper_queue_length gauge',
+            'bush_viper_queue_length 2',
+            '# HELP bush_viper_requests_total Requests made',
+            '# TYPE bush_viper_requests_total counter',
+            'bush_viper_requests_total 3',
+        ])
+
+    def test_histogram_family_keeps_its_name(self):
+        registry = MetricsRegistry()
+        registry.histogram('latency', 'Request latency', buckets=[1.0]).observe(0.5)
+        self.assertEqual(registry.textfile().splitlines(), [
+            '# HELP bush_viper_latency Request latency',
+            '# TYPE bush_viper_latency histogram',
+            'bush_viper_latency_bucket{le="1.0"} 1',
+            'bush_viper_latency_bucket{le="+Inf"} 1',
+            'bush_viper_latency_sum 0.5',
+            'bush_viper_latency_count 1',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
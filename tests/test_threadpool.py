@@ -0,0 +1,171 @@
+import hashlib
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from benchmark import FakeTumblr
+from db import DOWNLOAD_DONE, DOWNLOAD_FAILED
+from imagestore import ImageStore, ImageWriter
+from threadpool import ImageSink, PendingImageSink, ThreadPool
+
+
+class RecordingSink(ImageSink):
+
+    def __init__(self, store):
+        ImageSink.__init__(self, store)
+        self.inserted = []
+
+    def insert(self, url):
+        self.track(url)
+        self.inserted.append(url)
+
+
+class ImageSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sink = RecordingSink(ImageStore(root=self.root))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_replace_urls_keeps_fallback(self):
+        original = 'http://33.media.tumblr.com/tumblr_abc123_500.gif'
+        self.sink.replace_urls('<img src="%s">' % original)
+        self.assertEqual(self.sink.inserted, ['https://33.media.tumblr.com/tumblr_abc123_1280.gif'])
+        self.assertEqual(self.sink.fallback_url(self.sink.inserted[0]), original)
+        self.sink.finished(self.sink.inserted[0])
+        self.assertIsNone(self.sink.fallback_url(self.sink.inserted[0]))
+
+    def test_mixed_case_host(self):
+        text = self.sink.replace_urls('<img src="http://33.Media.Tumblr.com/tumblr_abc123_500.gif">')
+        self.assertEqual(len(self.sink.inserted), 1)
+        self.assertNotIn('Tumblr.com', text)
+
+    def test_no_fallback_for_largest(self):
+        largest = 'https://33.media.tumblr.com/tumblr_abc123_1280.gif'
+        self.sink.replace_urls('<img src="%s">' % largest)
+        self.assertEqual(self.sink.inserted, [largest])
+        self.assertIsNone(self.sink.fallback_url(largest))
+
+    def test_fallback_is_persisted(self):
+        sink = PendingImageSink(self.sink.store)
+        original = 'http://33.media.tumblr.com/tumblr_abc123_500.gif'
+        sink.replace_urls('<img src="%s">' % original)
+        self.assertEqual(sink.pop_pending_changes(),
+                         ([('https://33.media.tumblr.com/tumblr_abc123_1280.gif', original)], []))
+        self.assertEqual(sink.fallbacks, {})
+
+    def test_sizes_share_a_download(self):
+        self.sink.replace_urls('<img src="https://33.media.tumblr.com/tumblr_abc123_500.gif" '
+                               'srcset="https://33.media.tumblr.com/tumblr_abc123_250.gif 250w">')
+        self.assertEqual(self.sink.inserted, ['https://33.media.tumblr.com/tumblr_abc123_1280.gif'])
+
+
+class FallbackDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tumblr = FakeTumblr()
+        self.tumblr.start()
+        self.pool = ThreadPool(num_threads=2, store=ImageStore(root=self.root))
+
+    def tearDown(self):
+        self.pool.close(drain=False)
+        self.tumblr.stop()
+        shutil.rmtree(self.root)
+
+    def test_falls_back_on_not_found(self):
+        upgraded = self.tumblr.media_url + 'missing/a_1280.jpg'
+        self.pool.rewrite_and_download_url(upgraded, fallback_url=self.tumblr.media_url + 'media/a_500.jpg')
+        self.pool.block_on_queue()
+        self.assertTrue(self.pool.store.is_stored(upgraded))
+        self.assertEqual([attempt[0] for attempt in self.pool.pop_attempts()], [DOWNLOAD_DONE])
+
+    def test_requeued_with_fallback(self):
+        upgraded = self.tumblr.media_url + 'missing/e_1280.jpg'
+        self.pool.insert_with_fallback(upgraded, self.tumblr.media_url + 'media/e_500.jpg')
+        self.pool.block_on_queue()
+        self.assertTrue(self.pool.store.is_stored(upgraded))
+
+    def test_fallback_is_not_resumed(self):
+        upgraded = self.tumblr.media_url + 'missing/d_1280.jpg'
+        data = self.tumblr.image_data('d_500.jpg')
+        writer = ImageWriter(self.pool.store, upgraded)
+        with open(writer.temp_path, 'wb') as partial:
+            partial.write('x' * 100)
+        with open(writer.validator_path, 'w') as validator_file:
+            validator_file.write('"%s"' % hashlib.sha1(data).hexdigest())
+        self.pool.rewrite_and_download_url(upgraded, fallback_url=self.tumblr.media_url + 'media/d_500.jpg')
+        self.pool.block_on_queue()
+        with open(self.pool.store.object_path(self.pool.store.hashes[upgraded]), 'rb') as stored:
+            self.assertEqual(stored.read(), data)
+
+    def test_already_stored_is_skipped(self):
+        url = self.tumblr.media_url + 'media/c_500.jpg'
+        self.pool.insert(url)
+        self.pool.block_on_queue()
+        self.pool.insert(url)
+        self.pool.block_on_queue()
+        self.assertEqual([attempt[0] for attempt in self.pool.pop_attempts()], [DOWNLOAD_DONE])
+        self.assertEqual(self.pool.pop_skipped(), [url])
+
+    def test_fails_without_fallback(self):
+        url = self.tumblr.media_url + 'missing/b.jpg'
+        self.pool.rewrite_and_download_url(url)
+        self.pool.block_on_queue()
+        self.assertFalse(self.pool.store.is_stored(url))
+        self.assertEqual([attempt[0] for attempt in self.pool.pop_attempts()], [DOWNLOAD_FAILED])
+
+
+class ResumedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tumblr = FakeTumblr()
+        self.tumblr.start()
+        self.pool = ThreadPool(num_threads=1, store=ImageStore(root=self.root))
+        self.url = self.tumblr.media_url + 'media/a_500.jpg'
+        self.data = self.tumblr.image_data('a_500.jpg')
+
+    def tearDown(self):
+        self.pool.close(drain=False)
+        self.tumblr.stop()
+        shutil.rmtree(self.root)
+
+    def leave_partial(self, data, validator):
+        writer = ImageWriter(self.pool.store, self.url)
+        with open(writer.temp_path, 'wb') as partial:
+            partial.write(data)
+        if validator is not None:
+            with open(writer.validator_path, 'w') as validator_file:
+                validator_file.write(validator)
+        return writer
+
+    def download(self):
+        self.pool.rewrite_and_download_url(self.url)
+        self.pool.block_on_queue()
+        with open(self.pool.store.object_path(self.pool.store.hashes[self.url]), 'rb') as stored:
+            return stored.read()
+
+    def test_resumes_unchanged_image(self):
+        writer = self.leave_partial(self.data[:100], '"%s"' % hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(self.tumblr.stats['media_bytes'], len(self.data) - 100)
+        self.assertFalse(os.path.exists(writer.validator_path))
+
+    def test_restarts_changed_image(self):
+        writer = self.leave_partial('x' * 100, '"stale"')
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(self.tumblr.stats['media_bytes'], len(self.data))
+        self.assertFalse(os.path.exists(writer.validator_path))
+
+    def test_restarts_without_validator(self):
+        self.leave_partial('x' * 100, None)
+        self.assertEqual(self.download(), self.data)
+        self.assertEqual(self.tumblr.stats['media_bytes'], len(self.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
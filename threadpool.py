@@ -1,46 +1,129 @@
-import os
+import logging
 import os.path
-import re
 import threading
-import urllib2
-import Queue
+import time
 
-from renderer import OUTFILE_FOLDER as POSTS_FOLDER
+from db import DOWNLOAD_DONE, DOWNLOAD_FAILED, DOWNLOAD_RETRYING
+from httppool import ConnectionPool, REQUEST_ERRORS
+from imagequeue import ImageQueue, IMAGE_QUEUE_SIZE
+from imagestore import ImageStore, OUTFILE_FOLDER, response_validator
+from mediaurls import RewriteCache, TUMBLR_MEDIA_REGEX, largest_media_url
+from metrics import METRICS
+from scheduler import DownloadScheduler, HOST_RATE, RETRY_CODES
 
-CHUNK_SIZE = 16384  # 16 KB, chosen randomly
+logger = logging.getLogger(__name__)
 
-OUTFILE_FOLDER = 'images'
-OUTFILE_PATTERN = os.path.join(POSTS_FOLDER, OUTFILE_FOLDER, '%s')
+TUMBLR_MEDIA_HOST = 'media.tumblr.com'
+REWRITE_CACHE_SIZE = 100000  # URLs whose local path is remembered
+FALLBACK_CODES = [403, 404]  # statuses on which an upgraded image URL is swapped for the URL it was found at
 
-TUMBLR_IMAGE_REGEX = r'https://\d+\.media\.tumblr\.com/\w+/\w+\.\w{3}'
+IMAGE_QUEUE_DEPTH = METRICS.gauge('image_queue_depth', 'Images waiting to be downloaded')
+IMAGE_DOWNLOAD_SECONDS = METRICS.histogram('image_download_seconds', 'Time taken to download each image')
+IMAGE_FAILURES = METRICS.counter('image_download_failures', 'Images given up on')
+REWRITE_CACHE_HITS = METRICS.counter('url_rewrite_cache_hits', 'Image URLs rewritten from the rewrite cache')
 
 
-class ThreadPool(object):
+class ImageSink(object):
     """
-    Manages and coordinates between a pool of threads for downloading images
+    Receives the image URLs found in posts, rewriting them to point at local copies and queueing them for download
+
+    Subclasses provide an insert() method that queues a URL, calling track() for it, call attempted() with the
+    outcome of every attempt to download it, and call finished() once it has been downloaded or given up on. The URLs
+    still pending can then be persisted, so that they can be queued again if the crawl is interrupted, and the
+    attempts recorded in the download ledger.
+
+    Rewritten URLs are remembered in a RewriteCache, so a URL that turns up again, as images reblogged across many
+    posts do, is rewritten without being queued again.
+
+    Not every image exists at the largest size it is upgraded to, so until an upgraded URL has finished the URL it
+    was found at is kept as its fallback; see fallback_url(). The fallback is persisted along with the URL, so that
+    an image queued again by a later run can still fall back; see insert_with_fallback().
     """
 
-    def __init__(self, num_threads=5):
-        print 'Checking for %s' % POSTS_FOLDER
-        if not os.path.exists(POSTS_FOLDER):
-            print 'Creating %s' % POSTS_FOLDER
-            os.mkdir(POSTS_FOLDER)
-        print 'Checking for %s' % OUTFILE_FOLDER
-        if not os.path.exists(os.path.join(POSTS_FOLDER, OUTFILE_FOLDER)):
-            print 'Creating %s' % OUTFILE_FOLDER
-            os.mkdir(os.path.join(POSTS_FOLDER, OUTFILE_FOLDER))
-        self.queue = Queue.Queue()
-        self.threads = []
-        for x in xrange(0, num_threads):
-            print 'Created thread'
-            self.threads.append(threading.Thread(target=download_images, kwargs={'queue': self.queue, 'id': x}))
-        for thread in self.threads:
-            thread.daemon = True  # daemonize child threads so they die with the parent
-            thread.start()
-            print 'Started thread'
+    def __init__(self, store, cache_size=REWRITE_CACHE_SIZE):
+        self.store = store
+        self.rewrites = RewriteCache(cache_size)
+        self.pending_lock = threading.Lock()
+        self.added = []
+        self.done = []
+        self.attempts = []
+        self.skipped = []
+        self.fallbacks = {}  # upgraded URL -> the URL it was found at, for URLs not yet finished
+
+    def track(self, url):
+        with self.pending_lock:
+            self.added.append((url, self.fallbacks.get(url)))
+
+    def finished(self, url):
+        with self.pending_lock:
+            self.done.append(url)
+            self.fallbacks.pop(url, None)
+
+    def fallback_url(self, url):
+        """
+        Get the URL to download an image from instead if its URL fails with one of FALLBACK_CODES.
+
+        :param url: the URL of the image, as queued
+        :return: the URL the image was found at before its size was upgraded, or None if it was not upgraded
+        """
+        with self.pending_lock:
+            return self.fallbacks.get(url)
+
+    def attempted(self, url, status, size=None, error=None, seconds=None):
+        """
+        Records the outcome of an attempt to download an image, for the download ledger.
+
+        :param url: the URL of the image
+        :param status: the image's status after the attempt: DOWNLOAD_DONE, DOWNLOAD_RETRYING or DOWNLOAD_FAILED
+        :param size: the size of the image in bytes, if it was downloaded
+        :param error: why the attempt failed, if it did
+        :param seconds: how long the attempt took
+        :return: None
+        """
+        with self.pending_lock:
+            self.attempts.append((status, size, error, int(time.time()), seconds, url))
+
+    def already_stored(self, url):
+        """
+        Records that an image came up for download already stored, eg because it was queued twice, so that the
+        download ledger marks it downloaded without counting an attempt.
+
+        :param url: the URL of the image
+        :return: None
+        """
+        with self.pending_lock:
+            self.skipped.append(url)
+
+    def pop_pending_changes(self):
+        """
+        Get the URLs queued and finished since this was last called, to be persisted.
+
+        :return: a tuple of the list of (URL, fallback URL) tuples queued and the list of URLs finished
+        """
+        with self.pending_lock:
+            added, self.added = self.added, []
+            done, self.done = self.done, []
+        return added, done
 
-    def __del__(self):
-        self.block_on_queue()
+    def pop_attempts(self):
+        """
+        Get the download attempts recorded since this was last called, to be persisted.
+
+        :return: a list of tuples for DBAdapter.update_download_ledger()
+        """
+        with self.pending_lock:
+            attempts, self.attempts = self.attempts, []
+        return attempts
+
+    def pop_skipped(self):
+        """
+        Get the URLs found already stored since this was last called, to be persisted; see already_stored().
+
+        :return: a list of URLs
+        """
+        with self.pending_lock:
+            skipped, self.skipped = self.skipped, []
+        return skipped
 
     def insert(self, url):
         """
@@ -49,32 +132,149 @@ class ThreadPool(object):
         :param url: the URL to download
         :return: None
         """
-        self.queue.put(url)
+        raise NotImplementedError
+
+    def insert_with_fallback(self, url, fallback_url=None):
+        """
+        Adds a URL to the queue to be downloaded, with the URL to download the image from instead if it turns out not
+        to exist; see fallback_url(). Images queued again from the pending images or the download ledger keep the
+        fallback they were first queued with this way.
+
+        :param url: the URL to download
+        :param fallback_url: the URL to fall back to, or None if there is none
+        :return: None
+        """
+        if fallback_url is not None and fallback_url != url:
+            with self.pending_lock:
+                self.fallbacks[url] = fallback_url
+        self.insert(url)
+
+    def close(self, drain=True):
+        """
+        Shuts the sink down. Sinks that download images themselves stop doing so here.
+
+        :param drain: whether to download everything queued first
+        :return: None
+        """
+        pass
 
-    def rewrite_and_download_url(self, url):
+    def rewrite_and_download_url(self, url, fallback_url=None):
         """
         Rewrites a URL that points to an external image to point to a bush-viper-downloaded local image and downloads the image
 
+        The rewritten URL is the image's alias path in the ImageStore, which is final even before the download
+        finishes. Images already stored, or rewritten before, are not queued again.
+
         :param url: the URL to rewrite and download
+        :param fallback_url: the URL to download the image from instead if url turns out not to exist
         :return: the rewritten URL
         """
 
-        new_url = os.path.join(OUTFILE_FOLDER, url.split('/')[-1])
-        self.insert(url)
-        print 'Rewrote %s to %s' % (url, new_url)
+        new_url = self.rewrites.get(url)
+        if new_url is not None:
+            REWRITE_CACHE_HITS.inc()
+            return new_url
+        new_url = os.path.join(OUTFILE_FOLDER, self.store.alias_path(url))
+        if not self.store.is_stored(url):
+            self.insert_with_fallback(url, fallback_url)
+        self.rewrites.put(url, new_url)
+        logger.debug('Rewrote %s to %s', url, new_url)
         return new_url
 
     def replace_urls(self, text):
         """
         Finds URLs of images hosted on tumblr and replaces them with local URLs
 
+        The text is scanned once for media URLs in any of the forms tumblr uses, including each candidate of a srcset.
+        Every size of an image is upgraded to the largest, so they all share one download and one local copy, with
+        the URL as found kept as the fallback in case the largest size doesn't exist.
+
         :param text: the text to replace URLs in
         :return: the text, with tumblr image URLs rewritten
         """
 
+        if not text or TUMBLR_MEDIA_HOST not in text.lower():  # most text has no images, so skip the regex
+            return text
+
         def handle_url(matched_url):
-            return self.rewrite_and_download_url(matched_url.group(0))
-        return re.sub(TUMBLR_IMAGE_REGEX, handle_url, text)
+            new_url = self.rewrites.get(matched_url.group(0))
+            if new_url is not None:
+                REWRITE_CACHE_HITS.inc()
+                return new_url
+            new_url = self.rewrite_and_download_url(largest_media_url(matched_url), fallback_url=matched_url.group(0))
+            self.rewrites.put(matched_url.group(0), new_url)
+            return new_url
+        return TUMBLR_MEDIA_REGEX.sub(handle_url, text)
+
+
+class PendingImageSink(ImageSink):
+    """
+    Records image URLs as pending without downloading them, for working offline; see TumblrRequester.replay()
+
+    The URLs are persisted as pending images like any others, so the next crawl queues them for download.
+    """
+
+    def insert(self, url):
+        self.track(url)
+        with self.pending_lock:  # the fallback is persisted along with the URL; see track()
+            self.fallbacks.pop(url, None)
+
+
+class ThreadPool(ImageSink):
+    """
+    Manages and coordinates between a pool of threads for downloading images
+
+    The pool starts with num_threads threads and is grown or shrunk between min_threads and max_threads by its
+    DownloadScheduler, which also rate limits and retries downloads.
+
+    Images wait in a bounded ImageQueue, so a crawl that finds images faster than they download either waits for
+    room or spills the excess to disk; see ImageQueue. The pool must be shut down with close() once it is no longer
+    needed.
+    """
+
+    def __init__(self, num_threads=5, store=None, pool=None, min_threads=1, max_threads=20,
+                 queue_size=IMAGE_QUEUE_SIZE, spill=False, host_rate=HOST_RATE):
+        ImageSink.__init__(self, store if store is not None else ImageStore())
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.queue = ImageQueue(queue_size, spill)
+        self.threads = []
+        self.threads_lock = threading.Lock()
+        self.scheduler = DownloadScheduler(self.queue, num_threads, min_threads=min_threads, max_threads=max_threads,
+                                           host_rate=host_rate, on_resize=self.start_threads)
+        self.start_threads(self.scheduler.target)
+
+    def start_threads(self, num_threads):
+        """
+        Starts threads until there are at least num_threads of them.
+
+        Threads are never stopped; when the scheduler shrinks the pool the surplus threads park until it grows again.
+
+        :param num_threads: how many threads there should be
+        :return: None
+        """
+        with self.threads_lock:
+            while len(self.threads) < num_threads:
+                thread = threading.Thread(target=download_images,
+                                          kwargs={'queue': self.queue, 'id': len(self.threads), 'store': self.store,
+                                                  'pool': self.pool, 'scheduler': self.scheduler,
+                                                  'on_finished': self.finished, 'on_attempt': self.attempted,
+                                                  'on_skipped': self.already_stored,
+                                                  'fallback_url': self.fallback_url})
+                thread.daemon = True  # daemonize child threads so they die with the parent
+                thread.start()
+                self.threads.append(thread)
+                logger.debug('Started thread')
+
+    def insert(self, url):
+        """
+        Adds a URL to the queue to be downloaded
+
+        :param url: the URL to download
+        :return: None
+        """
+        self.track(url)
+        self.queue.put((url, 0))
+        IMAGE_QUEUE_DEPTH.set(self.queue.qsize())
 
     def block_on_queue(self):
         """
@@ -82,42 +282,139 @@ class ThreadPool(object):
 
         :return: None
         """
-        print 'Waiting for image queue to empty before terminating threadpool'
+        logger.info('Waiting for image queue to empty before terminating threadpool')
         self.queue.join()
-        print 'Queue emptied; terminating threadpool'
+        while self.scheduler.wait_for_retries():  # retries may still be waiting out their backoff
+            self.queue.join()
+        logger.info('Queue emptied; terminating threadpool')
+
+    def close(self, drain=True):
+        """
+        Shuts the pool down, stopping its threads.
 
+        Without draining, the queue is dropped and each thread stops after its current download. The images dropped
+        are still recorded as pending (see pop_pending_changes()), so persisting them afterwards lets the next run
+        pick them up again.
+
+        :param drain: whether to download everything queued first
+        :return: None
+        """
+        if drain:
+            self.block_on_queue()
+        dropped = self.queue.close()
+        if dropped:
+            logger.info('Left %i queued images for the next run', dropped)
+        self.scheduler.stop()
+        with self.threads_lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
 
-def download_images(queue, id):
+
+def download_images(queue, id, store, pool, scheduler, on_finished, on_attempt, on_skipped, fallback_url):
     """
-    Downloads images from a queue
+    Downloads images from a queue into an ImageStore
+
+    Queue items are tuples of a URL and how many times it has been tried. Throttled, server error and network
+    failures are handed back to the scheduler to be retried, and are the only failures that shrink the pool; a missing
+    or forbidden image says nothing about how hard the pool is pushing the host. An interrupted download keeps its
+    partial data, and the retry asks for just the rest with a Range request, or the whole image if it has changed.
+    An upgraded image URL that fails with one of FALLBACK_CODES is downloaded from the URL it was found at instead,
+    keeping the upgraded URL's local path.
 
     :param queue: the queue to pull images to download from
     :param id: an ID number for this thread, to allow for better logging
+    :param store: the ImageStore to save images in
+    :param pool: the ConnectionPool to download over
+    :param scheduler: the DownloadScheduler pacing this pool
+    :param on_finished: called with each URL once it has been downloaded or given up on
+    :param on_attempt: called with the outcome of each attempt to download a URL; see ImageSink.attempted()
+    :param on_skipped: called with each URL found already stored, without an attempt; see ImageSink.already_stored()
+    :param fallback_url: called with a URL to get the URL to fall back to; see ImageSink.fallback_url()
     :return: None
     """
     while True:
-        url = queue.get()
+        scheduler.wait_until_active(id)
+        item = queue.get()
+        if item is None:  # the pool has been closed
+            return
+        url, attempt = item
+        IMAGE_QUEUE_DEPTH.set(queue.qsize())
+        finished = True
+        stored = False
+        writer = None
         try:
-            outfile_path = OUTFILE_PATTERN % url.split('/')[-1]  # this is super janky
-            if os.path.exists(outfile_path):
-                print '%s has already been downloaded to %s; thread %i moving on' % (url, outfile_path, id)
+            if store.is_stored(url):
+                stored = True
+                on_skipped(url)
+                logger.debug('%s has already been downloaded; thread %i moving on', url, id)
                 # we don't need to call task_done() here since the finally clause takes care of it for us
                 continue
-            response = urllib2.urlopen(url)
-            if response.getcode() not in [200, 201, 301]:
-                print 'Thread %i failed to retrieve %s with HTTP status %i' % (id, url, response.getcode())
-                queue.task_done()
+            writer = store.open_writer(url)
+            if writer is None:
+                logger.debug('%s is already being downloaded; thread %i moving on', url, id)
+                finished = False  # whoever is downloading it will finish it
+                continue
+            scheduler.throttle(url)
+            start = time.time()
+            headers = writer.range_headers() or None
+            response = pool.request(url, headers=headers)
+            if response.getcode() in FALLBACK_CODES and fallback_url(url) is not None:
+                logger.info('Thread %i failed to retrieve %s with HTTP status %i; falling back to %s', id, url,
+                            response.getcode(), fallback_url(url))
+                response.read()
+                response = pool.request(fallback_url(url))  # a different resource, so any partial data can't resume
+            if response.getcode() in RETRY_CODES:
+                logger.info('Thread %i failed to retrieve %s with HTTP status %i', id, url, response.getcode())
+                response.read()
+                writer.close()
+                finished = not scheduler.retry(url, attempt, throttled=response.getcode() == 429,
+                                               retry_after=response.getheader('retry-after'))
+                on_attempt(url, DOWNLOAD_FAILED if finished else DOWNLOAD_RETRYING,
+                           error='HTTP status %i' % response.getcode(), seconds=time.time() - start)
+                continue
+            if response.getcode() == 416:  # the partial download no longer matches; start again from scratch
+                response.read()
+                writer.abort()
+                finished = not scheduler.retry(url, attempt, overloaded=False)
+                on_attempt(url, DOWNLOAD_FAILED if finished else DOWNLOAD_RETRYING, error='HTTP status 416',
+                           seconds=time.time() - start)
+                continue
+            if response.getcode() not in [200, 201, 206, 301]:
+                logger.warning('Thread %i failed to retrieve %s with HTTP status %i', id, url, response.getcode())
+                response.read()
+                writer.abort()
+                on_attempt(url, DOWNLOAD_FAILED, error='HTTP status %i' % response.getcode(),
+                           seconds=time.time() - start)
                 continue
-            print 'Thread %i now downloading %s to %s' % (id, url, outfile_path)
-            with open(outfile_path, 'w') as outfile:
-                while True:
-                    data = response.read(CHUNK_SIZE)
-                    if data:
-                        outfile.write(data)
-                    else:
-                        print 'Thread %i finished downloading %s' % (id, url)
-                        break
+            if response.getcode() == 206:
+                logger.debug('Thread %i now resuming %s from byte %i', id, url, writer.offset)
+            else:
+                logger.debug('Thread %i now downloading %s', id, url)
+            try:
+                writer.start(resumed=response.getcode() == 206, validator=response_validator(response))
+                digest = store.save(writer, response)
+            finally:
+                response.close()
+            stored = True
+            IMAGE_DOWNLOAD_SECONDS.observe(time.time() - start)
+            scheduler.record_success(url)
+            on_attempt(url, DOWNLOAD_DONE, size=writer.size, seconds=time.time() - start)
+            logger.debug('Thread %i finished downloading %s (%s)', id, url, digest)
+        except REQUEST_ERRORS as e:
+            logger.warning('Failure in thread %i: %s', id, repr(e))
+            if writer is not None:
+                writer.close()
+            finished = not scheduler.retry(url, attempt)
+            on_attempt(url, DOWNLOAD_FAILED if finished else DOWNLOAD_RETRYING, error=repr(e))
         except Exception as e:  # if anything whatsoever goes wrong
-            print 'Failure in thread %i: %s' % (id, repr(e))
+            logger.warning('Failure in thread %i: %s', id, repr(e))
+            if writer is not None:
+                writer.abort()
+            on_attempt(url, DOWNLOAD_FAILED, error=repr(e))
         finally:
+            if finished:
+                on_finished(url)
+                if not stored:
+                    IMAGE_FAILURES.inc()
             queue.task_done()